@@ -11,9 +11,32 @@ Thanks Takahiro "Poly" Horikawa!
 
 """
 
+import binascii
+import collections
+import copy
+import logging
 import serial
 import struct
 import sys
+import time
+
+from hvcp_decoder import decode_detection, DetectionFrame
+from hvcp_framing import FrameReader
+from hvcp_metrics import Metrics
+from hvcp_record import SENT, RECEIVED
+from hvcp_protocol import (commands_dict, response_codes_dict, build_command,
+                           VERSION_COMMAND, parse_version,
+                           camera_orientation_command,
+                           GET_CAMERA_ORIENTATION_COMMAND, parse_camera_orientation,
+                           detection_command, detection_frame,
+                           THRESHOLDS_READ_COMMAND, parse_thresholds, thresholds_set_command,
+                           DETECTION_SIZE_READ_COMMAND, parse_detection_size,
+                           detection_size_set_command,
+                           FACE_DETECTION_ANGLE_READ_COMMAND, parse_face_detection_angle,
+                           face_inclination_angle_set_command,
+                           Command, HvcPError, ResponseTimeout, FramingError, ResponseError,
+                           TRANSIENT_ERRORS, response_error, check_response_size,
+                           check_detection_size)
 
 BLUE = '\033[94m'
 GREEN = '\033[92m'
@@ -21,179 +44,182 @@ ORANGE = '\033[93m'
 RED = '\033[91m'
 ENDC = '\033[0m'
 
+logger = logging.getLogger("hvcp")
+
 def readUInt32LE(bytes):
     if len(bytes) != 4:
-        print "Wrong number of bytes (" + str(len(bytes)) + ") should be 4"
+        logger.warning("Wrong number of bytes (" + str(len(bytes)) + ") should be 4")
         return None
     data, = struct.unpack("<I", bytes)
     return data
 
 def readUInt8(bytes):
     if len(bytes) != 1:
-        print "Wrong number of bytes (" + str(len(bytes)) + ") should be 1"
+        logger.warning("Wrong number of bytes (" + str(len(bytes)) + ") should be 1")
         return None
-    data = int(bytes.encode('hex'), 16)
+    data, = struct.unpack("<B", bytes)
     return data
 
 def readInt8(bytes):
     if len(bytes) != 1:
-        print "Wrong number of bytes (" + str(len(bytes)) + ") should be 1"
+        logger.warning("Wrong number of bytes (" + str(len(bytes)) + ") should be 1")
         return None
-    #data = int(bytes.encode('hex'), 16)
     data, = struct.unpack("<b", bytes)
     return data
 
 def readUInt16LE(bytes):
     if len(bytes) != 2:
-        print "Wrong number of bytes (" + str(len(bytes)) + ") should be 2"
+        logger.warning("Wrong number of bytes (" + str(len(bytes)) + ") should be 2")
         return None
-    data = int(bytes[:1].encode('hex'), 16)
-    data += (int(bytes[1:].encode('hex'), 16) * 10)
+    data, = struct.unpack("<H", bytes)
     return data
 
 def readInt16LE(bytes):
     if len(bytes) != 2:
-        print "Wrong number of bytes (" + str(len(bytes)) + ") should be 2"
+        logger.warning("Wrong number of bytes (" + str(len(bytes)) + ") should be 2")
         return None
     data, = struct.unpack("<h", bytes)
     return data
 
 def writeUInt16LE(data):
-    return struct.pack("<H", data)[0]
+    return struct.pack("<H", data)
 
 def writeUInt8(data):
-    return struct.pack("B", data)[0]
+    return struct.pack("B", data)
 
 def int_to_hex_le(number):
-    """Given a number as an integer, transform into the string
+    """Given a number as an integer, transform into the bytes
     in hex with little endian encoding"""
     data = struct.pack('<h', number)
     return data
 
 def show_image_opencv(width, height, image):
+    """
+    Show the image in an OpenCV window without waiting for a key,
+    to save the images use an hvcp_sink.ImageSink
+    """
     import cv2
     import numpy as np
-    image_np = np.fromstring(image, dtype='B')
-    print "image_np shape:"
-    print image_np.shape
+    image_np = np.frombuffer(image, dtype='B')
     image_reshaped = image_np.reshape(height, width)
-    print "new shape:"
-    print image_reshaped.shape
-    cv2.imwrite("image.jpg", image_reshaped)
+    logger.debug("image_np shape: " + str(image_np.shape) + " new shape: " + str(image_reshaped.shape))
     cv2.imshow("Image:", image_reshaped)
+    # Only lets the window refresh
+    cv2.waitKey(1)
 
-    key = cv2.waitKey(0)
-    if key == 27 or key == 1048603:
-        return
-
-
-
-commands_dict = {'00': "  model / version read ",
-                 '01': " set camera orientation",
-                 '02': " get camera orientation",
-                 '03': "  detection execution  ",
-                 '05': "     set thresholds    ",
-                 '06': "     get thresholds    ",
-                 '07': "   set detection size  ",
-                 '08': "   get detection size  ",
-                 '09': "set face detection angle",
-                 '0a': "get face detection angle"
-                 }
-
-response_codes_dict = {'00': "OK",
-                       'ff': "UNDEFINED COMMAND",
-                       'fe': "INTERNAL ERROR",
-                       'fd': "ILLEGAL COMMAND",
-                       'fa': "COMMUNICATION ERROR",
-                       'fb': "COMMUNICATION ERROR",
-                       'fc': "COMMUNICATION ERROR",
-                       'f0': "DEVICE ERROR",
-                       'f1': "DEVICE ERROR",
-                       'f2': "DEVICE ERROR",
-                       'f3': "DEVICE ERROR",
-                       'f4': "DEVICE ERROR",
-                       'f5': "DEVICE ERROR",
-                       'f6': "DEVICE ERROR",
-                       'f7': "DEVICE ERROR",
-                       'f8': "DEVICE ERROR",
-                       'f9': "DEVICE ERROR"
-                       }
 
-def print_datagram_send(command):
-    print RED + "===========>"
-    print "Sending datagram:"
-    print "header     command_code       data_len  payload"
-    encoded = command.encode('hex')
+
+def format_datagram_send(command):
+    """
+    :param command: bytes, datagram to send
+    :return: str, human readable dump of the datagram
+    """
+    lines = [RED + "===========>",
+             "Sending datagram:",
+             "header     command_code       data_len  payload"]
+    encoded = binascii.hexlify(command).decode('ascii')
     h = encoded[:2]
     c = encoded[2:4]
     d = encoded[4:8]
     p = encoded[8:]
     if len(p) == 0:
         p = "None"
-    print "  " + h + "            " + c + "              " + d + "      " + p
-    print ("    [" + commands_dict.get(c, "     unknown     ") + "] (" +
-           str(readUInt16LE(command[2:4])) + " bytes)   " + p.encode('utf-8') )
-    print "===========>" + ENDC
-
-def print_datagram_read(header, data_len, response_code, payload):
-    print GREEN + "<========================="
-    print "Read datagram:"
-    print "header   response_code     data_len     payload"
+    lines.append("  " + h + "            " + c + "              " + d + "      " + p)
+    lines.append("    [" + commands_dict.get(c, "     unknown     ") + "] (" +
+                 str(readUInt16LE(command[2:4])) + " bytes)   " + p)
+    lines.append("===========>" + ENDC)
+    return "\n".join(lines)
+
+def format_datagram_read(header, data_len, response_code, payload):
+    """
+    :return: str, human readable dump of a received datagram
+    """
+    lines = [GREEN + "<=========================",
+             "Read datagram:",
+             "header   response_code     data_len     payload"]
     if header:
-        h = header.encode('hex')
+        h = binascii.hexlify(header).decode('ascii')
     else:
-        print "  None      None         None         None"
-        print "<=========================" + ENDC
-        return
+        lines.append("  None      None         None         None")
+        lines.append("<=========================" + ENDC)
+        return "\n".join(lines)
 
     if response_code:
-        r = response_code.encode('hex')
+        r = binascii.hexlify(response_code).decode('ascii')
 
     if data_len:
-        d = data_len.encode('hex')
+        d = binascii.hexlify(data_len).decode('ascii')
         data_len_bytes = readUInt32LE(data_len)
     else:
-        print "  " + h + "      " + r + "   None         None"
-        print "       " + response_codes_dict.get(r, "UNKNOWN_CODE")
-        print "<=========================" + ENDC
-        return
+        lines.append("  " + h + "      " + r + "   None         None")
+        lines.append("       " + response_codes_dict.get(r, "UNKNOWN_CODE"))
+        lines.append("<=========================" + ENDC)
+        return "\n".join(lines)
 
+    if isinstance(payload, memoryview):
+        payload = payload.tobytes()
     if payload:
         # Better not spam the screen if the payload is very big
         if len(payload) > 20:
-            newp = payload[:10]
-            p = newp.encode('hex')
+            p = payload[:10].hex()
             p += " ... "
-            newp = payload[-10:]
-            p += newp.encode('hex')
+            p += payload[-10:].hex()
             p += "   (payload too long)"
 
         else:
-            p = payload.encode('hex')
+            p = payload.hex()
         try:
-            payload_encoded_unicode = unicode(payload)#payload.encode('unicode')
+            payload_encoded_unicode = payload.decode('utf-8')
         except UnicodeDecodeError:
             payload_encoded_unicode = "[ can't encode in unicode ]"
     else:
         p = "None"
         payload_encoded_unicode = "None"
 
-    print ("  " + h + "          " + r + "           " + d + "     " + p)
-    print ("              " + (response_codes_dict.get(r, "UNKNOWN_CODE")) + "           (" +
-           str(data_len_bytes) + " bytes)   '" + payload_encoded_unicode + "'" )
-    # print ("        (" + str(data_len_bytes) + " bytes)     "
-    #        +  + "       '" + payload_encoded_unicode + "'")
-    print "<=========================" + ENDC
+    lines.append("  " + h + "          " + r + "           " + d + "     " + p)
+    lines.append("              " + (response_codes_dict.get(r, "UNKNOWN_CODE")) + "           (" +
+                 str(data_len_bytes) + " bytes)   '" + payload_encoded_unicode + "'")
+    lines.append("<=========================" + ENDC)
+    return "\n".join(lines)
+
+def print_datagram_send(command):
+    print(format_datagram_send(command))
+
+def print_datagram_read(header, data_len, response_code, payload):
+    print(format_datagram_read(header, data_len, response_code, payload))
 
 class HvcP(object):
-    def __init__(self, tty="/dev/ttyUSB0", baudrate=921600, timeout=5):
-        print "Connecting to '" + tty + "' at baudrate " + str(baudrate)
-        self.ser = serial.Serial(port=tty, baudrate=baudrate, timeout=timeout)
+    def __init__(self, tty="/dev/ttyUSB0", baudrate=921600, timeout=5, logger=logger, ser=None):
+        """
+        :param logger: logging.Logger, sent and read datagrams are dumped
+                       to it with level DEBUG
+        :param ser: already open transport to use instead of opening tty,
+                    anything with write, readinto, flushInput, flushOutput,
+                    flush and isOpen like serial.Serial
+                    (e.g. hvcp_sim.SimulatedSerial)
+        """
+        self.logger = logger
+        if ser is None:
+            self.logger.info("Connecting to '" + tty + "' at baudrate " + str(baudrate))
+            ser = serial.Serial(port=tty, baudrate=baudrate, timeout=timeout)
+        self.ser = ser
         if self.ser.isOpen():
-            print "Succesfully opened serial connection."
+            self.logger.info("Succesfully opened serial connection.")
         else:
-            print "Serial connection failed."
+            self.logger.error("Serial connection failed.")
             sys.exit(-1)
+        self.frames = FrameReader(self.ser)
+        # Errors recovered from, see error_stats
+        self.errors = collections.Counter()
+        # Stage latencies, see enable_metrics
+        self.metrics = None
+        # (command code, perf_counter_ns at the end of its write) of the
+        # commands waiting for their response, only while metrics are enabled
+        self._sent = collections.deque()
+        # function(direction, perf_counter_ns, datagram) of every datagram, see enable_trace
+        self.trace = None
+        # Last configuration confirmed by the device, see apply_profile
+        self._config = {}
 
     def clear_input(self):
         """
@@ -201,6 +227,23 @@ class HvcP(object):
         """
         self.ser.flushInput()
 
+    def drain_input(self, quiet=0.05):
+        """
+        Discard the input until nothing arrives for quiet seconds, e.g. the late
+        responses of commands that timed out, so they are not taken for the
+        responses of the next ones (needs a transport with in_waiting, like
+        serial.Serial, otherwise the input is only cleared)
+        :param quiet: float, seconds
+        """
+        self.clear_input()
+        if not hasattr(self.ser, "in_waiting"):
+            return
+        while True:
+            time.sleep(quiet)
+            if not self.ser.in_waiting:
+                return
+            self.clear_input()
+
     def clear_output(self):
         """
         Clear output buffer of serial connection
@@ -215,66 +258,182 @@ class HvcP(object):
 
     def send_command(self, str_command):
         """
-        :param str_command: str
+        :param str_command: str, datagram as hex digits, e.g. 'fe000000'
         """
-        self.send_command_hex(str_command.decode('hex'))
+        self.send_command_hex(bytes.fromhex(str_command))
 
     def send_command_hex(self, hex_command):
         """
-        :param hex_command: str that is already hex
+        :param hex_command: bytes, datagram (e.g. one of the hvcp_protocol commands)
         """
-        print_datagram_send(hex_command)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(format_datagram_send(hex_command))
+        trace = self.trace
+        if trace is not None:
+            trace(SENT, time.perf_counter_ns(), hex_command)
+        metrics = self.metrics
+        if metrics is None:
+            self.ser.write(hex_command)
+            return
+        start = time.perf_counter_ns()
         self.ser.write(hex_command)
+        end = time.perf_counter_ns()
+        metrics.record(hex_command[1], "write", end - start)
+        self._sent.append((hex_command[1], end))
 
     def read(self, size):
         bytes_read = self.ser.read(size)
         if len(bytes_read) != size:
-            print "Warning: asked to read " + str(size) + " bytes but read " + str(len(bytes_read))
+            self.logger.warning("Asked to read " + str(size) + " bytes but read " + str(len(bytes_read)))
             return None
         return bytes_read
 
-    def read_data(self, size=None):
+    def read_data(self, size=None, into=None, copy=True):
         """
         Read the data coming from the board
         :param size: bytes to read (forcing, not using data_len from the protocol)
+        :param into: writable memoryview to read the payload into instead of
+                     allocating it, the returned data is then a view of it
+        :param copy: if False (and no into is given) data is a memoryview of the
+                     reusable read buffer, only valid until the next read
         :return: response_code (0 if all went well), data
+                 response_code, None if the response code is not OK
                  None, None if something went wrong
         """
-        response_header_bytes, data_len_bytes, response_code_bytes = None, None, None
-        response_code, payload_bytes = None, None
-        # Check header
-        response_header_bytes = self.read(1)
-        if response_header_bytes:
-            if response_header_bytes != '\xfe':
-                print "Error: Invalid response header, clearing input"
+        try:
+            return 0, self._read_response(size=size, into=into, copy=copy)
+        except ResponseError as e:
+            self.logger.warning("Response code not OK: " + str(e))
+            return e.response_code, None
+        except HvcPError as e:
+            self.logger.warning(str(e))
+            return None, None
+
+    def _read_response(self, command_code=None, size=None, into=None, copy=True):
+        """
+        Read a response, see read_data
+        :param command_code: int, command it answers, to check the payload length
+        :return: data
+        :raise HvcPError: ResponseTimeout, FramingError or ResponseError (by response code)
+        """
+        metrics = self.metrics
+        response_code, data_len = self.frames.read_header()
+        if metrics is not None:
+            header_time = time.perf_counter_ns()
+            # The responses come in the order of the commands
+            sent_code, sent_time = self._sent.popleft() if self._sent else (None, None)
+            if response_code is not None and sent_code is not None:
+                metrics.record(sent_code, "wait", header_time - sent_time)
+        if response_code is None:
+            self.errors["timeouts"] += 1
+            raise ResponseTimeout("No valid response header received")
+
+        payload_bytes = None
+        try:
+            if response_code != 0:
+                self.frames.read_payload(data_len)
+                self.errors[response_codes_dict.get("%02x" % response_code, "UNKNOWN_CODE")] += 1
+                raise response_error(response_code)
+            if command_code is not None:
+                try:
+                    check_response_size(command_code, data_len)
+                except FramingError:
+                    self.errors["bad_lengths"] += 1
+                    raise
+
+            # Set the bytes to read as payload, contemplate the forced case
+            data_bytes_to_read = data_len
+            if size is not None:
+                data_bytes_to_read = size
+                self.logger.warning("Forcing to read " + str(data_bytes_to_read) + " bytes instead of " + str(data_len))
+            if into is not None and data_bytes_to_read > len(into):
+                self.frames.read_payload(data_bytes_to_read)
+                self.errors["bad_lengths"] += 1
+                raise FramingError("Payload of " + str(data_bytes_to_read) + " bytes does not fit in buffer, skipping it")
+            payload_bytes = self.frames.read_payload(data_bytes_to_read, into)
+            if payload_bytes is None:
+                self.errors["timeouts"] += 1
+                raise ResponseTimeout("Payload of " + str(data_bytes_to_read) + " bytes not fully received")
+            if into is None and copy:
+                payload_bytes = payload_bytes.tobytes()
+            if metrics is not None and sent_code is not None:
+                metrics.record(sent_code, "transfer", time.perf_counter_ns() - header_time)
+        finally:
+            trace = self.trace
+            if trace is not None:
+                datagram = bytes(self.frames.header)
+                if payload_bytes is not None:
+                    datagram += bytes(payload_bytes)
+                trace(RECEIVED, time.perf_counter_ns(), datagram)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                header = bytes(self.frames.header)
+                self.logger.debug(format_datagram_read(header[0:1], header[2:6], header[1:2], payload_bytes))
+        return payload_bytes
+
+    def execute(self, command, retries=2, backoff=0.005):
+        """
+        Send a command and read its response. On a transient error (timeout,
+        unexpected length, communication error) the input is flushed and the
+        command sent again, up to retries times, waiting backoff, 2 * backoff...
+        before each retry.
+        :param command: bytes, full datagram (all the commands are idempotent)
+        :return: bytes, payload of the response
+        :raise HvcPError: ResponseError subclass by response code, ResponseTimeout
+                          or FramingError once the retries are exhausted
+        """
+        command_code = command[1]
+        for attempt in range(retries + 1):
+            if attempt:
+                self.errors["retries"] += 1
+                time.sleep(backoff * 2 ** (attempt - 1))
                 self.clear_input()
-            else:
-                response_code_bytes = self.read(1)
-                if response_code_bytes:
-                    response_code = readUInt8(response_code_bytes)
-                    if response_code_bytes == '\x00': # If all is OK
-                        # Check data len, Little Endian Unsigned Int 32bits (4 bytes)
-                        data_len_bytes = self.read(4)
-                        if data_len_bytes:
-                            data_len = readUInt32LE(data_len_bytes)
-                            # total length = header + data_length_header + response_code + data_len
-                            response_len = 1 + 4 + 1 + data_len
-                            # Set the bytes to read as payload, contemplate the forced case
-                            data_bytes_to_read = data_len
-                            if size is not None:
-                                data_bytes_to_read = size
-                                print "Forcing to read " + str(data_bytes_to_read) + " bytes instead of " + str(data_len)
-                            #print "Reading " + str(data_bytes_to_read) + " bytes as payload"
-                            payload_bytes = self.read(data_bytes_to_read)
-                    else:
-                        print "Response code not OK, cleaning buffer"
-                        # Read zeros
-                        zeros = self.read(4)
-
-
-        print_datagram_read(response_header_bytes, data_len_bytes, response_code_bytes, payload_bytes)
-        return response_code, payload_bytes
+            self.send_command_hex(command)
+            try:
+                return self._read_response(command_code)
+            except TRANSIENT_ERRORS as e:
+                error = e
+                self.logger.warning("Command 0x%02x failed: %s" % (command_code, e))
+        raise error
 
+    def enable_trace(self, trace):
+        """
+        Pass every datagram sent and received (the response header and
+        payload) to trace, e.g. a compact binary file:
+            sensor.enable_trace(hvcp_record.DatagramTrace("session.hvcptrc"))
+        :param trace: function(direction (hvcp_record.SENT or RECEIVED),
+                      time.perf_counter_ns(), datagram bytes)
+        """
+        self.trace = trace
+
+    def disable_trace(self):
+        self.trace = None
+
+    def enable_metrics(self, metrics=None):
+        """
+        Start recording the latency of every stage (write, wait, transfer, decode)
+        of every command
+        :param metrics: hvcp_metrics.Metrics to record into (None = a new one)
+        :return: hvcp_metrics.Metrics
+        """
+        if metrics is None:
+            metrics = Metrics()
+        self._sent.clear()
+        self.metrics = metrics
+        return metrics
+
+    def disable_metrics(self):
+        self.metrics = None
+        self._sent.clear()
+
+    def error_stats(self):
+        """
+        Count of every error recovered from since the connection was opened, e.g.:
+        {'timeouts': 1, 'bad_lengths': 0, 'retries': 1, 'resyncs': 3, 'COMMUNICATION ERROR': 1}
+        :return: dict
+        """
+        stats = dict(self.errors)
+        stats["resyncs"] = self.frames.resyncs
+        return stats
 
     def get_version(self):
         """
@@ -286,66 +445,126 @@ class HvcP(object):
         'minor_version': 0}
         :return: Dictionary with model, major_version, minor_version, release_version, revision
         """
-        # Type string (12 characters): "HVC-C1B"
-        # Major version (1 byte HEX): it will update at the time of large-scale change
-        # Minor version (1 byte HEX): I will update when small change
-        # Release version (1 byte HEX): I will update when minor modifications
-        # Revision number (4 bytes HEX): use it for internal management
+        try:
+            return parse_version(self.execute(VERSION_COMMAND))
+        except HvcPError as e:
+            self.logger.error("Could not get the version: " + str(e))
+            return None
 
-        self.send_command('fe000000')
-        response_code, data = self.read_data()
-        version_dict = {}
-        version_dict["model"] = data[0:12]
-        version_dict["major_version"] = readInt8(data[12:13])
-        version_dict["minor_version"] = readInt8(data[13:14])
-        version_dict["release_version"] = readInt8(data[14:15])
-        version_dict["revision"] = data[15:19].encode('hex')
-        return version_dict
 
+    def invalidate_config(self):
+        """
+        Forget the cached configuration, the next reads will go to the device
+        (e.g. after the sensor was power cycled)
+        """
+        self._config.clear()
 
-    def set_camera_orientation(self, angle):
+    def _read_config(self, key, command, parser, refresh):
+        """
+        Serve a configuration read from the cache, or from the device
+        if it is not cached or refresh is True
+        """
+        if not refresh and key in self._config:
+            return copy.copy(self._config[key])
+        try:
+            value = parser(self.execute(command))
+        except HvcPError as e:
+            self.logger.error("Could not read the " + key + ": " + str(e))
+            return None
+        if value is not None:
+            self._config[key] = value
+        return copy.copy(value)
+
+    def _apply_config(self, changes, force=False):
+        """
+        Send the setters whose value is not the one already confirmed by the device.
+        All the commands are written before reading the responses, so a batch
+        costs a single round trip.
+        :param changes: list of (config key, value as returned by its reader, command)
+        :param force: bool, send even the values that did not change
+        :return: list of the config keys that were sent
+        """
+        changes = [change for change in changes
+                   if force or self._config.get(change[0]) != change[1]]
+        for key, value, command in changes:
+            self.send_command_hex(command)
+        for key, value, command in changes:
+            response_code, data = self.read_data()
+            # The datasheet says it should give back info about how it went
+            # but in my case it does not work, so only trust the response code
+            if response_code == 0:
+                self._config[key] = value
+            else:
+                self._config.pop(key, None)
+        return [key for key, value, command in changes]
+
+    def _camera_orientation_change(self, angle):
+        command = camera_orientation_command(angle)
+        return "camera_orientation", parse_camera_orientation(command[4:]), command
+
+    def _thresholds_change(self, human_body, hand, face):
+        command = thresholds_set_command(human_body, hand, face)
+        return "thresholds", parse_thresholds(command[4:]), command
+
+    def _detection_size_change(self, human_body_min, human_body_max,
+                               hand_min, hand_max, face_min, face_max):
+        command = detection_size_set_command(human_body_min, human_body_max,
+                                             hand_min, hand_max,
+                                             face_min, face_max)
+        return "detection_size", parse_detection_size(command[4:]), command
+
+    def _face_detection_angle_change(self, face_direction, face_inclination):
+        command = face_inclination_angle_set_command(face_direction, face_inclination)
+        return "face_detection_angle", parse_face_detection_angle(command[4:]), command
+
+    def apply_profile(self, profile, force=False):
+        """
+        Apply several settings in one batch, only sending the ones that changed, e.g.:
+        {'camera_orientation': 90,
+         'thresholds': {'human_body': 500, 'hand': 500, 'face': 500},
+         'detection_size': {'human_body_min': 30, 'human_body_max': 8192,
+                            'hand_min': 40, 'hand_max': 8192,
+                            'face_min': 64, 'face_max': 8192},
+         'face_detection_angle': {'face_direction': 'front', 'face_inclination': '15'}}
+        Any of the keys can be left out.
+        :param profile: dict
+        :param force: bool, send all the settings even if the device already has them
+        :return: list of the settings that were sent
+        """
+        changes = []
+        if "camera_orientation" in profile:
+            changes.append(self._camera_orientation_change(profile["camera_orientation"]))
+        if "thresholds" in profile:
+            thresholds = profile["thresholds"]
+            changes.append(self._thresholds_change(thresholds["human_body"],
+                                                   thresholds["hand"],
+                                                   thresholds["face"]))
+        if "detection_size" in profile:
+            changes.append(self._detection_size_change(**profile["detection_size"]))
+        if "face_detection_angle" in profile:
+            face_angle = profile["face_detection_angle"]
+            changes.append(self._face_detection_angle_change(face_angle["face_direction"],
+                                                             face_angle["face_inclination"]))
+        return self._apply_config(changes, force)
+
+    def set_camera_orientation(self, angle, force=False):
         """
         Set the camera mounting orientation.
+        Nothing is sent if the device already has it, unless force is True.
         :param angle: 0, 90, 180, 270
         :return:
         """
-        angle_code = '00'
-        if angle == 0:
-            angle_code = '00'
-        elif angle == 90:
-            angle_code = '01'
-        elif angle == 180:
-            angle_code = '02'
-        elif angle == 270:
-            angle_code = '03'
-
-        buf = 'fe' # sync header
-        buf += '01' # command
-        buf += '0100' # data len
-        buf += angle_code # payload
-        self.send_command(buf)
-        response_code, data = self.read_data()
-        # The datasheet says it should give back info about how it went
-        # but in my case it does not work
-
-    def get_camera_orientation(self):
+        self._apply_config([self._camera_orientation_change(angle)], force)
+
+    def get_camera_orientation(self, refresh=False):
         """
         Get the camera mounting orientation
+        :param refresh: bool, ask the device even if the value is cached
         :return: 0, 90, 180, 270 as degrees of orientation
         and the config setting
         """
-        self.send_command('fe020000')
-        response_code, data = self.read_data()
-
-        if data == '\x00':
-            return 0
-        elif data == '\x01':
-            return 90
-        elif data == '\x02':
-            return 180
-        elif data == '\x03':
-            return 270
-        return None, None
+        return self._read_config("camera_orientation", GET_CAMERA_ORIENTATION_COMMAND,
+                                 parse_camera_orientation, refresh)
 
     def detection_execution(self, eyes_closed=True, gaze=True,
                             gender=True, age=True, face_orientation=True,
@@ -354,277 +573,260 @@ class HvcP(object):
                             facial_expression=True,
                             image_bit=False,
                             image_bit_small=False,
-                            show_image=True):
+                            show_image=True,
+                            image_ring=None,
+                            features=None,
+                            lazy=False):
         """
         Sets the detection to execute once
-        :return:
-        """
-        command = '\xfe\x03\x03\x00'
-        # 2 bytes: things to run
-        # 1 byte: reserved
-        # The bytes are configured by bits, byte_config_1:
-        # byte 7 6 5 4 3 2 1 0
-        # eye_closed, line_of_sight, gender, age, face_orientation, face_detection, hand_detection, human_body_detection
-        # byte_config_2:
-        # 0, 0, 0, 0, 0, 0, 0, facial_expression [all 0's but the last]
-        # byte_config_3:
-        # 0, 0, 0, 0, 0, 0, 0, 0 [Fixed 0's]
-        #                   |__|    <- the last bits enable getting grayscale image!
-        #        little_image     big_image
-        bitmask_1 = int('00000000', 2)
-        bitmask_2 = int('00000000', 2)
-        bitmask_3 = int('00000000', 2)
-        if eyes_closed:
-            bitmask_1 |= int('10000000', 2)
-        if gaze:
-            bitmask_1 |= int('01000000', 2)
-        if gender:
-            bitmask_1 |= int('00100000', 2)
-        if age:
-            bitmask_1 |= int('00010000', 2)
-        if face_orientation:
-            bitmask_1 |= int('00001000', 2)
-        if face_detection:
-            bitmask_1 |= int('00000100', 2)
-        if hand_detection:
-            bitmask_1 |= int('00000010', 2)
-        if human_body_detection:
-            bitmask_1 |= int('00000001', 2)
-
-        if facial_expression:
-            bitmask_2 |= int('00000001', 2)
-
-        image_bit=True
-        if image_bit:
-            bitmask_3 |= int('00000001', 2)
-        #image_bit_small=True
-        if image_bit_small:
-            bitmask_3 |= int('00000010', 2)
-
-        command = command + chr(bitmask_1) + chr(bitmask_2) + chr(bitmask_3)
-        #command = command + byte_config_1 + byte_config_2 + byte_config_3
+        :return: dict with a list of detections per category, e.g.:
+        {'body': [{'coord_x': 120, 'coord_y': 240, 'detect_size': 300, 'reliability': 800}],
+         'hand': [],
+         'face': [{'coord_x': 100, 'coord_y': 80, 'detect_size': 90, 'reliability': 700,
+                   'age_estimation': {'age': 30, 'reliability': 500}, ...}]}
+        plus 'image': {'width', 'height', 'data'} when an image was requested
+        :param image_ring: hvcp_image.ImageRing, if given the image is read in place
+        into one of its slots, 'image' then also has the 'slot' that must be
+        released once the image is consumed
+        :param features: hvcp_protocol.Feature flags, used instead of the
+        individual flags, e.g. Feature.FACE_DETECTION | Feature.AGE
+        :param lazy: bool, return a hvcp_decoder.DetectionFrame, that only decodes
+        the fields that are accessed, instead of the dict
+        """
+        if features is None:
+            command, bitmask_1, bitmask_2, bitmask_3 = detection_command(
+                eyes_closed, gaze, gender, age, face_orientation, face_detection,
+                hand_detection, human_body_detection, facial_expression,
+                image_bit, image_bit_small)
+        else:
+            command, bitmask_1, bitmask_2, bitmask_3 = detection_frame(features)
         self.send_command_hex(command)
-        #self.send_command(command)
-        response_code, data = self.read_data()
-
-        # header human_body[0-35], hand detection[0-35], face detection[0-35], reserved [0 fixed]
-        header_offset = 4
-        header = data[:header_offset]
-        body_n = readInt8(header[0])
-        hand_n = readInt8(header[1])
-        face_n = readInt8(header[2])
-        # reserved is useless
-        detection_dict = {}
-        detection_dict["body"] = {"num_detections": body_n}
-        detection_dict["hand"] = {"num_detections": hand_n}
-        detection_dict["face"] = {"num_detections": face_n}
-
-        def get_results(bytes):
-            coord_x = readInt16LE(bytes[0:2])
-            coord_y = readInt16LE(bytes[2:4])
-            detect_size = readInt16LE(bytes[4:6])
-            reliability = readInt16LE(bytes[6:8])
-            result_dict = {"coord_x": coord_x,
-                           "coord_y": coord_y,
-                           "detect_size": detect_size,
-                           "reliability": reliability}
-            return result_dict
-
-
-        for body_idx in range(body_n):
-            # bodies stuff body_n x 8 bytes
-            init_offset = header_offset + body_idx*8
-            end_offset = header_offset + body_idx*8 + 8
-            result_dict = get_results(data[init_offset:end_offset])
-            detection_dict["body"].update(result_dict)
-
-        # hands stuff hand_n x 8 bytes
-        for hand_idx in range(hand_n):
-            # hand stuff hand x 8 bytes
-            init_offset = header_offset + hand_idx*8
-            end_offset = header_offset + hand_idx*8 + 8
-            result_dict = get_results(data[init_offset:end_offset])
-            detection_dict["hand"].update(result_dict)
-
-        end_offset = header_offset
-        # faces stuff face_n x 2~31 bytes
-        for face_idx in range(face_n):
-            # 8 byte Face detection
-            if face_detection:
-                init_offset = header_offset + face_idx*8
-                end_offset = header_offset + face_idx*8 + 8
-                result_dict = get_results(data[init_offset:end_offset])
-                detection_dict["face"].update(result_dict)
-
-            # 8 byte Face direction estimation
-            if face_orientation:
-                init_offset = end_offset
-                end_offset = init_offset + 8
-                detection_dict["face"].update({
-                    "face_orientation": {
-                                    "left_and_right_direction": readInt16LE(data[init_offset:init_offset+2]),
-                                    "vertical_angle": readInt16LE(data[init_offset+2:init_offset+4]),
-                                    "face_inclination_angle": readInt16LE(data[init_offset+4:init_offset+6]),
-                                    "reliability": readInt16LE(data[init_offset+6:end_offset])
-                                    }
-                    })
-
-            # 3 byte Age estimation
-            if age:
-                init_offset = end_offset
-                end_offset = init_offset + 3
-                detection_dict["face"].update({
-                    "age_estimation": {
-                                    "age": readInt8(data[init_offset:init_offset+1]),
-                                    "reliability": readInt16LE(data[init_offset+1:end_offset])
-                                    }
-                    })
-
-            # 3 byte Gender estimation
-            if gender:
-                init_offset = end_offset
-                end_offset = init_offset + 3
-                gender = readInt8(data[init_offset:init_offset+1])
-                if gender == 0:
-                    gender = "woman"
-                elif gender == 1:
-                    gender = "man"
-                detection_dict["face"].update({
-                    "gender_estimation": {
-                                    "gender": gender,
-                                    "reliability": readInt16LE(data[init_offset+1:end_offset])
-                                    }
-                    })
-
-            # 2 byte Gaze estimation
-            if gaze:
-                init_offset = end_offset
-                end_offset = init_offset + 2
-                left_and_right_angle = readInt8(data[init_offset:init_offset+1])
-                up_and_down_angle = readInt8(data[init_offset+1:end_offset])
-                detection_dict["face"].update({
-                    "gaze_estimation": {
-                                    "left_and_right_angle": left_and_right_angle,
-                                    "up_and_down_angle": up_and_down_angle
-                                    }
-                    })
-
-            # 4 byte Eye closed
-            if eyes_closed:
-                init_offset = end_offset
-                end_offset = init_offset + 4
-                eyes_head_left = readInt16LE(data[init_offset:init_offset+2])
-                eyes_head_right = readInt16LE(data[init_offset+2:end_offset])
-                detection_dict["face"].update({
-                    "eyes_estimation": {
-                                    "eyes_head_left": eyes_head_left,
-                                    "eyes_head_right": eyes_head_right
-                                    }
-                    })
-
-            # 3 byte Facial expression estimation
-            if facial_expression:
-                init_offset = end_offset
-                end_offset = init_offset + 3
-                expression = readInt8(data[init_offset:init_offset+1])
-                # 1 = expressionless, 2 = joy, 3 = surprise, 4 = anger, 5 = sadness
-                if expression == 1:
-                    expression_str = "expressionless"
-                elif expression == 2:
-                    expression_str = "joy"
-                elif expression == 3:
-                    expression_str = "surprise"
-                elif expression == 4:
-                    expression_str = "anger"
-                elif expression == 5:
-                    expression_str = "sadness"
-                else:
-                    expression_str = "unknown"
-                top_score = readInt8(data[init_offset+1:init_offset+2])
-                neg_pos_degree = readInt8(data[init_offset+2:end_offset])
-                detection_dict["face"].update({
-                    "facial_expression": {
-                                    "expression": expression_str,
-                                    "top_score": top_score,
-                                    "neg_pos_degree": neg_pos_degree
-                                    }
-                    })
-
-        if image_bit:
-            # 76800 size (+4 of width and height))
-            width = readInt16LE(data[end_offset:end_offset+2])
-            height = readInt16LE(data[end_offset+2:end_offset+4])
-            image = data[end_offset+4:]
-            print "Got a big image of width, height: " + str((width, height))
-            print "With image size: " + str(len(image))
-
-        if image_bit_small:
-            # 19200 size (+4 of width and height)
-            width = readInt16LE(data[end_offset:end_offset+2])
-            height = readInt16LE(data[end_offset+2:end_offset+4])
-            image = data[end_offset+4:]
-            print "Got a tiny image of width, height: " + str((width, height))
-            print "With image size: " + str(len(image))
-
-        if show_image and (image_bit or image_bit_small):
-            show_image_opencv(width, height, image)
+        data, slot = self._read_detection(bitmask_1, bitmask_2, bitmask_3, image_ring, copy=lazy)
+        if data is None:
+            return None
+        detection_dict = self._decode_detection(data, bitmask_1, bitmask_2, bitmask_3, slot, lazy)
+
+        if "image" in detection_dict:
+            width = detection_dict["image"]["width"]
+            height = detection_dict["image"]["height"]
+            image = detection_dict["image"]["data"]
+            self.logger.debug("Got an image of width, height: " + str((width, height)) +
+                              " with image size: " + str(len(image)))
+
+            if show_image:
+                if "slot" in detection_dict["image"]:
+                    image = detection_dict["image"]["slot"].array()
+                show_image_opencv(width, height, image)
 
         return detection_dict
 
-    def thresholds_read(self):
+    def _read_detection(self, bitmask_1, bitmask_2, bitmask_3, image_ring=None, copy=False,
+                        image_sink=None):
+        """
+        Read a detection execution response, into a slot of image_ring if
+        an image was requested, and check its length against its counts.
+        A response lost or not matching the command may still (partly) be on
+        its way: the input is drained so that it is not read as the response
+        of the next command
+        :param copy: bool, without a slot return a copy instead of the reusable read buffer
+        :param image_sink: hvcp_sink.ImageSink holding slots of image_ring, that
+                           decides what to do when they are all taken
+        :return: data, slot (None, None if nothing could be read)
+        """
+        slot = None
+        if image_ring is not None and bitmask_3:
+            if image_sink is None:
+                slot = image_ring.acquire()
+            else:
+                slot = image_sink.acquire(image_ring)
+        data = None
+        try:
+            if slot is not None:
+                data = self._read_response(Command.DETECTION_EXECUTION, into=slot.buffer)
+            else:
+                data = self._read_response(Command.DETECTION_EXECUTION, copy=copy)
+            try:
+                check_detection_size(data, bitmask_1, bitmask_2, bitmask_3)
+            except FramingError:
+                self.errors["bad_lengths"] += 1
+                raise
+        except ResponseError as e:
+            self.logger.warning("Response code not OK: " + str(e))
+            data = None
+        except (ResponseTimeout, FramingError) as e:
+            self.logger.warning("Dropping a detection response: " + str(e))
+            data = None
+            self.drain_input()
+        if data is None and slot is not None:
+            slot.release()
+            slot = None
+        return data, slot
+
+    def _decode_detection(self, data, bitmask_1, bitmask_2, bitmask_3, slot=None, lazy=False):
+        """
+        :param lazy: bool, return a hvcp_decoder.DetectionFrame (data must not be
+                     the reusable read buffer, see _read_detection)
+        """
+        decode = self._decode_lazy if lazy and slot is not None else \
+            DetectionFrame if lazy else decode_detection
+        metrics = self.metrics
+        if metrics is None:
+            detection_dict = decode(data, bitmask_1, bitmask_2, bitmask_3)
+        else:
+            start = time.perf_counter_ns()
+            detection_dict = decode(data, bitmask_1, bitmask_2, bitmask_3)
+            metrics.record(Command.DETECTION_EXECUTION, "decode", time.perf_counter_ns() - start)
+        if slot is not None:
+            image = detection_dict["image"]
+            # The image is at the end of the payload
+            slot.set_image(image["width"], image["height"],
+                           len(data) - image["width"] * image["height"])
+            image["slot"] = slot
+        elif "image" in detection_dict and not lazy:
+            # data is the reusable read buffer, keep a copy of the image
+            detection_dict["image"]["data"] = detection_dict["image"]["data"].tobytes()
+        return detection_dict
+
+    @staticmethod
+    def _decode_lazy(data, bitmask_1, bitmask_2, bitmask_3):
+        """
+        DetectionFrame of a payload read into an image ring slot: the slot is
+        reused once released while the fields may not be decoded yet, so the
+        frame is built on a copy of the detections and only the image stays
+        in the slot
+        """
+        image = DetectionFrame(data, bitmask_1, bitmask_2, bitmask_3)["image"]
+        detections_end = len(data) - image["width"] * image["height"]
+        detection_frame = DetectionFrame(bytes(data[:detections_end]), bitmask_1, bitmask_2, bitmask_3)
+        detection_frame["image"] = image
+        return detection_frame
+
+    def stream(self, frames=None, eyes_closed=True, gaze=True,
+               gender=True, age=True, face_orientation=True,
+               face_detection=True, hand_detection=True,
+               human_body_detection=True,
+               facial_expression=True,
+               image_bit=False,
+               image_bit_small=False,
+               image_ring=None,
+               features=None,
+               image_sink=None,
+               lazy=False,
+               next_command=None):
+        """
+        Run the detection continuously, yielding every frame as it arrives:
+        {'frame': 0, 'timestamp': 1500000000.123, 'fps': 9.8, 'errors': 0,
+         'detections': <dict as returned by detection_execution>}
+        errors counts the responses that could not be read so far.
+        The next detection command is sent as soon as a response is received,
+        so the sensor is already working on the next frame while this one
+        is decoded and consumed.
+        :param frames: int, number of frames to capture (None = forever)
+        :param image_ring: hvcp_image.ImageRing to read the images into, see detection_execution
+        :param features: hvcp_protocol.Feature flags, see detection_execution
+        :param image_sink: hvcp_sink.ImageSink, every image is also queued there to be
+        encoded off this thread (it then releases the image_ring slots itself, and
+        applies its drop policy when they are all queued)
+        :param lazy: bool, the detections are hvcp_decoder.DetectionFrame, see detection_execution
+        :param next_command: function(detections) choosing the command of every frame from
+        the frame before: it is called with None for the first frame, then with the
+        detections of every frame (None if it could not be read), and returns the
+        (command, bitmask_1, bitmask_2, bitmask_3) of hvcp_protocol.detection_command.
+        The detection flags and features are then ignored, and every frame is
+        decoded before the next command is sent.
+        :return: generator of frame dicts
+        """
+        if next_command is not None:
+            command = next_command(None)
+        elif features is None:
+            command = detection_command(
+                eyes_closed, gaze, gender, age, face_orientation, face_detection,
+                hand_detection, human_body_detection, facial_expression,
+                image_bit, image_bit_small)
+        else:
+            command = detection_frame(features)
+        start_time = time.time()
+        self.send_command_hex(command[0])
+        commands_sent = 1
+        in_flight = True
+        frame_idx = 0
+        errors = 0
+        try:
+            while in_flight:
+                cmd, bitmask_1, bitmask_2, bitmask_3 = command
+                data, slot = self._read_detection(bitmask_1, bitmask_2, bitmask_3,
+                                                  image_ring, copy=lazy,
+                                                  image_sink=image_sink)
+                timestamp = time.time()
+                detection_dict = None
+                if next_command is not None:
+                    if data is not None:
+                        detection_dict = self._decode_detection(data, bitmask_1, bitmask_2,
+                                                                bitmask_3, slot, lazy)
+                    command = next_command(detection_dict)
+                in_flight = False
+                if frames is None or commands_sent < frames:
+                    self.send_command_hex(command[0])
+                    commands_sent += 1
+                    in_flight = True
+                if data is None:
+                    errors += 1
+                    continue
+                if detection_dict is None:
+                    detection_dict = self._decode_detection(data, bitmask_1, bitmask_2,
+                                                            bitmask_3, slot, lazy)
+                if image_sink is not None and "image" in detection_dict:
+                    image_sink.put(frame_idx, detection_dict)
+                fps = (frame_idx + 1) / (timestamp - start_time)
+                yield {"frame": frame_idx,
+                       "timestamp": timestamp,
+                       "fps": fps,
+                       "errors": errors,
+                       "detections": detection_dict}
+                frame_idx += 1
+        finally:
+            if in_flight:
+                # Consume the response of the command sent ahead
+                self.read_data()
+
+    def thresholds_read(self, refresh=False):
         """
         Reads the thresholds set for human body, hand and face detectors
         {'human_body': 254, 'face': 254, 'reserved': 254, 'hand': 254}
+        :param refresh: bool, ask the device even if the value is cached
         :return:
         """
-        self.send_command('fe060000')
-        response_code, data = self.read_data()
-        thresholds_dict = {}
-        thresholds_dict["human_body"] = readInt16LE(data[0:2])
-        thresholds_dict["hand"]       = readInt16LE(data[2:4])
-        thresholds_dict["face"]       = readInt16LE(data[4:6])
-        thresholds_dict["reserved"]   = readInt16LE(data[6:8])
-        return thresholds_dict
+        return self._read_config("thresholds", THRESHOLDS_READ_COMMAND,
+                                 parse_thresholds, refresh)
 
 
-    def thresholds_set(self, human_body, hand, face):
+    def thresholds_set(self, human_body, hand, face, force=False):
         """
         Set the thresholds on detecting bodies, hands and faces. Scale 1-1000, default 500.
+        Nothing is sent if the device already has them, unless force is True.
         :param human_body: int
         :param hand: int
         :param face: int
         """
-        command = '\xfe\x05\x08\x00'
-        command += int_to_hex_le(human_body)
-        command += int_to_hex_le(hand)
-        command += int_to_hex_le(face)
-        command += int_to_hex_le(0)
-        self.send_command_hex(command)
-        self.read_data()
+        self._apply_config([self._thresholds_change(human_body, hand, face)], force)
 
 
-    def detection_size_read(self):
+    def detection_size_read(self, refresh=False):
         """
         Get the detection size configurations (max and min): human_body size,
         hand size and face size:
         {'human_body_min': 30, 'hand_min': 40, 'hand_max': 8192, 'face_min': 64, 'face_max': 8192, 'human_body_max': 8192}
+        :param refresh: bool, ask the device even if the value is cached
         :return: dict
         """
-        self.send_command('fe080000')
-        response_code, data = self.read_data()
-        detection_size_dict = {}
-        detection_size_dict["human_body_min"] = readInt16LE(data[0:2])
-        detection_size_dict["human_body_max"] = readInt16LE(data[2:4])
-        detection_size_dict["hand_min"]       = readInt16LE(data[4:6])
-        detection_size_dict["hand_max"]       = readInt16LE(data[6:8])
-        detection_size_dict["face_min"]       = readInt16LE(data[8:10])
-        detection_size_dict["face_max"]       = readInt16LE(data[10:12])
-        return detection_size_dict
+        return self._read_config("detection_size", DETECTION_SIZE_READ_COMMAND,
+                                 parse_detection_size, refresh)
 
     def detection_size_set(self, human_body_min, human_body_max,
-                           hand_min, hand_max, face_min, face_max):
+                           hand_min, hand_max, face_min, face_max, force=False):
         """
         Set the detection size settings, range 20-8192, defaults here:S
+        Nothing is sent if the device already has them, unless force is True.
         :param human_body_min: int (30)
         :param human_body_max: int (8192)
         :param hand_min: int (40)
@@ -633,135 +835,52 @@ class HvcP(object):
         :param face_max: int (8192)
         :return:
         """
-        command = '\xfe\x07\x0c\x00'
-        command += int_to_hex_le(human_body_min)
-        command += int_to_hex_le(human_body_max)
-        command += int_to_hex_le(hand_min)
-        command += int_to_hex_le(hand_max)
-        command += int_to_hex_le(face_min)
-        command += int_to_hex_le(face_max)
-        self.send_command_hex(command)
-        self.read_data()
+        self._apply_config([self._detection_size_change(human_body_min, human_body_max,
+                                                        hand_min, hand_max,
+                                                        face_min, face_max)], force)
 
 
-    def face_detection_angle_read(self):
+    def face_detection_angle_read(self, refresh=False):
         """
         Face orientation left and right, face is the configuration of the slope (each 1 byte)
         whatever that means.
         {'face_inclination': '+-15', 'face_direction': 'front_face (+-30)'}
+        :param refresh: bool, ask the device even if the value is cached
         :return:
         """
-        self.send_command('fe0a0000')
-        response_code, data = self.read_data()
-        face_angle_dict = {}
-        if data[:1] == '\x00':
-            face_angle_dict["face_direction"] = "front_face (+-30)"
-        elif data[:1] == '\x01':
-            face_angle_dict["face_direction"] = "diagonal_face (+-60)"
-        elif data[:1] == '\x02':
-            face_angle_dict["face_direction"] = "profile_face (+-90)"
-        else:
-            face_angle_dict["face_direction"] = "unknown_setting (" + data[:1].encode('hex') + ")"
-
-        if data[1:2] == '\x00':
-            face_angle_dict["face_inclination"] = "+-15"
-        elif data[1:2] == '\x01':
-            face_angle_dict["face_inclination"] = "+-45"
-        else:
-            face_angle_dict["face_inclination"] = "unknown_setting (" + data[1:2].encode('hex') + ")"
-
-        return face_angle_dict
+        return self._read_config("face_detection_angle", FACE_DETECTION_ANGLE_READ_COMMAND,
+                                 parse_face_detection_angle, refresh)
 
-    def face_inclination_angle_set(self, face_direction, face_inclination):
+    def face_inclination_angle_set(self, face_direction, face_inclination, force=False):
         """
-        Set the face inclination parameter. Note, seems to ignore face_inclination
+        Set the face inclination parameter.
+        Nothing is sent if the device already has it, unless force is True.
         :param face_direction: str of: "front", "diagonal", "profile"
         :param face_inclination: str "15", "45"
         :return:
         """
-        command = '\xfe\x09\x02\x00'
-        if face_direction == "front":
-            command += int_to_hex_le(0)
-        elif face_direction == "diagonal":
-            command += int_to_hex_le(1)
-        elif face_direction == "profile":
-            command += int_to_hex_le(2)
-        else:
-            print "Error: input for face_inclination_angle_set face_direction can only be 'front', 'diagonal, 'profile''"
-            return
-
-        if face_inclination == "15":
-            command += int_to_hex_le(0)
-        elif face_inclination == "45":
-            command += int_to_hex_le(1)
-        else:
-            print "Error input for face_inclination_angle_set face_inclination can only be '15', '45' (as string)"
+        try:
+            change = self._face_detection_angle_change(face_direction, face_inclination)
+        except ValueError as e:
+            self.logger.error("Input for face_inclination_angle_set " + str(e))
             return
 
-        self.send_command_hex(command)
-        self.read_data()
+        self._apply_config([change], force)
 
 
     def test_requests(self, num_of_codes_to_try=50):
         for i in range(num_of_codes_to_try):
-            i_str_hex_enconded = str(hex(i))[2:4]
-            #print "i_str_hex_enconded: " + i_str_hex_enconded
-            if len(i_str_hex_enconded) == 1:
-                i_str_hex_enconded = '0' + i_str_hex_enconded
-            command = 'fe' + i_str_hex_enconded + '0000'
-            print "\n\n~~~~~~~~~~~~~~~~~"
-            print "Command # " + str(i)
-            print "Sending command: '" + command + "'"
-            self.send_command(command)
-            print "Command sent, reading data:"
+            command = build_command(i)
+            print("\n\n~~~~~~~~~~~~~~~~~")
+            print("Command # " + str(i))
+            print("Sending command: '" + command.hex() + "'")
+            self.send_command_hex(command)
+            print("Command sent, reading data:")
             response_code, data = self.read_data()
-            print "~~~~~~~~~~~~~~~~~~~~\n\n"
+            print("~~~~~~~~~~~~~~~~~~~~\n\n")
 
 
 if __name__ == '__main__':
-    sensor = HvcP()
-    print "Getting version:"
-    print sensor.get_version()
-    print "\n\n"
-    #
-    # deg_to_set_camera = 0
-    # print "Setting camera orientation to " + str(deg_to_set_camera) + " deg"
-    # sensor.set_camera_orientation(deg_to_set_camera)
-    # print "Getting camera orientation, degrees are: " + str(sensor.get_camera_orientation())
-    # deg_to_set_camera = 90
-    # print "Setting camera orientation to " + str(deg_to_set_camera) + " deg"
-    # sensor.set_camera_orientation(deg_to_set_camera)
-    # print "Getting camera orientation, degrees are: " + str(sensor.get_camera_orientation())
-    # deg_to_set_camera = 180
-    # print "Setting camera orientation to " + str(deg_to_set_camera) + " deg"
-    # sensor.set_camera_orientation(deg_to_set_camera)
-    # print "Getting camera orientation, degrees are: " + str(sensor.get_camera_orientation())
-    # deg_to_set_camera = 270
-    # print "Setting camera orientation to " + str(deg_to_set_camera) + " deg"
-    # sensor.set_camera_orientation(deg_to_set_camera)
-    # print "Getting camera orientation, degrees are: " + str(sensor.get_camera_orientation())
-    # print "\n\n"
-
-    # print "Setting thresholds: "
-    # sensor.thresholds_set(500, 500, 500)
-    #
-    # print "Reading thresholds settings: " + str(sensor.thresholds_read())
-    # print "\n\n"
-
-    # print "Setting detection size:"
-    # sensor.detection_size_set(30, 8192, 40, 8192, 64, 8192)
-    #
-    # print "Reading detection size settings: " + str(sensor.detection_size_read())
-    # print "\n\n"
-
-    print "Setting face angle:"
-    sensor.face_inclination_angle_set("front", '45')
-
-    print "Reading face angle settings: " + str(sensor.face_detection_angle_read())
-    print "\n\n"
-
-    # print "Detection execution: " + str(sensor.detection_execution())
-    # print "\n\n"
-
-    # print "Testing requests:"
-    # sensor.test_requests()
+    # python hvcp.py capture --help
+    from hvcp_capture import main
+    sys.exit(main())
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+asyncio client for the HVC-P sensor. Same commands as hvcp.HvcP
+but as coroutines, so waiting for the sensor does not block the
+event loop.
+
+It shares the command encoding and response decoding with HvcP
+(hvcp_protocol and hvcp_decoder), only the I/O is different. It works
+on any asyncio StreamReader/StreamWriter pair, e.g. from pyserial-asyncio
+(see AsyncHvcP.open) or from a pty connected to a fake device.
+
+Requires Python 3.5+.
+
+Usage:
+    sensor = await AsyncHvcP.open("/dev/ttyUSB0")
+    print(await sensor.get_version())
+    detections = await sensor.detection_execution(gaze=False)
+"""
+
+import asyncio
+import collections
+import logging
+
+from hvcp_decoder import decode_detection
+from hvcp_framing import SYNC_HEADER, RESPONSE_HEADER_STRUCT, RESPONSE_HEADER_SIZE
+from hvcp_image import MAX_PAYLOAD_SIZE
+from hvcp_protocol import (response_codes_dict, HvcPError, ResponseTimeout, FramingError,
+                           TRANSIENT_ERRORS, response_error, check_response_size,
+                           check_detection_size,
+                           VERSION_COMMAND, parse_version,
+                           camera_orientation_command,
+                           GET_CAMERA_ORIENTATION_COMMAND, parse_camera_orientation,
+                           detection_command,
+                           THRESHOLDS_READ_COMMAND, parse_thresholds, thresholds_set_command,
+                           DETECTION_SIZE_READ_COMMAND, parse_detection_size,
+                           detection_size_set_command,
+                           FACE_DETECTION_ANGLE_READ_COMMAND, parse_face_detection_angle,
+                           face_inclination_angle_set_command)
+
+logger = logging.getLogger("hvcp")
+
+
+class AsyncHvcP(object):
+    def __init__(self, reader, writer, timeout=5, logger=logger,
+                 max_data_len=MAX_PAYLOAD_SIZE, drain_quiet=0.05):
+        """
+        :param reader: asyncio.StreamReader of the serial link
+        :param writer: asyncio.StreamWriter of the serial link
+        :param timeout: float, seconds to wait for a response
+        :param logger: logging.Logger
+        :param max_data_len: int, biggest payload a response can have
+        :param drain_quiet: float, after a failed exchange the input is discarded
+                            until nothing arrives for this many seconds
+        """
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.logger = logger
+        self.max_data_len = max_data_len
+        self.drain_quiet = drain_quiet
+        # One command/response exchange at a time on the link
+        self._lock = asyncio.Lock()
+        # Errors recovered from, see error_stats
+        self.errors = collections.Counter()
+        self.resyncs = 0
+
+    @classmethod
+    async def open(cls, tty="/dev/ttyUSB0", baudrate=921600, timeout=5, logger=logger):
+        """
+        Open the serial port with pyserial-asyncio
+        :return: AsyncHvcP
+        """
+        import serial_asyncio
+        logger.info("Connecting to '" + tty + "' at baudrate " + str(baudrate))
+        reader, writer = await serial_asyncio.open_serial_connection(url=tty, baudrate=baudrate)
+        return cls(reader, writer, timeout=timeout, logger=logger)
+
+    def close(self):
+        self.writer.close()
+
+    def error_stats(self):
+        """
+        :return: dict of the errors recovered from, see hvcp.HvcP.error_stats
+        """
+        stats = dict(self.errors)
+        stats["resyncs"] = self.resyncs
+        return stats
+
+    async def _read_header(self):
+        header = await self.reader.readexactly(RESPONSE_HEADER_SIZE)
+        while True:
+            if header[0] == SYNC_HEADER:
+                sync, response_code, data_len = RESPONSE_HEADER_STRUCT.unpack(header)
+                if data_len <= self.max_data_len:
+                    return response_code, data_len
+            # Out of sync, keep what may be the start of the next header
+            self.resyncs += 1
+            sync_idx = header.find(b'\xfe', 1)
+            if sync_idx == -1:
+                header = b''
+            else:
+                header = header[sync_idx:]
+            header += await self.reader.readexactly(RESPONSE_HEADER_SIZE - len(header))
+
+    async def _read_response(self, command_code):
+        """
+        Read the response of a command, see hvcp.HvcP._read_response
+        :return: bytes, payload
+        :raise HvcPError: FramingError or ResponseError (by response code)
+        """
+        response_code, data_len = await self._read_header()
+        payload = await self.reader.readexactly(data_len)
+        if response_code != 0:
+            self.errors[response_codes_dict.get("%02x" % response_code, "UNKNOWN_CODE")] += 1
+            raise response_error(response_code)
+        try:
+            check_response_size(command_code, data_len)
+        except FramingError:
+            self.errors["bad_lengths"] += 1
+            raise
+        return payload
+
+    async def _drain(self):
+        """
+        Discard the input until it is quiet, e.g. the late response of a
+        command that timed out, so it is not taken for the next one
+        """
+        while True:
+            try:
+                data = await asyncio.wait_for(self.reader.read(MAX_PAYLOAD_SIZE), self.drain_quiet)
+            except asyncio.TimeoutError:
+                return
+            if not data:
+                return
+
+    async def execute(self, command, retries=2, backoff=0.005):
+        """
+        Send a command and wait for its response. On a transient error (timeout,
+        unexpected length, communication error) the input is drained and the
+        command sent again, up to retries times, see hvcp.HvcP.execute
+        :param command: bytes, full datagram
+        :return: bytes, payload of the response
+        :raise HvcPError: ResponseError subclass by response code, ResponseTimeout
+                          or FramingError once the retries are exhausted
+        """
+        command_code = command[1]
+        async with self._lock:
+            for attempt in range(retries + 1):
+                if attempt:
+                    self.errors["retries"] += 1
+                    await asyncio.sleep(backoff * 2 ** (attempt - 1))
+                self.writer.write(command)
+                await self.writer.drain()
+                try:
+                    return await asyncio.wait_for(self._read_response(command_code), self.timeout)
+                except asyncio.TimeoutError:
+                    self.errors["timeouts"] += 1
+                    error = ResponseTimeout("No response received in %s s" % self.timeout)
+                except asyncio.IncompleteReadError:
+                    raise HvcPError("The link was closed")
+                except TRANSIENT_ERRORS as e:
+                    error = e
+                self.logger.warning("Command 0x%02x failed: %s" % (command_code, error))
+                await self._drain()
+            raise error
+
+    async def _read_command(self, command, parser):
+        try:
+            return parser(await self.execute(command))
+        except HvcPError as e:
+            self.logger.error("Command 0x%02x failed: %s" % (command[1], e))
+            return None
+
+    async def _set(self, command):
+        try:
+            await self.execute(command)
+        except HvcPError as e:
+            self.logger.error("Command 0x%02x failed: %s" % (command[1], e))
+
+    async def get_version(self):
+        return await self._read_command(VERSION_COMMAND, parse_version)
+
+    async def set_camera_orientation(self, angle):
+        await self._set(camera_orientation_command(angle))
+
+    async def get_camera_orientation(self):
+        return await self._read_command(GET_CAMERA_ORIENTATION_COMMAND, parse_camera_orientation)
+
+    async def detection_execution(self, eyes_closed=True, gaze=True,
+                                  gender=True, age=True, face_orientation=True,
+                                  face_detection=True, hand_detection=True,
+                                  human_body_detection=True,
+                                  facial_expression=True,
+                                  image_bit=False,
+                                  image_bit_small=False):
+        """
+        See hvcp.HvcP.detection_execution
+        """
+        command, bitmask_1, bitmask_2, bitmask_3 = detection_command(
+            eyes_closed, gaze, gender, age, face_orientation, face_detection,
+            hand_detection, human_body_detection, facial_expression,
+            image_bit, image_bit_small)
+        return await self._read_command(
+            command, lambda data: self._decode_detection(data, bitmask_1, bitmask_2, bitmask_3))
+
+    def _decode_detection(self, data, bitmask_1, bitmask_2, bitmask_3):
+        try:
+            check_detection_size(data, bitmask_1, bitmask_2, bitmask_3)
+        except FramingError:
+            self.errors["bad_lengths"] += 1
+            raise
+        return decode_detection(data, bitmask_1, bitmask_2, bitmask_3)
+
+    async def thresholds_read(self):
+        return await self._read_command(THRESHOLDS_READ_COMMAND, parse_thresholds)
+
+    async def thresholds_set(self, human_body, hand, face):
+        await self._set(thresholds_set_command(human_body, hand, face))
+
+    async def detection_size_read(self):
+        return await self._read_command(DETECTION_SIZE_READ_COMMAND, parse_detection_size)
+
+    async def detection_size_set(self, human_body_min, human_body_max,
+                                 hand_min, hand_max, face_min, face_max):
+        await self._set(detection_size_set_command(human_body_min, human_body_max,
+                                                   hand_min, hand_max,
+                                                   face_min, face_max))
+
+    async def face_detection_angle_read(self):
+        return await self._read_command(FACE_DETECTION_ANGLE_READ_COMMAND, parse_face_detection_angle)
+
+    async def face_inclination_angle_set(self, face_direction, face_inclination):
+        """
+        :raise ValueError: on invalid face_direction or face_inclination
+        """
+        await self._set(face_inclination_angle_set_command(face_direction, face_inclination))
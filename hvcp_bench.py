@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of the hvcp hot paths, with no hardware: everything runs on
+synthetic payloads from hvcp_sim.
+
+  framing      HvcP.read_data on back to back detection responses
+  decode       decode_detection over the feature flags and detection counts
+  image        image payloads at both sizes, copied and read into an ImageRing
+  encode       command encoding (detection bitmasks and setters)
+  stream       end to end frame rate of HvcP.stream against the simulator
+
+Usage:
+    python hvcp_bench.py --output bench.json
+    python hvcp_bench.py --full --output bench.json --compare previous.json
+"""
+
+import argparse
+import io
+import itertools
+import json
+import platform
+import sys
+import time
+import timeit
+
+from hvcp import HvcP
+from hvcp_decoder import decode_detection
+from hvcp_image import ImageRing
+from hvcp_protocol import (detection_command, thresholds_set_command,
+                           detection_size_set_command, camera_orientation_command)
+from hvcp_sim import HvcPSimulator, SimulatedSerial
+
+FLAG_NAMES = ("eyes_closed", "gaze", "gender", "age", "face_orientation",
+              "face_detection", "hand_detection", "human_body_detection",
+              "facial_expression")
+ALL_FLAGS = dict((name, True) for name in FLAG_NAMES)
+
+
+class BufferSerial(io.BytesIO):
+    """
+    Transport that serves prerecorded responses, to time the reads alone
+    """
+    def write(self, data):
+        return len(data)
+
+    def isOpen(self):
+        return True
+
+
+def measure(func, number, repeat=3):
+    """
+    :return: dict with the time per call of the best and the mean repetition
+    """
+    times = [timeit.timeit(func, number=number) / number for _ in range(repeat)]
+    return {"iterations": number * repeat,
+            "min_us": min(times) * 1e6,
+            "mean_us": sum(times) / len(times) * 1e6,
+            "ops_per_s": 1.0 / min(times)}
+
+
+def flag_combinations(full):
+    """
+    :param full: bool, every combination of the 9 feature flags (512) or a representative subset
+    :return: list of (name, flags dict)
+    """
+    if full:
+        combinations = itertools.product((False, True), repeat=len(FLAG_NAMES))
+        return [("".join(str(int(enabled)) for enabled in combination),
+                 dict(zip(FLAG_NAMES, combination)))
+                for combination in combinations]
+    detection_only = dict(ALL_FLAGS, eyes_closed=False, gaze=False, gender=False, age=False,
+                          face_orientation=False, facial_expression=False)
+    return [("all", ALL_FLAGS),
+            ("detection_only", detection_only),
+            ("faces_only", dict(ALL_FLAGS, hand_detection=False, human_body_detection=False))]
+
+
+def detection_response(simulator, **flags):
+    command, bitmask_1, bitmask_2, bitmask_3 = detection_command(**flags)
+    return simulator.respond(command), (bitmask_1, bitmask_2, bitmask_3)
+
+
+def bench_framing(results, number):
+    for count in (0, 35):
+        simulator = HvcPSimulator(bodies=count, hands=count, faces=count)
+        response, bitmasks = detection_response(simulator, **ALL_FLAGS)
+        serial = BufferSerial(response * number)
+        sensor = HvcP(ser=serial)
+
+        def read():
+            sensor.read_data(copy=False)
+        results["framing/read_data/%d" % count] = measure(read, number, repeat=1)
+
+
+def bench_decode(results, number, full):
+    for name, flags in flag_combinations(full):
+        for count in (0, 1, 10, 35):
+            simulator = HvcPSimulator(bodies=count, hands=count, faces=count)
+            response, bitmasks = detection_response(simulator, **flags)
+            payload = response[6:]
+            results["decode/%s/%d" % (name, count)] = measure(
+                lambda: decode_detection(payload, *bitmasks), number)
+
+
+def bench_image(results, number):
+    for size_name, image_flag in (("big", "image_bit"), ("small", "image_bit_small")):
+        simulator = HvcPSimulator(bodies=1, hands=1, faces=1)
+        flags = dict(ALL_FLAGS)
+        flags[image_flag] = True
+        response, bitmasks = detection_response(simulator, **flags)
+
+        serial = BufferSerial(response * number)
+        sensor = HvcP(ser=serial)
+        results["image/%s/copy" % size_name] = measure(
+            lambda: sensor.detection_execution(show_image=False, **flags), number, repeat=1)
+
+        ring = ImageRing(slots=2)
+        serial = BufferSerial(response * number)
+        sensor = HvcP(ser=serial)
+
+        def read_into_ring():
+            detections = sensor.detection_execution(show_image=False, image_ring=ring, **flags)
+            detections["image"]["slot"].release()
+        results["image/%s/ring" % size_name] = measure(read_into_ring, number, repeat=1)
+
+
+def bench_encode(results, number):
+    results["encode/detection_command"] = measure(
+        lambda: detection_command(**ALL_FLAGS), number)
+    results["encode/camera_orientation"] = measure(
+        lambda: camera_orientation_command(90), number)
+    results["encode/thresholds_set"] = measure(
+        lambda: thresholds_set_command(500, 500, 500), number)
+    results["encode/detection_size_set"] = measure(
+        lambda: detection_size_set_command(30, 8192, 40, 8192, 64, 8192), number)
+
+
+def bench_stream(results, frames):
+    for count in (1, 35):
+        for baudrate in (None, 921600):
+            simulator = HvcPSimulator(bodies=count, hands=count, faces=count)
+            sensor = HvcP(ser=SimulatedSerial(simulator, baudrate=baudrate))
+            start = time.time()
+            for frame in sensor.stream(frames=frames, **ALL_FLAGS):
+                pass
+            elapsed = time.time() - start
+            results["stream/%d/%s" % (count, baudrate or "unlimited")] = {
+                "iterations": frames,
+                "min_us": elapsed / frames * 1e6,
+                "mean_us": elapsed / frames * 1e6,
+                "ops_per_s": frames / elapsed}
+
+
+def compare(results, previous):
+    """
+    Print the change of every benchmark against a previous run
+    """
+    for name in sorted(results):
+        if name not in previous["results"]:
+            continue
+        before = previous["results"][name]["min_us"]
+        after = results[name]["min_us"]
+        change = (after - before) / before * 100 if before else 0.0
+        flag = "  REGRESSION" if change > 10 else ""
+        print("%-40s %10.2f us -> %10.2f us  %+6.1f%%%s" % (name, before, after, change, flag))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the hvcp hot paths without hardware")
+    parser.add_argument("--output", help="JSON file to store the results")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare with")
+    parser.add_argument("--full", action="store_true",
+                        help="decode every combination of the 9 feature flags")
+    parser.add_argument("--number", type=int, default=1000,
+                        help="iterations per measurement")
+    parser.add_argument("--frames", type=int, default=200,
+                        help="frames per end to end stream measurement")
+    parser.add_argument("--only", help="run only the benchmarks starting with this prefix")
+    args = parser.parse_args(argv)
+
+    benchmarks = (("framing", lambda results: bench_framing(results, args.number)),
+                  ("decode", lambda results: bench_decode(results, args.number, args.full)),
+                  ("image", lambda results: bench_image(results, max(args.number // 10, 1))),
+                  ("encode", lambda results: bench_encode(results, args.number)),
+                  ("stream", lambda results: bench_stream(results, args.frames)))
+    results = {}
+    for name, run in benchmarks:
+        if args.only and not name.startswith(args.only):
+            continue
+        run(results)
+
+    for name in sorted(results):
+        print("%-40s %10.2f us %12.0f ops/s" % (name, results[name]["min_us"],
+                                                 results[name]["ops_per_s"]))
+
+    report = {"python": sys.version.split()[0],
+              "platform": platform.platform(),
+              "timestamp": time.time(),
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+
+
+if __name__ == '__main__':
+    main()
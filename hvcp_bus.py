@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""
+Shared memory frame bus: one process owns the HvcP and publishes every
+frame, any number of processes map the frames with no copy nor pickling.
+
+The bus is a multiprocessing.shared_memory block:
+  header: magic ("HVCPBUS1"), number of slots, slot size, latest sequence
+  slots: a ring of fixed layout records (SLOT_DTYPE): sequence, frame,
+         timestamp, the detection counts, up to 35 bodies, hands and faces
+         (every face field as int16, MISSING when not requested, gender and
+         expression as their hvcp_store codes) and the 320x240 image.
+Frame n (sequences start at 1) goes to slot (n - 1) % slots. Every slot is a
+seqlock: its sequence field is 2n - 1 while frame n is being written and 2n
+once it is complete, so a reader can tell a torn or overwritten record.
+
+Usage:
+    # publisher
+    bus = FramePublisher(name="hvcp", slots=8)
+    for frame in sensor.stream(image_bit=True):
+        bus.publish(frame)
+
+    # any other process
+    subscriber = FrameSubscriber("hvcp")
+    for view in subscriber.frames():
+        faces = view.record["face"][:view.record["face_n"]]  # numpy views, read-only
+        gray = view.image()
+        if view.valid():  # not overwritten while it was used
+            ...
+"""
+
+import struct
+import time
+
+import numpy as np
+from multiprocessing import shared_memory
+
+from hvcp_image import BIG_IMAGE_SIZE
+from hvcp_store import MISSING, FACE_ESTIMATION_COLUMNS, face_estimation_values
+
+MAGIC = b"HVCPBUS1"
+BUS_HEADER_STRUCT = struct.Struct("<8sII")
+MAX_DETECTIONS = 35
+
+RESULT_FIELDS = ("coord_x", "coord_y", "detect_size", "reliability")
+FACE_FIELDS = RESULT_FIELDS + tuple(name for name, typecode, key, field in FACE_ESTIMATION_COLUMNS)
+RESULT_DTYPE = np.dtype([(name, "<i2") for name in RESULT_FIELDS])
+FACE_DTYPE = np.dtype([(name, "<i2") for name in FACE_FIELDS])
+SLOT_DTYPE = np.dtype([("sequence", "<u8"),
+                       ("frame", "<u8"),
+                       ("timestamp", "<f8"),
+                       ("body_n", "u1"),
+                       ("hand_n", "u1"),
+                       ("face_n", "u1"),
+                       ("image_width", "<u2"),
+                       ("image_height", "<u2"),
+                       ("body", RESULT_DTYPE, (MAX_DETECTIONS,)),
+                       ("hand", RESULT_DTYPE, (MAX_DETECTIONS,)),
+                       ("face", FACE_DTYPE, (MAX_DETECTIONS,)),
+                       ("image", "u1", (BIG_IMAGE_SIZE,))], align=True)
+# magic, slots, slot size, then the latest sequence, 8 bytes aligned
+HEADER_SIZE = 24
+LATEST_OFFSET = 16
+
+
+def face_values(face):
+    """
+    :param face: face dict as returned by HvcP.detection_execution
+    :return: tuple of the FACE_FIELDS values
+    """
+    return (tuple(face[name] for name in RESULT_FIELDS) +
+            face_estimation_values(face, MISSING['h']))
+
+
+def attach(name):
+    """
+    Open an existing shared memory block without taking ownership of it
+    :return: shared_memory.SharedMemory
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # Before python 3.13 attaching registers the block to the resource tracker,
+    # which destroys it when this process exits (unregistering afterwards is
+    # not enough: processes started by multiprocessing share the tracker of
+    # the publisher)
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class FramePublisher(object):
+    def __init__(self, name=None, slots=8):
+        """
+        :param name: str, name of the shared memory block (None = random, see self.name)
+        :param slots: int, frames kept in the ring, a subscriber that falls
+                      further behind misses frames
+        """
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                              size=HEADER_SIZE + slots * SLOT_DTYPE.itemsize)
+        self.name = self.shm.name
+        BUS_HEADER_STRUCT.pack_into(self.shm.buf, 0, MAGIC, slots, SLOT_DTYPE.itemsize)
+        self._latest = np.ndarray((), dtype="<u8", buffer=self.shm.buf, offset=LATEST_OFFSET)
+        self._latest[()] = 0
+        self._slots = np.ndarray((slots,), dtype=SLOT_DTYPE, buffer=self.shm.buf, offset=HEADER_SIZE)
+        self.sequence = 0
+
+    def publish(self, frame):
+        """
+        :param frame: dict as yielded by HvcP.stream (frame, timestamp, detections)
+        :return: int, sequence of the frame in the bus
+        """
+        detections = frame["detections"]
+        self.sequence += 1
+        sequence = self.sequence
+        record = self._slots[(sequence - 1) % self.slots]
+        record["sequence"] = 2 * sequence - 1
+        record["frame"] = frame.get("frame", sequence - 1)
+        record["timestamp"] = frame.get("timestamp", time.time())
+        for category in ("body", "hand"):
+            results = detections.get(category, ())[:MAX_DETECTIONS]
+            record[category + "_n"] = len(results)
+            if results:
+                record[category][:len(results)] = [tuple(result[name] for name in RESULT_FIELDS)
+                                                   for result in results]
+        faces = detections.get("face", ())[:MAX_DETECTIONS]
+        record["face_n"] = len(faces)
+        if faces:
+            record["face"][:len(faces)] = [face_values(face) for face in faces]
+        image = detections.get("image")
+        if image is None:
+            record["image_width"] = record["image_height"] = 0
+        else:
+            size = image["width"] * image["height"]
+            data = image["slot"].data if "slot" in image else image["data"]
+            record["image"][:size] = np.frombuffer(data, dtype=np.uint8, count=size)
+            record["image_width"] = image["width"]
+            record["image_height"] = image["height"]
+        record["sequence"] = 2 * sequence
+        self._latest[()] = sequence
+        return sequence
+
+    def close(self, unlink=True):
+        """
+        :param unlink: bool, also destroy the shared memory block
+        """
+        del self._latest, self._slots
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class FrameView(object):
+    """
+    A frame of the bus, read in place: record and image are read-only
+    numpy views of the shared memory, valid() tells if the publisher
+    overwrote them since they were obtained.
+    """
+    __slots__ = ("sequence", "record")
+
+    def __init__(self, sequence, record):
+        self.sequence = sequence
+        self.record = record
+
+    def valid(self):
+        return int(self.record["sequence"]) == 2 * self.sequence
+
+    def image(self):
+        """
+        :return: numpy (height, width) uint8 view of the image, None if there is none
+        """
+        width = int(self.record["image_width"])
+        height = int(self.record["image_height"])
+        if not width:
+            return None
+        return self.record["image"][:width * height].reshape(height, width)
+
+    def detections(self):
+        """
+        :return: copy of the frame as a dict of numpy arrays per category,
+                 plus 'image' (a copy too) if there is one
+        """
+        record = self.record
+        detections = dict((category, record[category][:int(record[category + "_n"])].copy())
+                          for category in ("body", "hand", "face"))
+        image = self.image()
+        if image is not None:
+            detections["image"] = image.copy()
+        return detections
+
+
+class FrameSubscriber(object):
+    def __init__(self, name):
+        """
+        :param name: str, name of the shared memory block of the FramePublisher
+        """
+        self.shm = attach(name)
+        magic, self.slots, slot_size = BUS_HEADER_STRUCT.unpack_from(self.shm.buf, 0)
+        if magic != MAGIC or slot_size != SLOT_DTYPE.itemsize:
+            self.shm.close()
+            raise ValueError(name + " is not a hvcp frame bus of this version")
+        self._latest = np.ndarray((), dtype="<u8", buffer=self.shm.buf, offset=LATEST_OFFSET)
+        self._slots = np.ndarray((self.slots,), dtype=SLOT_DTYPE, buffer=self.shm.buf,
+                                 offset=HEADER_SIZE)
+        self._latest.flags.writeable = False
+        self._slots.flags.writeable = False
+        self.missed = 0
+
+    def latest_sequence(self):
+        """
+        :return: int, sequence of the latest complete frame (0 = none yet)
+        """
+        return int(self._latest)
+
+    def read(self, sequence=None):
+        """
+        :param sequence: int, frame to read (None = the latest)
+        :return: FrameView, None if that frame is not (or no longer) in the ring
+        """
+        if sequence is None:
+            sequence = self.latest_sequence()
+        if sequence < 1:
+            return None
+        record = self._slots[(sequence - 1) % self.slots]
+        view = FrameView(sequence, record)
+        if not view.valid():
+            return None
+        return view
+
+    def frames(self, start=None, poll_interval=0.001, timeout=None):
+        """
+        Follow the frames as they are published. When falling more than
+        the ring size behind, skip to the oldest frame still available,
+        counting the frames lost in self.missed.
+        :param start: int, first sequence (None = the next frame published)
+        :param timeout: float, stop after this many seconds without a new frame
+        :return: generator of FrameView
+        """
+        sequence = self.latest_sequence() + 1 if start is None else start
+        last_frame_time = time.time()
+        while True:
+            latest = self.latest_sequence()
+            if sequence > latest:
+                if timeout is not None and time.time() - last_frame_time > timeout:
+                    return
+                time.sleep(poll_interval)
+                continue
+            oldest = max(latest - self.slots + 1, 1)
+            if sequence < oldest:
+                self.missed += oldest - sequence
+                sequence = oldest
+            view = self.read(sequence)
+            if view is None:
+                # Overwritten before it could be read
+                self.missed += 1
+            else:
+                last_frame_time = time.time()
+                yield view
+            sequence += 1
+
+    def close(self):
+        """
+        Unmap the bus, every FrameView (and array taken from it) must be dropped before
+        """
+        del self._latest, self._slots
+        self.shm.close()
@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+
+"""
+Capture daemon: apply a configuration profile, then run the detection
+continuously (HvcP.stream, one command always in flight) and write every
+frame to an output:
+  ndjson    one JSON object per line, to a file or stdout ("-")
+  columnar  binary columnar file: chunks of hvcp_store.DetectionStore columns
+  socket    NDJSON lines to every client of a UNIX socket served at the path
+Frames are encoded as they come but written in bulk, once buffer_size bytes
+(columnar: chunk_frames frames) are pending or every flush_interval seconds.
+
+SIGTERM and SIGINT stop the capture after the current frame: the response
+in flight is consumed, the buffers flushed and the stats printed to stderr
+as JSON. numpy and cv2 are only imported when images are saved.
+
+Usage:
+    python hvcp.py capture --profile profile.json --output ndjson --path frames.ndjson
+    python hvcp.py capture --output columnar --path frames.hvcpcol --features face_detection,age
+    python hvcp.py capture --output socket --path /tmp/hvcp.sock --images images --encoding jpeg
+    python hvcp.py capture --simulate --frames 100 --output ndjson --path -
+
+The profile is a JSON file of HvcP.apply_profile settings, the --orientation,
+--thresholds, --detection-size and --face-angle options override its entries.
+"""
+
+import argparse
+import array
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+
+from hvcp import HvcP
+from hvcp_image import ImageRing
+from hvcp_protocol import ALL_FEATURES, Feature, HvcPError
+from hvcp_store import CATEGORIES, DetectionStore
+
+OUTPUTS = ("ndjson", "columnar", "socket")
+
+COLUMNAR_MAGIC = b"HVCPCOL1"
+# frames, columns
+CHUNK_STRUCT = struct.Struct("<II")
+# name length, typecode, data length
+COLUMN_STRUCT = struct.Struct("<HcQ")
+
+logger = logging.getLogger(__name__)
+
+
+def frame_record(frame):
+    """
+    :param frame: dict as yielded by HvcP.stream
+    :return: dict that can be serialized to JSON (the image is only described)
+    """
+    detections = frame["detections"]
+    record = {"frame": frame["frame"], "timestamp": frame["timestamp"]}
+    for category in CATEGORIES:
+        record[category] = detections.get(category, [])
+    image = detections.get("image")
+    if image is not None:
+        record["image"] = {"width": image["width"], "height": image["height"]}
+    return record
+
+
+class BulkWriter(object):
+    """
+    Base of the outputs: keeps the encoded frames and hands them to
+    _write in bulk
+    """
+    def __init__(self, buffer_size=1 << 16, flush_interval=1.0):
+        """
+        :param buffer_size: int, bytes pending before a write
+        :param flush_interval: float, max seconds a frame stays pending
+        """
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._chunks = []
+        self._pending = 0
+        self._last_flush = time.time()
+        self.frames = 0
+        self.bytes_written = 0
+        self.flushes = 0
+
+    def encode(self, frame):
+        """
+        :return: bytes of the frame in the output
+        """
+        return (json.dumps(frame_record(frame), separators=(",", ":")) + "\n").encode("utf-8")
+
+    def write(self, frame):
+        data = self.encode(frame)
+        self._chunks.append(data)
+        self._pending += len(data)
+        self.frames += 1
+        if (self._pending >= self.buffer_size or
+                time.time() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        if not self._chunks:
+            return
+        data = b"".join(self._chunks)
+        self._chunks = []
+        self._pending = 0
+        self._write(data)
+        self.bytes_written += len(data)
+        self.flushes += 1
+
+    def _write(self, data):
+        raise NotImplementedError
+
+    def stats(self):
+        return {"frames": self.frames, "bytes": self.bytes_written, "flushes": self.flushes}
+
+    def close(self):
+        self.flush()
+
+
+class NdjsonWriter(BulkWriter):
+    def __init__(self, path="-", **kwargs):
+        """
+        :param path: str, file to append to, "-" = stdout
+        """
+        BulkWriter.__init__(self, **kwargs)
+        if path == "-":
+            self._file = sys.stdout.buffer
+            self._close_file = False
+        else:
+            self._file = open(path, "ab", buffering=0)
+            self._close_file = True
+
+    def _write(self, data):
+        self._file.write(data)
+        self._file.flush()
+
+    def close(self):
+        BulkWriter.close(self)
+        if self._close_file:
+            self._file.close()
+
+
+class SocketWriter(BulkWriter):
+    """
+    Serve the NDJSON lines on a UNIX stream socket: clients can connect at any
+    time and get the frames from then on, a client that cannot keep up
+    (send blocked for send_timeout) is disconnected
+    """
+    def __init__(self, path, send_timeout=0.5, **kwargs):
+        BulkWriter.__init__(self, **kwargs)
+        self.path = path
+        self.send_timeout = send_timeout
+        if os.path.exists(path):
+            os.remove(path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(8)
+        self._server.setblocking(False)
+        self._clients = []
+        self.disconnected = 0
+
+    def _accept(self):
+        while True:
+            try:
+                client, address = self._server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            client.settimeout(self.send_timeout)
+            self._clients.append(client)
+
+    def _write(self, data):
+        self._accept()
+        for client in list(self._clients):
+            try:
+                client.sendall(data)
+            except (OSError, socket.timeout):
+                self._clients.remove(client)
+                client.close()
+                self.disconnected += 1
+
+    def stats(self):
+        stats = BulkWriter.stats(self)
+        stats["clients"] = len(self._clients)
+        stats["disconnected"] = self.disconnected
+        return stats
+
+    def close(self):
+        BulkWriter.close(self)
+        for client in self._clients:
+            client.close()
+        self._server.close()
+        os.remove(self.path)
+
+
+class ColumnarWriter(BulkWriter):
+    """
+    Binary columnar file:
+      magic ("HVCPCOL1"), byte order (1 byte, 0 little / 1 big endian)
+      chunks: frames (4 bytes), columns (4 bytes), then for every column its
+              name length (2 bytes), typecode (1 byte), data length (8 bytes),
+              name and data (the array.array bytes)
+    The columns of a chunk are "timestamp", "<category>.offsets" (rows of frame
+    n: offsets[n]:offsets[n + 1]) and "<category>.<column>" as in DetectionStore,
+    see read_columnar.
+    """
+    def __init__(self, path, chunk_frames=1000, **kwargs):
+        """
+        :param chunk_frames: int, frames per chunk
+        """
+        BulkWriter.__init__(self, **kwargs)
+        self.chunk_frames = chunk_frames
+        self._store = DetectionStore()
+        new_file = not os.path.exists(path) or not os.path.getsize(path)
+        self._file = open(path, "ab")
+        if new_file:
+            self._file.write(COLUMNAR_MAGIC + struct.pack("<B", sys.byteorder == "big"))
+
+    def write(self, frame):
+        self._store.append(frame["detections"], frame["timestamp"])
+        self.frames += 1
+        if (len(self._store) >= self.chunk_frames or
+                time.time() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        store = self._store
+        if not len(store):
+            return
+        columns = [("timestamp", store.timestamps)]
+        for category in CATEGORIES:
+            columns.append((category + ".offsets", store.offsets[category]))
+            columns.extend((category + "." + name, column)
+                           for name, column in sorted(store.columns[category].items()))
+        parts = [CHUNK_STRUCT.pack(len(store), len(columns))]
+        for name, column in columns:
+            name = name.encode("ascii")
+            data = column.tobytes()
+            parts.append(COLUMN_STRUCT.pack(len(name), column.typecode.encode("ascii"), len(data)))
+            parts.append(name)
+            parts.append(data)
+        data = b"".join(parts)
+        self._store = DetectionStore()
+        self._file.write(data)
+        self._file.flush()
+        self.bytes_written += len(data)
+        self.flushes += 1
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+def read_columnar(path):
+    """
+    :return: generator of one dict of column name: array.array per chunk
+    """
+    with open(path, "rb") as columnar_file:
+        data = columnar_file.read()
+    if data[:len(COLUMNAR_MAGIC)] != COLUMNAR_MAGIC:
+        raise ValueError(path + " is not a hvcp columnar file")
+    swap = bool(data[len(COLUMNAR_MAGIC)]) != (sys.byteorder == "big")
+    offset = len(COLUMNAR_MAGIC) + 1
+    while offset < len(data):
+        frames, column_count = CHUNK_STRUCT.unpack_from(data, offset)
+        offset += CHUNK_STRUCT.size
+        chunk = {}
+        for _ in range(column_count):
+            name_len, typecode, data_len = COLUMN_STRUCT.unpack_from(data, offset)
+            offset += COLUMN_STRUCT.size
+            name = data[offset:offset + name_len].decode("ascii")
+            offset += name_len
+            column = array.array(typecode.decode("ascii"))
+            column.frombytes(data[offset:offset + data_len])
+            offset += data_len
+            if swap:
+                column.byteswap()
+            chunk[name] = column
+        yield chunk
+
+
+def parse_features(names):
+    """
+    :param names: str, comma separated Feature names (any case) or "all"
+    :return: Feature
+    """
+    features = Feature(0)
+    for name in names.split(","):
+        name = name.strip().upper()
+        if name == "ALL":
+            features |= ALL_FEATURES
+        elif name:
+            try:
+                features |= Feature[name]
+            except KeyError:
+                raise argparse.ArgumentTypeError("unknown feature " + name.lower())
+    return features
+
+
+def build_profile(args):
+    """
+    :return: dict of HvcP.apply_profile settings from --profile and the options
+    """
+    profile = {}
+    if args.profile:
+        with open(args.profile) as profile_file:
+            profile = json.load(profile_file)
+    if args.orientation is not None:
+        profile["camera_orientation"] = args.orientation
+    if args.thresholds:
+        profile["thresholds"] = dict(zip(("human_body", "hand", "face"), args.thresholds))
+    if args.detection_size:
+        profile["detection_size"] = dict(zip(("human_body_min", "human_body_max",
+                                              "hand_min", "hand_max",
+                                              "face_min", "face_max"), args.detection_size))
+    if args.face_angle:
+        profile["face_detection_angle"] = dict(zip(("face_direction", "face_inclination"),
+                                                   args.face_angle))
+    return profile
+
+
+def open_writer(args):
+    options = dict(flush_interval=args.flush_interval)
+    if args.output == "ndjson":
+        return NdjsonWriter(args.path, buffer_size=args.buffer_size, **options)
+    if args.output == "socket":
+        return SocketWriter(args.path, buffer_size=args.buffer_size, **options)
+    return ColumnarWriter(args.path, chunk_frames=args.chunk_frames, **options)
+
+
+def open_sensor(args):
+    if args.simulate:
+        from hvcp_sim import HvcPSimulator, SimulatedSerial
+        simulator = HvcPSimulator(faces=args.simulate, bodies=args.simulate,
+                                  hands=args.simulate, latency=0.05)
+        return HvcP(ser=SimulatedSerial(simulator))
+    if args.auto_baud:
+        from hvcp_link import connect
+        return connect(args.tty)
+    return HvcP(tty=args.tty, baudrate=args.baudrate)
+
+
+def capture(args):
+    """
+    :return: dict of the capture stats
+    """
+    features = args.features
+    if args.images:
+        features |= Feature.IMAGE_BIG if args.image_size == "big" else Feature.IMAGE_SMALL
+    writer = open_writer(args)
+    sensor = open_sensor(args)
+    profile = build_profile(args)
+    if profile:
+        logger.info("Applied settings: %s" % sensor.apply_profile(profile))
+    if args.metrics:
+        sensor.enable_metrics()
+
+    sink = None
+    image_ring = None
+    if args.images:
+        # Only now: the sink imports numpy and cv2 to encode
+        from hvcp_sink import ImageSink, RotatingFileWriter
+        sink = ImageSink(RotatingFileWriter(args.images, max_files=args.max_images),
+                         encoding=args.encoding, max_pending=args.max_pending)
+        # Queued images, the ones being encoded (2 workers) and the one being read
+        image_ring = ImageRing(slots=args.max_pending + 3)
+
+    stop = []
+
+    def request_stop(signum, stack_frame):
+        stop.append(signum)
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    start_time = time.time()
+    last = {}
+    frames = sensor.stream(frames=args.frames, features=features,
+                           image_ring=image_ring, image_sink=sink)
+    try:
+        for frame in frames:
+            writer.write(frame)
+            last = frame
+            if stop:
+                break
+    finally:
+        frames.close()
+        writer.close()
+        if sink is not None:
+            sink.close()
+
+    elapsed = time.time() - start_time
+    stats = {"frames": writer.frames,
+             "errors": last.get("errors", 0),
+             "elapsed_s": elapsed,
+             "fps": writer.frames / elapsed if elapsed else 0.0,
+             "output": writer.stats(),
+             "link": sensor.error_stats()}
+    if stop:
+        stats["signal"] = signal.Signals(stop[0]).name
+    if sink is not None:
+        stats["images"] = sink.stats()
+    if args.metrics:
+        stats["metrics"] = sensor.metrics.snapshot()
+    return stats
+
+
+def add_capture_arguments(parser):
+    parser.add_argument("--tty", default="/dev/ttyUSB0")
+    parser.add_argument("--baudrate", type=int, default=921600)
+    parser.add_argument("--auto-baud", action="store_true",
+                        help="use the fastest stable baud rate (probed once, see hvcp_link)")
+    parser.add_argument("--simulate", type=int, metavar="DETECTIONS",
+                        help="no sensor: simulate this many bodies, hands and faces per frame")
+    parser.add_argument("--profile", help="JSON file of HvcP.apply_profile settings")
+    parser.add_argument("--orientation", type=int, choices=(0, 90, 180, 270))
+    parser.add_argument("--thresholds", type=int, nargs=3, metavar=("BODY", "HAND", "FACE"))
+    parser.add_argument("--detection-size", type=int, nargs=6,
+                        metavar=("BODY_MIN", "BODY_MAX", "HAND_MIN", "HAND_MAX",
+                                 "FACE_MIN", "FACE_MAX"))
+    parser.add_argument("--face-angle", nargs=2, metavar=("DIRECTION", "INCLINATION"),
+                        help="e.g. front 15 (directions: front, diagonal, profile; "
+                             "inclinations: 15, 45)")
+    parser.add_argument("--features", type=parse_features, default=ALL_FEATURES,
+                        help="comma separated detection features, e.g. "
+                             "face_detection,age,gender (default: all)")
+    parser.add_argument("--frames", type=int, help="stop after this many frames")
+    parser.add_argument("--output", choices=OUTPUTS, default="ndjson")
+    parser.add_argument("--path", default="-",
+                        help="file (ndjson: - = stdout) or socket path of the output")
+    parser.add_argument("--buffer-size", type=int, default=1 << 16,
+                        help="bytes pending before a write (ndjson, socket)")
+    parser.add_argument("--chunk-frames", type=int, default=1000,
+                        help="frames per chunk (columnar)")
+    parser.add_argument("--flush-interval", type=float, default=1.0,
+                        help="max seconds a frame stays pending")
+    parser.add_argument("--images", metavar="DIRECTORY", help="also save the images there")
+    parser.add_argument("--image-size", choices=("big", "small"), default="small")
+    parser.add_argument("--encoding", choices=("jpeg", "png", "raw"), default="jpeg")
+    parser.add_argument("--max-images", type=int, default=1000,
+                        help="images kept in the directory")
+    parser.add_argument("--max-pending", type=int, default=8,
+                        help="images waiting to be encoded before dropping the oldest")
+    parser.add_argument("--metrics", action="store_true",
+                        help="add the latency of every stage to the stats")
+    parser.add_argument("--verbose", action="store_true")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="hvcp", description="OMRON HVC-P sensor")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    add_capture_arguments(commands.add_parser(
+        "capture", help="run the detection continuously and write the frames to an output"))
+    version_parser = commands.add_parser("version", help="print the version of the sensor")
+    version_parser.add_argument("--tty", default="/dev/ttyUSB0")
+    version_parser.add_argument("--baudrate", type=int, default=921600)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if getattr(args, "verbose", False) else logging.INFO,
+                        format="%(message)s", stream=sys.stderr)
+    if args.command == "version":
+        print(HvcP(tty=args.tty, baudrate=args.baudrate).get_version())
+        return 0
+    try:
+        stats = capture(args)
+    except HvcPError as e:
+        logger.error("Capture failed: " + str(e))
+        return 1
+    sys.stderr.write(json.dumps(stats, indent=2, sort_keys=True) + "\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
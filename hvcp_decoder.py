@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+
+"""
+Decoder for the payload of the HVC-P detection execution
+command (0x03).
+
+The payload is:
+  header (4 bytes): human_body_n, hand_n, face_n, reserved
+  human_body_n x 8 bytes (coord_x, coord_y, detect_size, reliability)
+  hand_n x 8 bytes (same layout as the bodies)
+  face_n x 2~31 bytes, depending on the enabled face estimators
+  [image: width (2 bytes), height (2 bytes), width * height bytes]
+
+Every record layout only depends on the three bitmasks sent with the
+command, so the struct.Struct for each combination is built once and
+then the records are unpacked in place with iter_unpack over a memoryview
+of the payload, without copying it.
+"""
+
+import struct
+
+# bitmask_1
+HUMAN_BODY_DETECTION = 0x01
+HAND_DETECTION = 0x02
+FACE_DETECTION = 0x04
+FACE_ORIENTATION = 0x08
+AGE = 0x10
+GENDER = 0x20
+GAZE = 0x40
+EYES_CLOSED = 0x80
+# bitmask_2
+FACIAL_EXPRESSION = 0x01
+# bitmask_3
+IMAGE_BIG = 0x01
+IMAGE_SMALL = 0x02
+
+HEADER_STRUCT = struct.Struct("<BBBx")
+RESULT_STRUCT = struct.Struct("<hhhh")
+IMAGE_HEADER_STRUCT = struct.Struct("<hh")
+
+# The detection coordinates are in the camera frame, not in the image
+SENSOR_WIDTH = 1600
+SENSOR_HEIGHT = 1200
+
+GENDERS = {0: "woman", 1: "man"}
+# 1 = expressionless, 2 = joy, 3 = surprise, 4 = anger, 5 = sadness
+EXPRESSIONS = {1: "expressionless", 2: "joy", 3: "surprise",
+               4: "anger", 5: "sadness"}
+
+
+def _put_face_detection(record, v, i):
+    record["coord_x"] = v[i]
+    record["coord_y"] = v[i + 1]
+    record["detect_size"] = v[i + 2]
+    record["reliability"] = v[i + 3]
+
+
+def _put_face_orientation(record, v, i):
+    record["face_orientation"] = {"left_and_right_direction": v[i],
+                                  "vertical_angle": v[i + 1],
+                                  "face_inclination_angle": v[i + 2],
+                                  "reliability": v[i + 3]}
+
+
+def _put_age(record, v, i):
+    record["age_estimation"] = {"age": v[i],
+                                "reliability": v[i + 1]}
+
+
+def _put_gender(record, v, i):
+    record["gender_estimation"] = {"gender": GENDERS.get(v[i], v[i]),
+                                   "reliability": v[i + 1]}
+
+
+def _put_gaze(record, v, i):
+    record["gaze_estimation"] = {"left_and_right_angle": v[i],
+                                 "up_and_down_angle": v[i + 1]}
+
+
+def _put_eyes_closed(record, v, i):
+    record["eyes_estimation"] = {"eyes_head_left": v[i],
+                                 "eyes_head_right": v[i + 1]}
+
+
+def _put_facial_expression(record, v, i):
+    record["facial_expression"] = {"expression": EXPRESSIONS.get(v[i], "unknown"),
+                                   "top_score": v[i + 1],
+                                   "neg_pos_degree": v[i + 2]}
+
+
+# Order matters: it is the order of the fields inside each face record
+# (bitmask index, bit, struct format, record builder)
+FACE_SEGMENTS = ((0, FACE_DETECTION, "hhhh", _put_face_detection),
+                 (0, FACE_ORIENTATION, "hhhh", _put_face_orientation),
+                 (0, AGE, "bh", _put_age),
+                 (0, GENDER, "bh", _put_gender),
+                 (0, GAZE, "bb", _put_gaze),
+                 (0, EYES_CLOSED, "hh", _put_eyes_closed),
+                 (1, FACIAL_EXPRESSION, "bbb", _put_facial_expression))
+
+FACE_BITS_1 = (FACE_DETECTION | FACE_ORIENTATION | AGE | GENDER |
+               GAZE | EYES_CLOSED)
+FACE_BITS_2 = FACIAL_EXPRESSION
+
+
+class FaceLayout(object):
+    """
+    Precompiled layout of a face record for one combination of bitmasks.
+    """
+    def __init__(self, bitmask_1, bitmask_2):
+        fmt = "<"
+        self.segments = []
+        value_idx = 0
+        for mask_idx, bit, seg_fmt, builder in FACE_SEGMENTS:
+            if (bitmask_1, bitmask_2)[mask_idx] & bit:
+                fmt += seg_fmt
+                self.segments.append((builder, value_idx))
+                value_idx += len(seg_fmt)
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        # field key: (builder, value_idx), for LazyFace
+        self.fields = {}
+        for builder, value_idx in self.segments:
+            for key in SEGMENT_KEYS[builder]:
+                self.fields[key] = (builder, value_idx)
+
+    def decode(self, data, offset):
+        values = self.struct.unpack_from(data, offset)
+        record = {}
+        for builder, value_idx in self.segments:
+            builder(record, values, value_idx)
+        return record
+
+    def decode_all(self, data, offset, count):
+        """
+        Decode count consecutive face records starting at offset
+        :return: list of dicts
+        """
+        if not count or not self.size:
+            # iter_unpack does not take an empty struct (no face bit set)
+            return [{} for _ in range(count)]
+        records = []
+        segments = self.segments
+        view = memoryview(data)[offset:offset + count * self.size]
+        for values in self.struct.iter_unpack(view):
+            record = {}
+            for builder, value_idx in segments:
+                builder(record, values, value_idx)
+            records.append(record)
+        return records
+
+
+_face_layouts = {}
+
+
+def face_layout(bitmask_1, bitmask_2=0):
+    """
+    Get the (cached) face record layout for the given bitmasks
+    :param bitmask_1: int, first config byte of the detection command
+    :param bitmask_2: int, second config byte of the detection command
+    :return: FaceLayout
+    """
+    key = (bitmask_1 & FACE_BITS_1, bitmask_2 & FACE_BITS_2)
+    layout = _face_layouts.get(key)
+    if layout is None:
+        layout = FaceLayout(*key)
+        _face_layouts[key] = layout
+    return layout
+
+
+def decode_results(data, offset, count):
+    """
+    Decode count consecutive body/hand records starting at offset
+    :return: list of dicts with coord_x, coord_y, detect_size, reliability
+    """
+    view = memoryview(data)[offset:offset + count * RESULT_STRUCT.size]
+    return [{"coord_x": coord_x,
+             "coord_y": coord_y,
+             "detect_size": detect_size,
+             "reliability": reliability}
+            for coord_x, coord_y, detect_size, reliability in RESULT_STRUCT.iter_unpack(view)]
+
+
+def decode_detection(data, bitmask_1, bitmask_2=0, bitmask_3=0):
+    """
+    Decode the payload of a detection execution response, e.g.:
+    {'body': [{'coord_x': 120, 'coord_y': 240, 'detect_size': 300, 'reliability': 800}],
+     'hand': [],
+     'face': [{'coord_x': 100, ..., 'age_estimation': {'age': 30, 'reliability': 500}}]}
+    and if an image was requested also
+     'image': {'width': 320, 'height': 240, 'data': <76800 bytes>}
+    :param data: str/bytes/bytearray/memoryview payload
+    :param bitmask_1: int, first config byte sent with the command
+    :param bitmask_2: int, second config byte sent with the command
+    :param bitmask_3: int, third config byte sent with the command
+    :return: dict with a list of detections per category
+    """
+    body_n, hand_n, face_n = HEADER_STRUCT.unpack_from(data, 0)
+    offset = HEADER_STRUCT.size
+    detection_dict = {}
+
+    detection_dict["body"] = decode_results(data, offset, body_n)
+    offset += body_n * RESULT_STRUCT.size
+
+    detection_dict["hand"] = decode_results(data, offset, hand_n)
+    offset += hand_n * RESULT_STRUCT.size
+
+    layout = face_layout(bitmask_1, bitmask_2)
+    detection_dict["face"] = layout.decode_all(data, offset, face_n)
+    offset += face_n * layout.size
+
+    if bitmask_3 & (IMAGE_BIG | IMAGE_SMALL):
+        # 76800 (big) or 19200 (small) size (+4 of width and height)
+        width, height = IMAGE_HEADER_STRUCT.unpack_from(data, offset)
+        offset += IMAGE_HEADER_STRUCT.size
+        detection_dict["image"] = {"width": width,
+                                   "height": height,
+                                   "data": data[offset:offset + width * height]}
+
+    return detection_dict
+
+
+def detection_box(result, scale=1.0, margin=0.0):
+    """
+    Square of side detect_size around a detection
+    :param result: detection dict (coord_x, coord_y, detect_size)
+    :param scale: float, image pixels per camera frame pixel (image width / SENSOR_WIDTH)
+    :param margin: float, added on each side, as a fraction of detect_size
+    :return: (x1, y1, x2, y2) floats, in image pixels
+    """
+    half = result["detect_size"] * (0.5 + margin) * scale
+    center_x = result["coord_x"] * scale
+    center_y = result["coord_y"] * scale
+    return center_x - half, center_y - half, center_x + half, center_y + half
+
+
+# Keys set by every face segment builder
+SEGMENT_KEYS = {_put_face_detection: ("coord_x", "coord_y", "detect_size", "reliability"),
+                _put_face_orientation: ("face_orientation",),
+                _put_age: ("age_estimation",),
+                _put_gender: ("gender_estimation",),
+                _put_gaze: ("gaze_estimation",),
+                _put_eyes_closed: ("eyes_estimation",),
+                _put_facial_expression: ("facial_expression",)}
+
+
+class LazyFace(object):
+    """
+    Face record read in place: the record is unpacked on the first access
+    to any of its fields, each field (e.g. the age_estimation dict) is built
+    on its first access and memoised. Reads like the face dicts of
+    decode_detection: face["age_estimation"], face.get("gaze_estimation")...
+    """
+    __slots__ = ("_data", "_offset", "_layout", "_values", "_fields")
+
+    def __init__(self, data, offset, layout):
+        self._data = data
+        self._offset = offset
+        self._layout = layout
+        self._values = None
+        self._fields = {}
+
+    def __getitem__(self, key):
+        fields = self._fields
+        if key in fields:
+            return fields[key]
+        segment = self._layout.fields.get(key)
+        if segment is None:
+            raise KeyError(key)
+        if self._values is None:
+            self._values = self._layout.struct.unpack_from(self._data, self._offset)
+        builder, value_idx = segment
+        builder(fields, self._values, value_idx)
+        return fields[key]
+
+    def __setitem__(self, key, value):
+        self._fields[key] = value
+
+    def __contains__(self, key):
+        return key in self._fields or key in self._layout.fields
+
+    def keys(self):
+        return list(self._layout.fields) + [key for key in self._fields
+                                            if key not in self._layout.fields]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, other):
+        self._fields.update(other)
+
+    def to_dict(self):
+        return dict((key, self[key]) for key in self.keys())
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class DetectionFrame(object):
+    """
+    Detection execution payload decoded on demand. Building it only reads
+    the 4 byte header; the bodies, hands, faces and image are decoded the
+    first time they are accessed and memoised, faces field by field (see
+    LazyFace). Reads like the dict of decode_detection: frame["face"],
+    "image" in frame...
+
+    The payload must not change while the frame is in use: do not build it
+    on the reusable read buffer of HvcP.read_data(copy=False).
+    """
+    __slots__ = ("_data", "bitmask_1", "bitmask_2", "bitmask_3",
+                 "body_count", "hand_count", "face_count", "_layout", "_fields")
+
+    def __init__(self, data, bitmask_1, bitmask_2=0, bitmask_3=0):
+        """
+        :param data: bytes/bytearray/memoryview payload
+        """
+        self._data = memoryview(data)
+        self.bitmask_1 = bitmask_1
+        self.bitmask_2 = bitmask_2
+        self.bitmask_3 = bitmask_3
+        self.body_count, self.hand_count, self.face_count = HEADER_STRUCT.unpack_from(data, 0)
+        self._layout = face_layout(bitmask_1, bitmask_2)
+        self._fields = {}
+
+    def _face_offset(self):
+        return HEADER_STRUCT.size + (self.body_count + self.hand_count) * RESULT_STRUCT.size
+
+    def _decode(self, key):
+        if key == "body":
+            return decode_results(self._data, HEADER_STRUCT.size, self.body_count)
+        if key == "hand":
+            return decode_results(self._data, HEADER_STRUCT.size + self.body_count * RESULT_STRUCT.size,
+                                  self.hand_count)
+        if key == "face":
+            offset = self._face_offset()
+            size = self._layout.size
+            return [LazyFace(self._data, offset + face_idx * size, self._layout)
+                    for face_idx in range(self.face_count)]
+        if key == "image" and self.bitmask_3 & (IMAGE_BIG | IMAGE_SMALL):
+            offset = self._face_offset() + self.face_count * self._layout.size
+            width, height = IMAGE_HEADER_STRUCT.unpack_from(self._data, offset)
+            offset += IMAGE_HEADER_STRUCT.size
+            return {"width": width,
+                    "height": height,
+                    "data": self._data[offset:offset + width * height]}
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        fields = self._fields
+        if key not in fields:
+            fields[key] = self._decode(key)
+        return fields[key]
+
+    def __setitem__(self, key, value):
+        self._fields[key] = value
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def keys(self):
+        keys = ["body", "hand", "face"]
+        if self.bitmask_3 & (IMAGE_BIG | IMAGE_SMALL):
+            keys.append("image")
+        return keys + [key for key in self._fields if key not in keys]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def face_coordinates(self):
+        """
+        Coordinates of all the faces in one pass, without building any face
+        :return: list of (coord_x, coord_y, detect_size, reliability)
+        """
+        if not self.bitmask_1 & FACE_DETECTION:
+            return []
+        unpack_from = RESULT_STRUCT.unpack_from
+        offset = self._face_offset()
+        size = self._layout.size
+        return [unpack_from(self._data, offset + face_idx * size)
+                for face_idx in range(self.face_count)]
+
+    def to_dict(self):
+        """
+        :return: dict as returned by decode_detection
+        """
+        detection_dict = dict((key, self[key]) for key in self.keys())
+        detection_dict["face"] = [face.to_dict() for face in detection_dict["face"]]
+        return detection_dict
+
+    def __repr__(self):
+        return repr(self.to_dict())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+Framing of the HVC-P responses:
+  sync header (1 byte, 0xFE), response code (1 byte),
+  data len (4 bytes, little endian), payload (data len bytes)
+
+The 6 byte header is read with a single call and the payload is
+read in big chunks in place into a reusable buffer. If the header
+does not start with 0xFE the already buffered bytes are scanned for
+the next 0xFE instead of dropping the input. A header announcing more
+than max_data_len bytes can not be a real one: it is taken as garbage
+too, instead of waiting for the timeout trying to read its payload.
+"""
+
+import struct
+
+from hvcp_image import MAX_PAYLOAD_SIZE
+
+SYNC_HEADER = 0xFE
+RESPONSE_HEADER_STRUCT = struct.Struct("<BBI")
+RESPONSE_HEADER_SIZE = RESPONSE_HEADER_STRUCT.size
+
+
+class FrameReader(object):
+    def __init__(self, ser, buffer_size=80 * 1024, chunk_size=16 * 1024,
+                 max_data_len=MAX_PAYLOAD_SIZE):
+        """
+        :param ser: serial.Serial (or any object with readinto)
+        :param buffer_size: int, initial size of the payload buffer, grows when needed
+        :param chunk_size: int, max bytes asked to the serial port per read
+        :param max_data_len: int, biggest payload a response can have
+        """
+        self.ser = ser
+        self.chunk_size = chunk_size
+        self.max_data_len = max_data_len
+        self.header = bytearray(RESPONSE_HEADER_SIZE)
+        self._header_view = memoryview(self.header)
+        self._buffer = bytearray(buffer_size)
+        self.resyncs = 0
+
+    def read_header(self):
+        """
+        Read a response header, skipping any garbage before the sync byte
+        :return: response_code, data_len (None, None on timeout)
+        """
+        header = self.header
+        filled = 0
+        while True:
+            bytes_read = self.ser.readinto(self._header_view[filled:])
+            if not bytes_read:
+                return None, None
+            filled += bytes_read
+            if filled < RESPONSE_HEADER_SIZE:
+                continue
+            if header[0] == SYNC_HEADER:
+                sync, response_code, data_len = RESPONSE_HEADER_STRUCT.unpack_from(header)
+                if data_len <= self.max_data_len:
+                    return response_code, data_len
+            # Out of sync, keep what may be the start of the next header
+            self.resyncs += 1
+            sync_idx = header.find(b'\xfe', 1)
+            if sync_idx == -1:
+                filled = 0
+            else:
+                filled = RESPONSE_HEADER_SIZE - sync_idx
+                header[:filled] = header[sync_idx:]
+
+    def read_payload(self, data_len, into=None):
+        """
+        Read data_len bytes of payload
+        :param data_len: int
+        :param into: writable memoryview to read into, instead of the internal buffer
+        :return: memoryview of the payload (if it is the internal buffer, only
+                 valid until the next read), None on timeout
+        """
+        if into is None:
+            if data_len > len(self._buffer):
+                self._buffer = bytearray(data_len)
+            into = self._buffer
+        view = memoryview(into)[:data_len]
+        filled = 0
+        while filled < data_len:
+            bytes_read = self.ser.readinto(view[filled:filled + self.chunk_size])
+            if not bytes_read:
+                return None
+            filled += bytes_read
+        return view
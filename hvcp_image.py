@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+Preallocated ring of buffers to receive detection execution
+payloads that carry an image, so every frame is read in place
+(with readinto) instead of allocating and copying ~77KB per frame.
+
+Usage:
+    ring = ImageRing(slots=4)
+    detections = sensor.detection_execution(image_bit=True, image_ring=ring)
+    slot = detections["image"]["slot"]
+    gray = slot.array()  # (240, 320) uint8 numpy view, no copy
+    ...
+    slot.release()  # the buffer can be reused for a new frame
+"""
+
+import collections
+
+# header + 35 bodies + 35 hands + 35 faces (31 bytes max) + image header
+MAX_DETECTIONS_SIZE = 4 + 35 * 8 + 35 * 8 + 35 * 31 + 4
+BIG_IMAGE_SIZE = 320 * 240
+SMALL_IMAGE_SIZE = 160 * 120
+MAX_PAYLOAD_SIZE = MAX_DETECTIONS_SIZE + BIG_IMAGE_SIZE
+
+
+class ImageSlot(object):
+    """
+    One buffer of the ring. Holds a full detection payload and,
+    once decoded, the position of the image inside it.
+    """
+    def __init__(self, ring, index, buffer):
+        self.ring = ring
+        self.index = index
+        self.buffer = buffer
+        self.width = None
+        self.height = None
+        self.data = None
+
+    def set_image(self, width, height, offset):
+        """
+        :param width: int
+        :param height: int
+        :param offset: int, position of the image inside the slot
+        """
+        self.width = width
+        self.height = height
+        self.data = self.buffer[offset:offset + width * height]
+
+    def array(self):
+        """
+        :return: numpy (height, width) uint8 view of the image, no copy
+        """
+        import numpy as np
+        return np.frombuffer(self.data, dtype=np.uint8).reshape(self.height, self.width)
+
+    def release(self):
+        """
+        Give the slot back to the ring. The image must not be used after this.
+        """
+        self.width, self.height, self.data = None, None, None
+        self.ring._free.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class ImageRing(object):
+    def __init__(self, slots=4, slot_size=MAX_PAYLOAD_SIZE):
+        """
+        :param slots: int, number of frames that can be held at the same time
+        :param slot_size: int, bytes of each slot (max payload size)
+        """
+        self.slot_size = slot_size
+        self._storage = bytearray(slots * slot_size)
+        view = memoryview(self._storage)
+        self.slots = [ImageSlot(self, idx, view[idx * slot_size:(idx + 1) * slot_size])
+                      for idx in range(slots)]
+        self._free = collections.deque(self.slots)
+
+    def free_slots(self):
+        return len(self._free)
+
+    def acquire(self):
+        """
+        Take a free slot to read a payload into
+        :return: ImageSlot
+        """
+        try:
+            return self._free.popleft()
+        except IndexError:
+            raise RuntimeError("No free slot in the image ring, "
+                               "release the frames that are already consumed")
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""
+Baud rate selection of the link to the sensor.
+
+The transfer of a 320x240 image takes 0.83 s at 921600 baud and 80 s at
+9600, and a serial port opened at a rate the device does not use does not
+fail: the reads just time out. connect probes the rates from the fastest:
+  - the rate answers if get_version gets a valid response (short timeout),
+  - the link is measured: round trip of get_version (median of trials) and
+    throughput of a detection execution with the small image alone (its
+    extra bytes over the extra time taken compared to get_version),
+  - the rate is stable if every trial succeeded without any retry.
+The stable rate with the best measured throughput is kept. Slower rates are
+skipped once their nominal throughput (8N1: baudrate / 10 bytes/s) could
+not beat the measured one. The result is saved per device in a JSON file,
+later connections only check that the cached rate still answers.
+
+Only the host side rate changes: over the USB link of the HVC-P every
+rate answers and the throughput tells them apart, over a UART only the
+rate of the device answers.
+
+Usage:
+    sensor = connect("/dev/ttyUSB0")  # probes the first time, then uses the cache
+    print(load_cache()["/dev/ttyUSB0"])
+    sensor = connect("/dev/ttyUSB0", reprobe=True)  # e.g. after changing the cable
+"""
+
+import json
+import logging
+import os
+import time
+
+from hvcp import HvcP
+from hvcp_protocol import (HvcPError, VERSION_COMMAND, Feature, detection_frame,
+                           parse_version)
+
+BAUDRATES = (921600, 460800, 230400, 115200, 38400, 9600)
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".hvcp_link.json")
+THROUGHPUT_COMMAND = detection_frame(Feature.IMAGE_SMALL)[0]
+
+logger = logging.getLogger(__name__)
+
+
+def load_cache(path=DEFAULT_CACHE_PATH):
+    """
+    :return: dict of device (tty): link dict as saved by connect, {} if there is no cache
+    """
+    try:
+        with open(path) as cache_file:
+            return json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_cache(cache, path=DEFAULT_CACHE_PATH):
+    """
+    Write the cache atomically
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as cache_file:
+        json.dump(cache, cache_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _timed(sensor, command):
+    """
+    :return: (seconds, payload) of one exchange, without retries
+    """
+    start = time.perf_counter()
+    data = sensor.execute(command, retries=0)
+    return time.perf_counter() - start, data
+
+
+def measure_link(sensor, trials=3):
+    """
+    Benchmark the link at the current rate of sensor.ser
+    :return: dict with round_trip_ms (median get_version exchange), throughput_Bps
+             (bytes/s of the image transfer), errors and stable (bool)
+    """
+    errors_before = sum(sensor.errors.values())
+    round_trips = []
+    transfers = []
+    failures = 0
+    for _ in range(trials):
+        try:
+            version_time, version = _timed(sensor, VERSION_COMMAND)
+            image_time, image = _timed(sensor, THROUGHPUT_COMMAND)
+        except HvcPError:
+            failures += 1
+            sensor.clear_input()
+            continue
+        round_trips.append(version_time)
+        transfers.append((len(image) - len(version), image_time - version_time))
+    errors = failures + sum(sensor.errors.values()) - errors_before
+    link = {"round_trip_ms": None, "throughput_Bps": None,
+            "errors": errors, "stable": not errors}
+    if round_trips:
+        round_trips.sort()
+        link["round_trip_ms"] = round_trips[len(round_trips) // 2] * 1000.0
+        extra_bytes = sum(size for size, duration in transfers)
+        extra_time = sum(duration for size, duration in transfers)
+        link["throughput_Bps"] = extra_bytes / extra_time if extra_time > 0 else float(extra_bytes)
+    return link
+
+
+def answers(sensor, baudrate, timeout=0.3):
+    """
+    Switch the host side of the link to baudrate and check that the device answers
+    :param timeout: float, seconds to wait for the response
+    :return: version dict, None if there is no valid response
+    """
+    ser = sensor.ser
+    ser.baudrate = baudrate
+    previous_timeout = ser.timeout
+    ser.timeout = timeout
+    try:
+        sensor.clear_input()
+        return parse_version(sensor.execute(VERSION_COMMAND, retries=0))
+    except HvcPError:
+        sensor.clear_input()
+        return None
+    finally:
+        ser.timeout = previous_timeout
+
+
+def probe(sensor, baudrates=BAUDRATES, trials=3, timeout=0.3):
+    """
+    Find the fastest stable rate, leaving sensor.ser at it (or at its
+    original rate if none is stable)
+    :param baudrates: rates to try, the fastest first
+    :param trials: int, exchanges of each benchmark
+    :return: (best link dict or None, list of the link dicts of every rate tried),
+             a link dict is as measure_link plus baudrate and version
+    """
+    original_baudrate = sensor.ser.baudrate
+    results = []
+    best = None
+    for baudrate in sorted(baudrates, reverse=True):
+        if best is not None and baudrate / 10.0 <= best["throughput_Bps"]:
+            break
+        version = answers(sensor, baudrate, timeout)
+        if version is None:
+            logger.info("No answer at %d baud" % baudrate)
+            results.append({"baudrate": baudrate, "version": None, "stable": False})
+            continue
+        link = measure_link(sensor, trials)
+        link["baudrate"] = baudrate
+        link["version"] = version
+        results.append(link)
+        logger.info("%d baud: %s" % (baudrate, link))
+        if link["stable"] and (best is None or link["throughput_Bps"] > best["throughput_Bps"]):
+            best = link
+    sensor.ser.baudrate = original_baudrate if best is None else best["baudrate"]
+    sensor.clear_input()
+    return best, results
+
+
+def connect(tty="/dev/ttyUSB0", cache_path=DEFAULT_CACHE_PATH, baudrates=BAUDRATES,
+            trials=3, reprobe=False, timeout=5, ser=None):
+    """
+    Open the sensor at the fastest stable rate: the cached one if it still
+    answers, otherwise probe (and update the cache)
+    :param cache_path: str, JSON file of the rate per device, None = no cache
+    :param reprobe: bool, ignore the cached rate
+    :param ser: see HvcP (e.g. hvcp_sim.SimulatedSerial), still cached under tty
+    :return: HvcP
+    :raise HvcPError: when no rate is stable
+    """
+    cache = load_cache(cache_path) if cache_path else {}
+    cached = None if reprobe else cache.get(tty)
+    sensor = HvcP(tty=tty, baudrate=cached["baudrate"] if cached else max(baudrates),
+                  timeout=timeout, ser=ser)
+    if cached:
+        version = answers(sensor, cached["baudrate"])
+        if version is not None and version == cached["version"]:
+            logger.info("Using the cached rate of %s: %d baud" % (tty, cached["baudrate"]))
+            return sensor
+        logger.info("The cached rate of %s does not answer, probing" % tty)
+    best, results = probe(sensor, baudrates, trials)
+    if best is None:
+        raise HvcPError("No stable baud rate for %s: %s" % (tty, results))
+    if cache_path:
+        cache = load_cache(cache_path)
+        cache[tty] = dict(best, probed=time.time(), results=results)
+        save_cache(cache, cache_path)
+    return sensor
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""
+Latency histograms of every stage of the exchanges with the sensor,
+per command:
+  write     ser.write of the command datagram
+  wait      from the end of the write to the response header read
+            (device processing + header transfer, + queueing when pipelined)
+  transfer  payload read
+  decode    detection payload decoding (detection execution only)
+
+Durations come from time.perf_counter_ns and go to fixed size log-linear
+histograms (8 buckets per power of 2, so any percentile is within ~6%):
+recording is a few integer operations on preallocated buckets. With the
+metrics disabled the instrumented code only checks sensor.metrics is None.
+
+Usage:
+    metrics = sensor.enable_metrics()
+    ...
+    print(metrics.snapshot()["detection_execution"]["wait"]["p99_us"])
+    open("metrics.prom", "w").write(metrics.to_prometheus())
+    sensor.disable_metrics()  # back to no instrumentation at all
+"""
+
+import json
+import threading
+
+from hvcp_protocol import Command
+
+STAGES = ("write", "wait", "transfer", "decode")
+SUB_BUCKETS = 8
+# Values up to 2^64 ns
+BUCKETS = (64 - 3) * SUB_BUCKETS + SUB_BUCKETS
+
+
+def command_name(command_code):
+    """
+    :return: str, e.g. "detection_execution", "0x42" for unknown codes
+    """
+    try:
+        return Command(command_code).name.lower()
+    except ValueError:
+        return "0x%02x" % command_code
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        """
+        :param value: int, nanoseconds
+        """
+        if value < 2 * SUB_BUCKETS:
+            idx = value if value > 0 else 0
+        else:
+            shift = value.bit_length() - 4
+            idx = shift * SUB_BUCKETS + (value >> shift)
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @staticmethod
+    def bucket_upper_bound(idx):
+        if idx < 2 * SUB_BUCKETS:
+            return idx
+        shift = idx // SUB_BUCKETS - 1
+        mantissa = idx % SUB_BUCKETS + SUB_BUCKETS
+        return ((mantissa + 1) << shift) - 1
+
+    def percentile(self, fraction):
+        """
+        :param fraction: float, e.g. 0.99
+        :return: int, nanoseconds (upper bound of its bucket, at most the max)
+        """
+        if not self.count:
+            return 0
+        target = max(int(fraction * self.count + 0.5), 1)
+        seen = 0
+        for idx, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target:
+                return min(self.bucket_upper_bound(idx), self.max)
+        return self.max
+
+    def summary(self):
+        """
+        :return: dict with count, mean_us, p50_us, p99_us, max_us
+        """
+        return {"count": self.count,
+                "mean_us": self.total / 1000.0 / self.count if self.count else 0.0,
+                "p50_us": self.percentile(0.5) / 1000.0,
+                "p99_us": self.percentile(0.99) / 1000.0,
+                "max_us": self.max / 1000.0}
+
+
+class Metrics(object):
+    def __init__(self):
+        # (command code, stage): Histogram
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, command_code, stage, nanoseconds):
+        histogram = self.histograms.get((command_code, stage))
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault((command_code, stage), Histogram())
+        histogram.record(nanoseconds)
+
+    def histogram(self, command_code, stage):
+        """
+        :return: Histogram, None if nothing was recorded for it
+        """
+        return self.histograms.get((command_code, stage))
+
+    def reset(self):
+        self.histograms = {}
+
+    def snapshot(self):
+        """
+        :return: dict of command name: stage: summary, e.g.
+        {'detection_execution': {'wait': {'count': 100, 'mean_us': 80123.4,
+                                          'p50_us': 79871.0, 'p99_us': 90111.0,
+                                          'max_us': 91002.1}, ...}}
+        """
+        snapshot = {}
+        for (command_code, stage), histogram in sorted(self.histograms.items()):
+            snapshot.setdefault(command_name(command_code), {})[stage] = histogram.summary()
+        return snapshot
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix="hvcp"):
+        """
+        :return: str, Prometheus text exposition: a summary of the stage
+                 durations (p50, p99) and a gauge of the max, in seconds
+        """
+        name = prefix + "_stage_seconds"
+        lines = ["# HELP %s Duration of each stage of the exchanges with the sensor" % name,
+                 "# TYPE %s summary" % name]
+        max_lines = ["# HELP %s_max Longest duration of each stage" % name,
+                     "# TYPE %s_max gauge" % name]
+        for (command_code, stage), histogram in sorted(self.histograms.items()):
+            labels = 'command="%s",stage="%s"' % (command_name(command_code), stage)
+            for quantile in (0.5, 0.99):
+                lines.append('%s{%s,quantile="%s"} %.9f'
+                             % (name, labels, quantile, histogram.percentile(quantile) / 1e9))
+            lines.append("%s_sum{%s} %.9f" % (name, labels, histogram.total / 1e9))
+            lines.append("%s_count{%s} %d" % (name, labels, histogram.count))
+            max_lines.append("%s_max{%s} %.9f" % (name, labels, histogram.max / 1e9))
+        return "\n".join(lines + max_lines) + "\n"
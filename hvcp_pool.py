@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+Drive several HVC-P sensors (one per serial port) in parallel.
+
+Every sensor is served by its own thread, so the time to get a frame
+from all of them is the time of the slowest one instead of the sum.
+
+Usage:
+    pool = SensorPool(["/dev/ttyUSB0", "/dev/ttyUSB1"])
+    snapshot = pool.detection_execution(gaze=False)
+    # {'timestamp': ..., 'frames': {'/dev/ttyUSB0': {...}, '/dev/ttyUSB1': {...}}}
+    for frame in pool.stream():
+        # frames of all the sensors ordered by arrival, tagged by 'device'
+        print(frame['device'], frame['timestamp'], frame['detections'])
+    print(pool.stats())
+"""
+
+import collections
+import queue
+import threading
+import time
+
+from hvcp import HvcP
+
+
+class SensorPool(object):
+    def __init__(self, ttys=(), baudrate=921600, timeout=5, sensors=None):
+        """
+        :param ttys: list of str, serial ports, a HvcP is opened for each one
+        :param baudrate: int
+        :param timeout: float
+        :param sensors: dict of device name: HvcP already connected, used instead of ttys
+        """
+        if sensors is None:
+            sensors = collections.OrderedDict(
+                (tty, HvcP(tty=tty, baudrate=baudrate, timeout=timeout)) for tty in ttys)
+        self.sensors = sensors
+        self._stats_lock = threading.Lock()
+        self._stats = dict((device, {"frames": 0, "errors": 0, "busy_time": 0.0})
+                           for device in sensors)
+
+    def _count(self, device, frames=0, errors=0, busy_time=0.0):
+        with self._stats_lock:
+            stats = self._stats[device]
+            stats["frames"] += frames
+            stats["errors"] += errors
+            stats["busy_time"] += busy_time
+
+    def stats(self):
+        """
+        Per device throughput and error counts, e.g.:
+        {'/dev/ttyUSB0': {'frames': 120, 'errors': 1, 'busy_time': 12.1, 'fps': 9.9}}
+        :return: dict
+        """
+        with self._stats_lock:
+            stats = dict((device, dict(device_stats)) for device, device_stats in self._stats.items())
+        for device_stats in stats.values():
+            busy_time = device_stats["busy_time"]
+            device_stats["fps"] = device_stats["frames"] / busy_time if busy_time else 0.0
+        return stats
+
+    def detection_execution(self, **detection_flags):
+        """
+        Run one detection on all the sensors at the same time
+        :param detection_flags: arguments of HvcP.detection_execution
+        :return: {'timestamp': <start time>, 'frames': {device: detections (None on error)}}
+        """
+        detection_flags.setdefault("show_image", False)
+        start_time = time.time()
+        results = {}
+
+        def detect(device, sensor):
+            try:
+                results[device] = sensor.detection_execution(**detection_flags)
+            except Exception:
+                sensor.logger.exception("Detection failed on " + str(device))
+                results[device] = None
+            if results[device] is None:
+                self._count(device, errors=1, busy_time=time.time() - start_time)
+            else:
+                self._count(device, frames=1, busy_time=time.time() - start_time)
+
+        threads = [threading.Thread(target=detect, args=(device, sensor))
+                   for device, sensor in self.sensors.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return {"timestamp": start_time, "frames": results}
+
+    def stream(self, frames=None, max_pending=64, **detection_flags):
+        """
+        Run HvcP.stream on all the sensors at the same time and merge their
+        frames in a single stream, in arrival order, each one tagged with
+        its 'device'.
+        :param frames: int, frames to capture per sensor (None = forever)
+        :param max_pending: int, frames that can wait to be consumed before
+                            the sensor threads block
+        :param detection_flags: arguments of HvcP.stream
+        :return: generator of frame dicts (see HvcP.stream) with 'device'
+        """
+        output = queue.Queue(maxsize=max_pending)
+        stop = threading.Event()
+        done = object()
+
+        def capture(device, sensor):
+            errors_seen = 0
+            last_time = time.time()
+            try:
+                for frame in sensor.stream(frames=frames, **detection_flags):
+                    if stop.is_set():
+                        break
+                    now = time.time()
+                    self._count(device, frames=1, errors=frame["errors"] - errors_seen,
+                                busy_time=now - last_time)
+                    errors_seen, last_time = frame["errors"], now
+                    frame["device"] = device
+                    output.put(frame)
+            except Exception:
+                sensor.logger.exception("Capture failed on " + str(device))
+                self._count(device, errors=1)
+            finally:
+                output.put(done)
+
+        threads = [threading.Thread(target=capture, args=(device, sensor))
+                   for device, sensor in self.sensors.items()]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        running = len(threads)
+        try:
+            while running:
+                frame = output.get()
+                if frame is done:
+                    running -= 1
+                else:
+                    yield frame
+        finally:
+            stop.set()
+            # Unblock the threads waiting to put a frame
+            while running:
+                if output.get() is done:
+                    running -= 1
+            for thread in threads:
+                thread.join()
+
+    def close(self):
+        for sensor in self.sensors.values():
+            sensor.ser.close()
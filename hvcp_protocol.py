@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+
+"""
+Pure encoding of the HVC-P commands and decoding of their responses,
+with no I/O, shared by the blocking (hvcp.HvcP) and the asyncio
+(hvcp_async.AsyncHvcP) clients.
+
+A command datagram is:
+  sync header (1 byte, 0xFE), command code (1 byte),
+  data len (2 bytes, little endian), payload (data len bytes)
+
+Every datagram is prebuilt bytes: the read commands and all the detection
+execution combinations (DETECTION_FRAMES, by Feature flags) are computed
+at import, the setter datagrams are cached by their arguments.
+"""
+
+import binascii
+import enum
+import functools
+import struct
+
+from hvcp_decoder import (HUMAN_BODY_DETECTION, HAND_DETECTION, FACE_DETECTION,
+                          FACE_ORIENTATION, AGE, GENDER, GAZE, EYES_CLOSED,
+                          FACIAL_EXPRESSION, IMAGE_BIG, IMAGE_SMALL,
+                          HEADER_STRUCT, RESULT_STRUCT, IMAGE_HEADER_STRUCT, face_layout)
+
+commands_dict = {'00': "  model / version read ",
+                 '01': " set camera orientation",
+                 '02': " get camera orientation",
+                 '03': "  detection execution  ",
+                 '05': "     set thresholds    ",
+                 '06': "     get thresholds    ",
+                 '07': "   set detection size  ",
+                 '08': "   get detection size  ",
+                 '09': "set face detection angle",
+                 '0a': "get face detection angle"
+                 }
+
+response_codes_dict = {'00': "OK",
+                       'ff': "UNDEFINED COMMAND",
+                       'fe': "INTERNAL ERROR",
+                       'fd': "ILLEGAL COMMAND",
+                       'fa': "COMMUNICATION ERROR",
+                       'fb': "COMMUNICATION ERROR",
+                       'fc': "COMMUNICATION ERROR",
+                       'f0': "DEVICE ERROR",
+                       'f1': "DEVICE ERROR",
+                       'f2': "DEVICE ERROR",
+                       'f3': "DEVICE ERROR",
+                       'f4': "DEVICE ERROR",
+                       'f5': "DEVICE ERROR",
+                       'f6': "DEVICE ERROR",
+                       'f7': "DEVICE ERROR",
+                       'f8': "DEVICE ERROR",
+                       'f9': "DEVICE ERROR"
+                       }
+
+COMMAND_HEADER_STRUCT = struct.Struct("<BBH")
+
+
+class Command(enum.IntEnum):
+    VERSION = 0x00
+    SET_CAMERA_ORIENTATION = 0x01
+    GET_CAMERA_ORIENTATION = 0x02
+    DETECTION_EXECUTION = 0x03
+    SET_THRESHOLDS = 0x05
+    GET_THRESHOLDS = 0x06
+    SET_DETECTION_SIZE = 0x07
+    GET_DETECTION_SIZE = 0x08
+    SET_FACE_DETECTION_ANGLE = 0x09
+    GET_FACE_DETECTION_ANGLE = 0x0A
+
+
+VERSION_STRUCT = struct.Struct("<12sbbb4s")
+THRESHOLDS_STRUCT = struct.Struct("<hhhh")
+DETECTION_SIZE_STRUCT = struct.Struct("<hhhhhh")
+FACE_ANGLE_STRUCT = struct.Struct("<BB")
+
+ORIENTATION_CODES = {0: 0, 90: 1, 180: 2, 270: 3}
+ORIENTATION_ANGLES = {0: 0, 1: 90, 2: 180, 3: 270}
+FACE_DIRECTION_CODES = {"front": 0, "diagonal": 1, "profile": 2}
+FACE_DIRECTIONS = {0: "front_face (+-30)", 1: "diagonal_face (+-60)", 2: "profile_face (+-90)"}
+FACE_INCLINATION_CODES = {"15": 0, "45": 1}
+FACE_INCLINATIONS = {0: "+-15", 1: "+-45"}
+
+
+class HvcPError(Exception):
+    """
+    Base of the errors of an exchange with the sensor
+    """
+
+
+class ResponseTimeout(HvcPError):
+    """
+    No complete response within the timeout
+    """
+
+
+class FramingError(HvcPError):
+    """
+    Response whose length is not the one expected for the command
+    """
+
+
+class ResponseError(HvcPError):
+    """
+    Response with a code other than OK, see response_codes_dict
+    """
+    def __init__(self, response_code):
+        self.response_code = response_code
+        name = response_codes_dict.get("%02x" % response_code, "UNKNOWN_CODE")
+        super(ResponseError, self).__init__("%s (0x%02x)" % (name, response_code))
+
+
+class UndefinedCommandError(ResponseError):
+    pass
+
+
+class InternalError(ResponseError):
+    pass
+
+
+class IllegalCommandError(ResponseError):
+    pass
+
+
+class CommunicationError(ResponseError):
+    pass
+
+
+class DeviceError(ResponseError):
+    pass
+
+
+RESPONSE_ERRORS = {0xFF: UndefinedCommandError,
+                   0xFE: InternalError,
+                   0xFD: IllegalCommandError}
+RESPONSE_ERRORS.update((code, CommunicationError) for code in (0xFA, 0xFB, 0xFC))
+RESPONSE_ERRORS.update((code, DeviceError) for code in range(0xF0, 0xFA))
+
+# Errors worth sending the same command again for
+TRANSIENT_ERRORS = (ResponseTimeout, FramingError, CommunicationError)
+
+
+def response_error(response_code):
+    """
+    :return: ResponseError (subclass) for the response code
+    """
+    return RESPONSE_ERRORS.get(response_code, ResponseError)(response_code)
+
+
+def build_command(command_code, payload=b''):
+    """
+    :param command_code: int
+    :param payload: bytes
+    :return: bytes, full datagram
+    """
+    return COMMAND_HEADER_STRUCT.pack(0xFE, command_code, len(payload)) + payload
+
+
+VERSION_COMMAND = build_command(Command.VERSION)
+GET_CAMERA_ORIENTATION_COMMAND = build_command(Command.GET_CAMERA_ORIENTATION)
+THRESHOLDS_READ_COMMAND = build_command(Command.GET_THRESHOLDS)
+DETECTION_SIZE_READ_COMMAND = build_command(Command.GET_DETECTION_SIZE)
+FACE_DETECTION_ANGLE_READ_COMMAND = build_command(Command.GET_FACE_DETECTION_ANGLE)
+
+# Payload length of the OK response of the read commands (the setters are
+# not checked: their payload is not reliable, see HvcP._apply_config)
+RESPONSE_SIZES = {Command.VERSION: VERSION_STRUCT.size,
+                  Command.GET_CAMERA_ORIENTATION: 1,
+                  Command.GET_THRESHOLDS: THRESHOLDS_STRUCT.size,
+                  Command.GET_DETECTION_SIZE: DETECTION_SIZE_STRUCT.size,
+                  Command.GET_FACE_DETECTION_ANGLE: FACE_ANGLE_STRUCT.size}
+# Header of the detection execution payload
+MIN_DETECTION_SIZE = HEADER_STRUCT.size
+# Image size by the image bit of bitmask_3 (the big one wins if both are set)
+IMAGE_SIZES = {IMAGE_BIG: (320, 240), IMAGE_SMALL: (160, 120)}
+
+
+def check_response_size(command_code, data_len):
+    """
+    :raise FramingError: if data_len is not the payload length of an OK
+                         response to the command
+    """
+    if command_code == Command.DETECTION_EXECUTION:
+        if data_len < MIN_DETECTION_SIZE:
+            raise FramingError("Detection response of %d bytes" % data_len)
+        return
+    expected = RESPONSE_SIZES.get(command_code)
+    if expected is not None and data_len != expected:
+        raise FramingError("Response of %d bytes to command 0x%02x, expected %d"
+                           % (data_len, command_code, expected))
+
+
+def check_detection_size(data, bitmask_1, bitmask_2=0, bitmask_3=0):
+    """
+    Check a detection execution payload against the length given by the
+    counts of its header and the bitmasks of the command, and its image
+    size, so a corrupted count is not decoded as garbage detections
+    :raise FramingError: if they do not match
+    """
+    data_len = len(data)
+    if data_len < MIN_DETECTION_SIZE:
+        raise FramingError("Detection response of %d bytes" % data_len)
+    body_n, hand_n, face_n = HEADER_STRUCT.unpack_from(data, 0)
+    expected = (HEADER_STRUCT.size + (body_n + hand_n) * RESULT_STRUCT.size +
+                face_n * face_layout(bitmask_1, bitmask_2).size)
+    image_size = None
+    if bitmask_3 & IMAGE_BIG:
+        image_size = IMAGE_SIZES[IMAGE_BIG]
+    elif bitmask_3 & IMAGE_SMALL:
+        image_size = IMAGE_SIZES[IMAGE_SMALL]
+    if image_size is not None:
+        expected += IMAGE_HEADER_STRUCT.size + image_size[0] * image_size[1]
+    if data_len != expected:
+        raise FramingError("Detection response of %d bytes, expected %d for %d bodies, "
+                           "%d hands and %d faces" % (data_len, expected, body_n, hand_n, face_n))
+    if image_size is not None:
+        image_header = IMAGE_HEADER_STRUCT.unpack_from(data, data_len - image_size[0] * image_size[1]
+                                                       - IMAGE_HEADER_STRUCT.size)
+        if image_header != image_size:
+            raise FramingError("Image of %dx%d, expected %dx%d" % (image_header + image_size))
+
+
+def parse_version(data):
+    """
+    Version info, e.g.:
+    {'release_version': 10,
+    'model': 'HVC-P       ',
+    'major_version': 1,
+    'revision': '7b040000',
+    'minor_version': 0}
+    """
+    # Type string (12 characters): "HVC-C1B"
+    # Major version (1 byte HEX): it will update at the time of large-scale change
+    # Minor version (1 byte HEX): I will update when small change
+    # Release version (1 byte HEX): I will update when minor modifications
+    # Revision number (4 bytes HEX): use it for internal management
+    model, major, minor, release, revision = VERSION_STRUCT.unpack_from(data)
+    version_dict = {}
+    version_dict["model"] = model.decode('ascii')
+    version_dict["major_version"] = major
+    version_dict["minor_version"] = minor
+    version_dict["release_version"] = release
+    version_dict["revision"] = binascii.hexlify(revision).decode('ascii')
+    return version_dict
+
+
+@functools.lru_cache(maxsize=64)
+def camera_orientation_command(angle):
+    """
+    :param angle: 0, 90, 180, 270 (anything else is sent as 0)
+    """
+    return build_command(Command.SET_CAMERA_ORIENTATION,
+                         struct.pack("<B", ORIENTATION_CODES.get(angle, 0)))
+
+
+def parse_camera_orientation(data):
+    """
+    :return: 0, 90, 180, 270 as degrees of orientation, None if unknown
+    """
+    code, = struct.unpack_from("<B", data)
+    return ORIENTATION_ANGLES.get(code)
+
+
+class Feature(enum.IntFlag):
+    """
+    Detection execution features, the three bitmasks of the command
+    packed in one int: bitmask_1 | bitmask_2 << 8 | bitmask_3 << 16
+    """
+    HUMAN_BODY_DETECTION = HUMAN_BODY_DETECTION
+    HAND_DETECTION = HAND_DETECTION
+    FACE_DETECTION = FACE_DETECTION
+    FACE_ORIENTATION = FACE_ORIENTATION
+    AGE = AGE
+    GENDER = GENDER
+    GAZE = GAZE
+    EYES_CLOSED = EYES_CLOSED
+    FACIAL_EXPRESSION = FACIAL_EXPRESSION << 8
+    IMAGE_BIG = IMAGE_BIG << 16
+    IMAGE_SMALL = IMAGE_SMALL << 16
+
+
+ALL_FEATURES = (Feature.HUMAN_BODY_DETECTION | Feature.HAND_DETECTION | Feature.FACE_DETECTION |
+                Feature.FACE_ORIENTATION | Feature.AGE | Feature.GENDER | Feature.GAZE |
+                Feature.EYES_CLOSED | Feature.FACIAL_EXPRESSION)
+
+
+def _detection_frame(features):
+    features = int(features)
+    bitmask_1 = features & 0xFF
+    bitmask_2 = (features >> 8) & 0xFF
+    bitmask_3 = (features >> 16) & 0xFF
+    command = build_command(Command.DETECTION_EXECUTION,
+                            struct.pack("<BBB", bitmask_1, bitmask_2, bitmask_3))
+    return command, bitmask_1, bitmask_2, bitmask_3
+
+
+# Every detection execution datagram, by int(features): 2048 combinations of ~7 bytes
+DETECTION_FRAMES = dict((features, _detection_frame(features))
+                        for features in range(ALL_FEATURES + 1)
+                        if not features & ~ALL_FEATURES)
+DETECTION_FRAMES.update((features | image, _detection_frame(features | image))
+                        for features in list(DETECTION_FRAMES)
+                        for image in (Feature.IMAGE_BIG, Feature.IMAGE_SMALL,
+                                      Feature.IMAGE_BIG | Feature.IMAGE_SMALL))
+
+
+def detection_frame(features):
+    """
+    :param features: Feature flags (or their int value)
+    :return: command, bitmask_1, bitmask_2, bitmask_3 (precomputed)
+    """
+    return DETECTION_FRAMES[features]
+
+
+def detection_command(eyes_closed=True, gaze=True,
+                      gender=True, age=True, face_orientation=True,
+                      face_detection=True, hand_detection=True,
+                      human_body_detection=True,
+                      facial_expression=True,
+                      image_bit=False,
+                      image_bit_small=False):
+    """
+    Get the detection execution command for the given flags
+    :return: command, bitmask_1, bitmask_2, bitmask_3 (precomputed)
+    """
+    # Plain ints: IntFlag operations are much slower
+    return DETECTION_FRAMES[(EYES_CLOSED if eyes_closed else 0) |
+                            (GAZE if gaze else 0) |
+                            (GENDER if gender else 0) |
+                            (AGE if age else 0) |
+                            (FACE_ORIENTATION if face_orientation else 0) |
+                            (FACE_DETECTION if face_detection else 0) |
+                            (HAND_DETECTION if hand_detection else 0) |
+                            (HUMAN_BODY_DETECTION if human_body_detection else 0) |
+                            (FACIAL_EXPRESSION << 8 if facial_expression else 0) |
+                            (IMAGE_BIG << 16 if image_bit else 0) |
+                            (IMAGE_SMALL << 16 if image_bit_small else 0)]
+
+
+def parse_thresholds(data):
+    """
+    {'human_body': 254, 'face': 254, 'reserved': 254, 'hand': 254}
+    """
+    human_body, hand, face, reserved = THRESHOLDS_STRUCT.unpack_from(data)
+    return {"human_body": human_body,
+            "hand": hand,
+            "face": face,
+            "reserved": reserved}
+
+
+@functools.lru_cache(maxsize=256)
+def thresholds_set_command(human_body, hand, face):
+    return build_command(Command.SET_THRESHOLDS,
+                         THRESHOLDS_STRUCT.pack(human_body, hand, face, 0))
+
+
+def parse_detection_size(data):
+    """
+    {'human_body_min': 30, 'hand_min': 40, 'hand_max': 8192, 'face_min': 64, 'face_max': 8192, 'human_body_max': 8192}
+    """
+    values = DETECTION_SIZE_STRUCT.unpack_from(data)
+    return dict(zip(("human_body_min", "human_body_max",
+                     "hand_min", "hand_max",
+                     "face_min", "face_max"), values))
+
+
+@functools.lru_cache(maxsize=256)
+def detection_size_set_command(human_body_min, human_body_max,
+                               hand_min, hand_max, face_min, face_max):
+    return build_command(Command.SET_DETECTION_SIZE,
+                         DETECTION_SIZE_STRUCT.pack(human_body_min, human_body_max,
+                                                    hand_min, hand_max,
+                                                    face_min, face_max))
+
+
+def parse_face_detection_angle(data):
+    """
+    {'face_inclination': '+-15', 'face_direction': 'front_face (+-30)'}
+    """
+    direction, inclination = FACE_ANGLE_STRUCT.unpack_from(data)
+    face_angle_dict = {}
+    face_angle_dict["face_direction"] = FACE_DIRECTIONS.get(
+        direction, "unknown_setting (%02x)" % direction)
+    face_angle_dict["face_inclination"] = FACE_INCLINATIONS.get(
+        inclination, "unknown_setting (%02x)" % inclination)
+    return face_angle_dict
+
+
+@functools.lru_cache(maxsize=64)
+def face_inclination_angle_set_command(face_direction, face_inclination):
+    """
+    :param face_direction: str of: "front", "diagonal", "profile"
+    :param face_inclination: str "15", "45"
+    :raise ValueError: on any other input
+    """
+    if face_direction not in FACE_DIRECTION_CODES:
+        raise ValueError("face_direction can only be 'front', 'diagonal, 'profile''")
+    if face_inclination not in FACE_INCLINATION_CODES:
+        raise ValueError("face_inclination can only be '15', '45' (as string)")
+    return build_command(Command.SET_FACE_DETECTION_ANGLE,
+                         FACE_ANGLE_STRUCT.pack(FACE_DIRECTION_CODES[face_direction],
+                                                FACE_INCLINATION_CODES[face_inclination]))
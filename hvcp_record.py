@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+"""
+Record the raw byte stream of a HvcP session and replay it later
+through the same read_data/decode_detection code, without a sensor.
+
+A recording is an append-only file:
+  magic (8 bytes, "HVCPREC1")
+  records: direction (1 byte, 0 sent / 1 received), timestamp (8 bytes double),
+           length (4 bytes), data (length bytes)
+and an index next to it (<path>.idx): the file offset (8 bytes) of every sent
+record, so exchange N (a command and the bytes received after it) can be found
+without reading anything before it. Both files are memory mapped to replay.
+The sensor answers in order, so the response to command N is the N-th
+response received, wherever it is (the commands may have been pipelined,
+e.g. by hvcp_worker.HvcPWorker, several of them before their responses).
+
+Usage:
+    sensor = HvcP(ser=RecordingSerial(serial.Serial("/dev/ttyUSB0", 921600, timeout=5), "session.hvcprec"))
+    ... use sensor as usual, then sensor.ser.close()
+
+    for frame in replay_detections("session.hvcprec", start=5000):
+        print(frame["frame"], frame["detections"])
+    # or feed any HvcP code in real time
+    sensor = HvcP(ser=ReplaySerial(Recording("session.hvcprec"), realtime=True))
+"""
+
+import io
+import mmap
+import os
+import struct
+import threading
+import time
+
+from hvcp_decoder import decode_detection
+from hvcp_framing import FrameReader
+from hvcp_protocol import COMMAND_HEADER_STRUCT, FramingError, check_detection_size
+
+MAGIC = b"HVCPREC1"
+RECORD_STRUCT = struct.Struct("<BdI")
+INDEX_STRUCT = struct.Struct("<Q")
+SENT = 0
+RECEIVED = 1
+TRACE_MAGIC = b"HVCPTRC1"
+TRACE_RECORD_STRUCT = struct.Struct("<BQI")
+
+
+class RecordingSerial(object):
+    """
+    Wrap a transport (e.g. serial.Serial) recording everything written and read
+    """
+    def __init__(self, ser, path):
+        """
+        :param ser: transport to record
+        :param path: str, recording file, appended to if it exists
+        """
+        self.ser = ser
+        self.path = path
+        self._file = io.open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._index = io.open(path + ".idx", "ab")
+
+    def _record(self, direction, data):
+        if direction == SENT:
+            self._index.write(INDEX_STRUCT.pack(self._file.tell()))
+        self._file.write(RECORD_STRUCT.pack(direction, time.time(), len(data)))
+        self._file.write(data)
+
+    def write(self, data):
+        self._record(SENT, data)
+        return self.ser.write(data)
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        if data:
+            self._record(RECEIVED, data)
+        return data
+
+    def readinto(self, buffer):
+        bytes_read = self.ser.readinto(buffer)
+        if bytes_read:
+            self._record(RECEIVED, memoryview(buffer)[:bytes_read])
+        return bytes_read
+
+    def close(self):
+        self._file.close()
+        self._index.close()
+        self.ser.close()
+
+    def __getattr__(self, name):
+        # Everything else (flushInput, isOpen, baudrate...) goes to the transport
+        return getattr(self.ser, name)
+
+
+def build_index(path):
+    """
+    Rebuild <path>.idx by scanning the recording, e.g. if it was lost
+    """
+    with io.open(path, "rb") as recording:
+        data = recording.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(path + " is not a hvcp recording")
+    with io.open(path + ".idx", "wb") as index:
+        offset = len(MAGIC)
+        while offset + RECORD_STRUCT.size <= len(data):
+            direction, timestamp, length = RECORD_STRUCT.unpack_from(data, offset)
+            if direction == SENT:
+                index.write(INDEX_STRUCT.pack(offset))
+            offset += RECORD_STRUCT.size + length
+
+
+class Recording(object):
+    """
+    Memory mapped read access to a recording
+    """
+    def __init__(self, path):
+        if not os.path.exists(path + ".idx"):
+            build_index(path)
+        self.path = path
+        self._file = io.open(path, "rb")
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(path + " is not a hvcp recording")
+        self._index_file = io.open(path + ".idx", "rb")
+        if os.fstat(self._index_file.fileno()).st_size:
+            self.index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.index = b''
+        self.size = len(self.data)
+        self._responses = None
+
+    def __len__(self):
+        """
+        :return: int, number of exchanges (commands sent)
+        """
+        return len(self.index) // INDEX_STRUCT.size
+
+    def offset(self, exchange_idx):
+        """
+        :return: int, file offset of the command of the exchange
+        """
+        offset, = INDEX_STRUCT.unpack_from(self.index, exchange_idx * INDEX_STRUCT.size)
+        return offset
+
+    def record(self, offset):
+        """
+        :return: direction, timestamp, data offset, data length of the record at offset
+        """
+        direction, timestamp, length = RECORD_STRUCT.unpack_from(self.data, offset)
+        return direction, timestamp, offset + RECORD_STRUCT.size, length
+
+    def exchange(self, exchange_idx):
+        """
+        :return: timestamp, command (bytes), received (bytes) of the exchange
+        """
+        direction, timestamp, data_offset, length = self.record(self.offset(exchange_idx))
+        command = self.data[data_offset:data_offset + length]
+        received = []
+        offset = data_offset + length
+        while offset < self.size:
+            direction, record_timestamp, data_offset, length = self.record(offset)
+            if direction == SENT:
+                break
+            received.append(self.data[data_offset:data_offset + length])
+            offset = data_offset + length
+        return timestamp, command, b''.join(received)
+
+    def responses(self):
+        """
+        Scan the received bytes for the response frames (once, then memoised)
+        :return: list of the positions (see ReplaySerial.tell) of every response
+                 received, in order, any garbage before it included
+        """
+        if self._responses is None:
+            scanner = ReplaySerial(self)
+            frames = FrameReader(scanner)
+            responses = []
+            while True:
+                position = scanner.tell()
+                response_code, data_len = frames.read_header()
+                if response_code is None or frames.read_payload(data_len) is None:
+                    break
+                responses.append(position)
+            self._responses = responses
+        return self._responses
+
+    def close(self):
+        self.data.close()
+        if len(self.index):
+            self.index.close()
+        self._file.close()
+        self._index_file.close()
+
+
+class ReplaySerial(object):
+    """
+    Transport that serves the bytes received in a recording. Writes are
+    ignored: reads go on with what the sensor sent next in the recording.
+    """
+    def __init__(self, recording, realtime=False, speed=1.0):
+        """
+        :param recording: Recording
+        :param realtime: bool, deliver the bytes with the recorded timing
+        :param speed: float, with realtime, how many times faster than recorded
+        """
+        self.recording = recording
+        self.realtime = realtime
+        self.speed = speed
+        self.seek(0)
+
+    def seek(self, exchange_idx, reset_clock=True):
+        """
+        Go to the response of the exchange exchange_idx
+        :param reset_clock: bool, with realtime, replay from here as if it was now
+        """
+        self._pos = 0
+        if exchange_idx >= len(self.recording):
+            self._offset = self.recording.size
+            return
+        self._offset = self.recording.offset(exchange_idx)
+        if reset_clock:
+            self._reset_clock()
+
+    def seek_response(self, response_idx, reset_clock=True):
+        """
+        Go to the response_idx-th response of the recording, see Recording.responses
+        """
+        responses = self.recording.responses()
+        if response_idx >= len(responses):
+            self._offset, self._pos = self.recording.size, 0
+            return
+        self._offset, self._pos = responses[response_idx]
+        if reset_clock:
+            self._reset_clock()
+
+    def tell(self):
+        """
+        :return: (file offset of the record, position in it) of the next byte to read
+        """
+        return self._offset, self._pos
+
+    def _reset_clock(self):
+        self._replay_start = time.time()
+        self._recording_start = self.recording.record(self._offset)[1]
+
+    def _wait(self, timestamp):
+        wait = (self._replay_start + (timestamp - self._recording_start) / self.speed) - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+    def readinto(self, buffer):
+        recording = self.recording
+        filled = 0
+        while filled < len(buffer) and self._offset < recording.size:
+            direction, timestamp, data_offset, length = recording.record(self._offset)
+            if direction == RECEIVED:
+                if self.realtime and self._pos == 0:
+                    self._wait(timestamp)
+                chunk = min(len(buffer) - filled, length - self._pos)
+                start = data_offset + self._pos
+                buffer[filled:filled + chunk] = recording.data[start:start + chunk]
+                filled += chunk
+                self._pos += chunk
+                if self._pos < length:
+                    continue
+            self._offset = data_offset + length
+            self._pos = 0
+        return filled
+
+    def read(self, size=1):
+        buffer = bytearray(size)
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def write(self, data):
+        return len(data)
+
+    def flushInput(self):
+        pass
+
+    def flushOutput(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def isOpen(self):
+        return True
+
+    def close(self):
+        self.recording.close()
+
+
+class DatagramTrace(object):
+    """
+    Compact binary trace of the datagrams of a HvcP (see HvcP.enable_trace):
+      magic (8 bytes, "HVCPTRC1")
+      records: direction (1 byte, 0 sent / 1 received), time.perf_counter_ns
+               (8 bytes), length (4 bytes), datagram (length bytes: the command,
+               or the response header and payload)
+    Unlike a recording, it holds whole datagrams, timed to the nanosecond.
+    """
+    def __init__(self, path):
+        """
+        :param path: str, trace file, appended to if it exists
+        """
+        self.path = path
+        self._file = io.open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(TRACE_MAGIC)
+        # The worker sends and reads from two threads
+        self._lock = threading.Lock()
+
+    def __call__(self, direction, timestamp_ns, data):
+        with self._lock:
+            self._file.write(TRACE_RECORD_STRUCT.pack(direction, timestamp_ns, len(data)))
+            self._file.write(data)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_trace(path):
+    """
+    :return: generator of (direction, perf_counter_ns, datagram bytes)
+    """
+    with io.open(path, "rb") as trace_file:
+        data = trace_file.read()
+    if data[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+        raise ValueError(path + " is not a hvcp trace")
+    offset = len(TRACE_MAGIC)
+    while offset + TRACE_RECORD_STRUCT.size <= len(data):
+        direction, timestamp_ns, length = TRACE_RECORD_STRUCT.unpack_from(data, offset)
+        offset += TRACE_RECORD_STRUCT.size
+        yield direction, timestamp_ns, data[offset:offset + length]
+        offset += length
+
+
+def replay_detections(path, start=0, stop=None, realtime=False, speed=1.0):
+    """
+    Decode the detection execution responses of a recording, through HvcP.read_data,
+    skipping those that do not match their command (see check_detection_size)
+    :param path: str, recording
+    :param start: int, first exchange to replay
+    :param stop: int, exchange to stop at (None = end)
+    :return: generator of {'frame': exchange index, 'timestamp': recorded time,
+             'detections': dict as returned by HvcP.detection_execution}
+    """
+    from hvcp import HvcP
+    recording = Recording(path)
+    replay = ReplaySerial(recording, realtime=realtime, speed=speed)
+    sensor = HvcP(ser=replay)
+    if stop is None:
+        stop = len(recording)
+    reset_clock = True
+    try:
+        for exchange_idx in range(start, stop):
+            direction, timestamp, data_offset, length = recording.record(recording.offset(exchange_idx))
+            sync, command_code, data_len = COMMAND_HEADER_STRUCT.unpack_from(recording.data, data_offset)
+            if command_code != 0x03:
+                continue
+            bitmasks = struct.unpack_from("<BBB", recording.data, data_offset + COMMAND_HEADER_STRUCT.size)
+            replay.seek_response(exchange_idx, reset_clock=reset_clock)
+            reset_clock = False
+            response_code, data = sensor.read_data()
+            if data is None:
+                continue
+            try:
+                check_detection_size(data, *bitmasks)
+            except FramingError as e:
+                sensor.logger.warning("Skipping the response to exchange %d: %s" % (exchange_idx, e))
+                continue
+            yield {"frame": exchange_idx,
+                   "timestamp": timestamp,
+                   "detections": decode_detection(data, *bitmasks)}
+    finally:
+        recording.close()
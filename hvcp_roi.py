@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+Regions of interest of the sensor images.
+
+The detections (coordinates in the 1600x1200 camera frame) locate the
+parts of the image worth keeping. RoiExtractor crops the square around
+every detection of the chosen categories, plus a margin, out of the image
+of the same frame with numpy slicing: every crop is a view of the image
+buffer (of the ImageRing slot when one is used), nothing is copied. A
+max_size downsamples the crops by taking every n-th pixel, still a view.
+
+The image mode is chosen from what the consumers need: each one calls
+require(min_size) with the smallest side (pixels) it can use, and the
+160x120 image is requested on the next frame as long as every region of
+the current one is at least that big in it, the 320x240 image otherwise.
+
+Usage:
+    extractor = RoiExtractor(categories=("face",), margin=0.2, max_size=48)
+    extractor.require(32)
+    for frame in extractor.stream(sensor, image_ring=ImageRing(slots=4)):
+        for roi in frame["rois"]:
+            face = roi["image"]  # numpy view, copy it to keep it after the release
+        frame["detections"]["image"]["slot"].release()
+"""
+
+import numpy as np
+
+from hvcp_decoder import SENSOR_WIDTH, detection_box
+from hvcp_protocol import detection_command
+
+IMAGE_WIDTHS = {"big": 320, "small": 160}
+
+
+def image_array(image):
+    """
+    :param image: 'image' dict of the detections
+    :return: numpy (height, width) uint8 view of the image, no copy
+    """
+    if "slot" in image:
+        return image["slot"].array()
+    return np.frombuffer(image["data"], dtype=np.uint8).reshape(image["height"], image["width"])
+
+
+def region(result, scale, margin=0.0, width=None, height=None):
+    """
+    :param result: detection dict (coord_x, coord_y, detect_size)
+    :param scale: float, image pixels per camera frame pixel (image width / 1600)
+    :param margin: float, added on each side, as a fraction of detect_size
+    :param width: int, clip the region to the image width
+    :param height: int, clip the region to the image height
+    :return: (x1, y1, x2, y2) in image pixels, x2 and y2 excluded
+    """
+    x1, y1, x2, y2 = detection_box(result, scale, margin)
+    x1 = max(int(x1), 0)
+    y1 = max(int(y1), 0)
+    x2 = int(x2 + 0.5)
+    y2 = int(y2 + 0.5)
+    if width is not None:
+        x2 = min(x2, width)
+    if height is not None:
+        y2 = min(y2, height)
+    return x1, y1, x2, y2
+
+
+def crop(image_np, box, max_size=None):
+    """
+    :param image_np: numpy (height, width) image
+    :param box: (x1, y1, x2, y2), see region
+    :param max_size: int, take every n-th pixel so that no side is bigger
+    :return: numpy view of the region
+    """
+    x1, y1, x2, y2 = box
+    step = 1
+    if max_size:
+        step = max(-(-max(x2 - x1, y2 - y1) // max_size), 1)
+    return image_np[y1:y2:step, x1:x2:step]
+
+
+class RoiExtractor(object):
+    def __init__(self, categories=("face",), margin=0.2, max_size=None, min_size=None):
+        """
+        :param categories: detection categories to crop ("body", "hand", "face")
+        :param margin: float, added around each detection, fraction of its detect_size
+        :param max_size: int, downsample the crops to at most this many pixels per side
+        :param min_size: int, see require
+        """
+        self.categories = categories
+        self.margin = margin
+        self.max_size = max_size
+        self.min_size = None
+        # Commands by image mode and mode of the frame in flight, see stream
+        self._commands = None
+        self._mode = None
+        if min_size is not None:
+            self.require(min_size)
+
+    def require(self, min_size):
+        """
+        Declare the smallest crop side (image pixels) a consumer needs,
+        the biggest of all the requirements is kept
+        """
+        self.min_size = min_size if self.min_size is None else max(self.min_size, min_size)
+
+    def regions(self, detections, width, height):
+        """
+        :return: list of (category, index, detection dict, box) within a width x height image
+        """
+        scale = float(width) / SENSOR_WIDTH
+        return [(category, idx, result, region(result, scale, self.margin, width, height))
+                for category in self.categories
+                for idx, result in enumerate(detections.get(category, ()))]
+
+    def crop(self, detections):
+        """
+        :param detections: dict as returned by HvcP.detection_execution, with an image
+        :return: list of {'category', 'index', 'box', 'image'} dicts, the image being
+                 a numpy view of the frame image (valid until its slot is released)
+        """
+        image = detections.get("image")
+        if image is None:
+            return []
+        image_np = image_array(image)
+        return [{"category": category, "index": idx, "box": box,
+                 "image": crop(image_np, box, self.max_size)}
+                for category, idx, result, box in self.regions(detections,
+                                                               image["width"], image["height"])]
+
+    def image_mode(self, detections):
+        """
+        :param detections: dict of the latest frame, None if there is none yet
+        :return: str, "small" if every region of the detections is at least
+                 min_size in the small image (or nothing is required), else "big"
+        """
+        if self.min_size is None:
+            return "small"
+        if detections is None:
+            return "big"
+        width = IMAGE_WIDTHS["small"]
+        scale = float(width) / SENSOR_WIDTH
+        for category in self.categories:
+            for result in detections.get(category, ()):
+                if result["detect_size"] * (1 + 2 * self.margin) * scale < self.min_size:
+                    return "big"
+        return "small"
+
+    def next_command(self, detections):
+        """
+        hvcp.HvcP.stream hook: request the image mode the frame needs
+        (the mode is kept after a frame that could not be read)
+        """
+        if detections is not None or self._mode is None:
+            self._mode = self.image_mode(detections)
+        return self._commands[self._mode]
+
+    def stream(self, sensor, frames=None, image_ring=None, **flags):
+        """
+        Run the detection continuously, as HvcP.stream, with the image mode of
+        each frame chosen from the frame before (decoded before sending the
+        next command), and crop the regions of every frame
+        :param sensor: HvcP
+        :param frames: int, number of frames to capture (None = forever)
+        :param image_ring: hvcp_image.ImageRing, see HvcP.detection_execution
+        :param flags: detection flags as in detection_execution (except the image ones)
+        :return: generator of {'frame', 'timestamp', 'fps', 'errors', 'image_mode',
+                 'detections', 'rois'} dicts
+        """
+        self._commands = {"big": detection_command(image_bit=True, **flags),
+                          "small": detection_command(image_bit_small=True, **flags)}
+        self._mode = None
+        for frame in sensor.stream(frames=frames, image_ring=image_ring,
+                                   next_command=self.next_command):
+            detections = frame["detections"]
+            frame["image_mode"] = "big" if detections["image"]["width"] == IMAGE_WIDTHS["big"] else "small"
+            frame["rois"] = self.crop(detections)
+            yield frame
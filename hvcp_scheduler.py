@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+Adaptive scheduling of the face estimators of the detection execution.
+
+Every face estimator (orientation, age, gender, gaze, eyes closed,
+expression) makes the sensor work longer and the response bigger, while
+their results change slowly. FeatureScheduler runs the body/hand/face
+detection alone on most frames and only enables the estimators:
+  - every `every` frames,
+  - when faces are present and the faces changed since the last
+    estimation (a face appeared, left, or moved too far).
+No estimator runs while there is no face.
+The latest estimations are merged into every frame, matching each face
+to the nearest estimated face.
+
+Usage:
+    scheduler = FeatureScheduler(sensor, every=10, gaze=False)
+    for frame in scheduler.stream():
+        # frame["estimated"] is True when the estimators ran on this frame,
+        # every face with an estimation has its keys as in detection_execution
+        # plus "estimation_frame", the frame the estimation comes from
+        print(frame["frame"], frame["detections"]["face"])
+"""
+
+import math
+
+from hvcp_protocol import detection_command
+
+# detection_execution flag: key of its estimation in the face dicts
+ESTIMATORS = (("face_orientation", "face_orientation"),
+              ("age", "age_estimation"),
+              ("gender", "gender_estimation"),
+              ("gaze", "gaze_estimation"),
+              ("eyes_closed", "eyes_estimation"),
+              ("facial_expression", "facial_expression"))
+
+
+class FeatureScheduler(object):
+    def __init__(self, sensor, every=10, on_change=True, max_distance=None,
+                 hand_detection=True, human_body_detection=True,
+                 image_bit=False, image_bit_small=False, **estimators):
+        """
+        :param sensor: HvcP
+        :param every: int, run the estimators at least every this many frames
+        :param on_change: bool, also run them as soon as the faces changed
+        :param max_distance: int, max distance (1600x1200 coordinates) between a face
+                             and an estimated face to be considered the same one,
+                             None = the detect_size of the face
+        :param estimators: estimator flags as in detection_execution (face_orientation,
+                           age, gender, gaze, eyes_closed, facial_expression), all
+                           enabled by default
+        """
+        self.sensor = sensor
+        self.every = every
+        self.on_change = on_change
+        self.max_distance = max_distance
+        flags = dict((flag, estimators.pop(flag, True)) for flag, key in ESTIMATORS)
+        if estimators:
+            raise TypeError("Unknown estimators: " + ", ".join(sorted(estimators)))
+        self.estimation_keys = [key for flag, key in ESTIMATORS if flags[flag]]
+        common = dict(face_detection=True, hand_detection=hand_detection,
+                      human_body_detection=human_body_detection,
+                      image_bit=image_bit, image_bit_small=image_bit_small)
+        no_estimators = dict((flag, False) for flag, key in ESTIMATORS)
+        self.detection_command = detection_command(**dict(common, **no_estimators))
+        self.estimation_command = detection_command(**dict(common, **flags))
+        # Faces of the latest estimation, following the faces detected since:
+        # list of (coord_x, coord_y, estimation dict, frame of the estimation)
+        self._estimated = []
+        self._last_estimation = None
+        self.estimations = 0
+        # Command of the frame in flight, and if the latest frame was estimated
+        self._command = None
+        self._frame_idx = 0
+        self.estimated = False
+
+    def _match(self, face):
+        """
+        :return: index in self._estimated of the nearest estimated face, None if too far
+        """
+        max_distance = self.max_distance
+        if max_distance is None:
+            max_distance = face["detect_size"]
+        best_idx = None
+        best_distance = max_distance
+        for idx, (coord_x, coord_y, estimation, frame_idx) in enumerate(self._estimated):
+            distance = math.hypot(face["coord_x"] - coord_x, face["coord_y"] - coord_y)
+            if distance <= best_distance:
+                best_idx, best_distance = idx, distance
+        return best_idx
+
+    def _changed(self, faces):
+        """
+        :return: bool, True if the faces are not the ones last estimated
+        """
+        if len(faces) != len(self._estimated):
+            return True
+        return any(self._match(face) is None for face in faces)
+
+    def _needs_estimation(self, frame_idx, faces):
+        if not faces:
+            # Nothing to estimate, the next face to appear is a change
+            return False
+        if self._last_estimation is None or frame_idx - self._last_estimation >= self.every:
+            return True
+        return self.on_change and self._changed(faces)
+
+    def _store(self, frame_idx, faces):
+        self._estimated = [(face["coord_x"], face["coord_y"],
+                            dict((key, face[key]) for key in self.estimation_keys),
+                            frame_idx)
+                           for face in faces]
+        self._last_estimation = frame_idx
+        self.estimations += 1
+
+    def _merge(self, faces):
+        """
+        Add the latest estimations to the faces, the matched estimated faces
+        follow the faces to their new position
+        """
+        unmatched = list(range(len(self._estimated)))
+        for face in faces:
+            idx = self._match(face)
+            if idx is None or idx not in unmatched:
+                continue
+            unmatched.remove(idx)
+            coord_x, coord_y, estimation, frame_idx = self._estimated[idx]
+            face.update(estimation)
+            face["estimation_frame"] = frame_idx
+            self._estimated[idx] = (face["coord_x"], face["coord_y"], estimation, frame_idx)
+
+    def next_command(self, detections):
+        """
+        hvcp.HvcP.stream hook: keep or merge the estimations of the frame
+        and choose the command of the next one
+        :param detections: dict of the frame, None before the first frame
+                           or if the frame could not be read
+        :return: command, bitmask_1, bitmask_2, bitmask_3
+        """
+        faces = []
+        if detections is not None:
+            faces = detections["face"]
+            self.estimated = self._command is self.estimation_command
+            if self.estimated:
+                self._store(self._frame_idx, faces)
+            else:
+                self._merge(faces)
+            self._frame_idx += 1
+        elif self._command is None:
+            # First frame
+            self._command = self.estimation_command
+            return self._command
+        if self._needs_estimation(self._frame_idx, faces):
+            self._command = self.estimation_command
+        else:
+            self._command = self.detection_command
+        return self._command
+
+    def stream(self, frames=None, image_ring=None):
+        """
+        Run the detection continuously, as HvcP.stream. The command of each frame
+        is chosen from the faces of the frame before, which is decoded before
+        sending the next command.
+        :param frames: int, number of frames to capture (None = forever)
+        :param image_ring: hvcp_image.ImageRing, see HvcP.detection_execution
+        :return: generator of {'frame', 'timestamp', 'fps', 'errors', 'estimated',
+                 'detections'} dicts
+        """
+        self._command = None
+        self._frame_idx = 0
+        for frame in self.sensor.stream(frames=frames, image_ring=image_ring,
+                                        next_command=self.next_command):
+            frame["estimated"] = self.estimated
+            yield frame
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+
+"""
+Simulator of the HVC-P serial protocol, to run hvcp without a sensor
+(benchmarks, regression tests, CI).
+
+HvcPSimulator plays the device: it answers every command datagram with
+a correctly framed response, generating the requested number of bodies,
+hands and faces, the 320x240 or 160x120 image when it is asked for, and
+optionally injecting latency, dropped bytes and error response codes.
+
+It can be plugged into HvcP through:
+  - SimulatedSerial, an in-process file-like transport:
+        sensor = HvcP(ser=SimulatedSerial(HvcPSimulator(faces=35)))
+  - PtySimulator, a pty served by a thread, for anything that needs
+    a real port name (e.g. AsyncHvcP.open):
+        pty_sim = PtySimulator(HvcPSimulator()).start()
+        sensor = HvcP(tty=pty_sim.port)
+        ...
+        pty_sim.stop()
+"""
+
+import collections
+import os
+import random
+import select
+import struct
+import threading
+import time
+
+from hvcp_decoder import (HUMAN_BODY_DETECTION, HAND_DETECTION, FACE_DETECTION,
+                          FACE_ORIENTATION, AGE, GENDER, GAZE, EYES_CLOSED,
+                          FACIAL_EXPRESSION, IMAGE_BIG, IMAGE_SMALL,
+                          FACE_SEGMENTS, HEADER_STRUCT, RESULT_STRUCT,
+                          IMAGE_HEADER_STRUCT, face_layout)
+from hvcp_framing import RESPONSE_HEADER_STRUCT
+from hvcp_protocol import COMMAND_HEADER_STRUCT, response_codes_dict
+
+MAX_DETECTIONS = 35
+
+
+class CommandParser(object):
+    """
+    Split the byte stream written to the device into command datagrams
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        :param data: bytes received
+        :return: list of complete command datagrams (bytes)
+        """
+        self._buffer += data
+        commands = []
+        while True:
+            sync_idx = self._buffer.find(b'\xfe')
+            if sync_idx == -1:
+                del self._buffer[:]
+                break
+            del self._buffer[:sync_idx]
+            if len(self._buffer) < COMMAND_HEADER_STRUCT.size:
+                break
+            sync, command_code, data_len = COMMAND_HEADER_STRUCT.unpack_from(self._buffer)
+            end = COMMAND_HEADER_STRUCT.size + data_len
+            if len(self._buffer) < end:
+                break
+            commands.append(bytes(self._buffer[:end]))
+            del self._buffer[:end]
+        return commands
+
+
+class HvcPSimulator(object):
+    def __init__(self, bodies=1, hands=1, faces=1, latency=0.0,
+                 drop_rate=0.0, error_rate=0.0, error_codes=None, seed=None):
+        """
+        :param bodies: int, bodies detected per frame (0-35)
+        :param hands: int, hands detected per frame (0-35)
+        :param faces: int, faces detected per frame (0-35)
+        :param latency: float, seconds the device takes to answer a command
+        :param drop_rate: float, probability of dropping one byte of a response
+        :param error_rate: float, probability of answering with an error code
+        :param error_codes: list of int, codes to pick from when answering with
+                            an error (default: all the non OK codes of response_codes_dict)
+        :param seed: random seed, to make the drops and errors reproducible
+        """
+        self.bodies = min(bodies, MAX_DETECTIONS)
+        self.hands = min(hands, MAX_DETECTIONS)
+        self.faces = min(faces, MAX_DETECTIONS)
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.error_rate = error_rate
+        if error_codes is None:
+            error_codes = sorted(int(code, 16) for code in response_codes_dict if code != '00')
+        self.error_codes = error_codes
+        self.random = random.Random(seed)
+        self.frame_idx = 0
+        self.version = b'HVC-P       ' + struct.pack("<bbb", 1, 0, 10) + b'\x7b\x04\x00\x00'
+        # Payload returned by each read command, the setters (read code - 1) update it
+        self.config = {0x02: struct.pack("<B", 0),
+                       0x06: struct.pack("<hhhh", 500, 500, 500, 0),
+                       0x08: struct.pack("<hhhhhh", 30, 8192, 40, 8192, 64, 8192),
+                       0x0A: struct.pack("<BB", 0, 0)}
+        self._images = {}
+        self._face_values = {(0, FACE_DETECTION): self._face_detection_values,
+                             (0, FACE_ORIENTATION): lambda idx: (idx % 20 - 10, 5, 0, 600),
+                             (0, AGE): lambda idx: (20 + idx % 50, 500),
+                             (0, GENDER): lambda idx: (idx % 2, 700),
+                             (0, GAZE): lambda idx: (idx % 10 - 5, 3),
+                             (0, EYES_CLOSED): lambda idx: (100, 200),
+                             (1, FACIAL_EXPRESSION): lambda idx: (1 + idx % 5, 80, 10)}
+
+    def response(self, response_code, data=b''):
+        return RESPONSE_HEADER_STRUCT.pack(0xFE, response_code, len(data)) + data
+
+    def respond(self, command):
+        """
+        :param command: bytes, a full command datagram
+        :return: bytes, the full response datagram
+        """
+        sync, command_code, data_len = COMMAND_HEADER_STRUCT.unpack_from(command)
+        payload = command[COMMAND_HEADER_STRUCT.size:]
+        if self.error_rate and self.random.random() < self.error_rate:
+            return self.response(self.random.choice(self.error_codes))
+
+        if command_code == 0x00:
+            data = self.version
+        elif command_code == 0x03:
+            data = self.detection_payload(*struct.unpack_from("<BBB", payload))
+        elif command_code in (0x01, 0x05, 0x07, 0x09):
+            self.config[command_code + 1] = payload
+            data = b''
+        elif command_code in self.config:
+            data = self.config[command_code]
+        else:
+            return self.response(0xFF)
+
+        response = self.response(0x00, data)
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            drop_idx = self.random.randrange(len(response))
+            response = response[:drop_idx] + response[drop_idx + 1:]
+        return response
+
+    def _result_values(self, idx, row):
+        # Objects spread over the 1600x1200 frame, slowly moving to the right
+        return ((100 + idx * 40 + self.frame_idx * 3) % 1600,
+                (100 + row * 300 + idx * 20) % 1200,
+                100 + (idx % 5) * 20,
+                500 + (idx * 10) % 500)
+
+    def _face_detection_values(self, idx):
+        return self._result_values(idx, 2)
+
+    def image(self, width, height):
+        """
+        :return: bytes, width x height grayscale gradient
+        """
+        key = (width, height)
+        if key not in self._images:
+            self._images[key] = bytes(bytearray((x + y) & 0xFF
+                                                for y in range(height)
+                                                for x in range(width)))
+        return self._images[key]
+
+    def detection_payload(self, bitmask_1, bitmask_2, bitmask_3):
+        """
+        :return: bytes, payload of the response to a detection execution
+        """
+        self.frame_idx += 1
+        body_n = self.bodies if bitmask_1 & HUMAN_BODY_DETECTION else 0
+        hand_n = self.hands if bitmask_1 & HAND_DETECTION else 0
+        face_n = self.faces if bitmask_1 & FACE_DETECTION else 0
+
+        parts = [HEADER_STRUCT.pack(body_n, hand_n, face_n)]
+        for idx in range(body_n):
+            parts.append(RESULT_STRUCT.pack(*self._result_values(idx, 0)))
+        for idx in range(hand_n):
+            parts.append(RESULT_STRUCT.pack(*self._result_values(idx, 1)))
+
+        layout = face_layout(bitmask_1, bitmask_2)
+        enabled = [self._face_values[(mask_idx, bit)]
+                   for mask_idx, bit, seg_fmt, builder in FACE_SEGMENTS
+                   if (bitmask_1, bitmask_2)[mask_idx] & bit]
+        for idx in range(face_n):
+            values = []
+            for face_values in enabled:
+                values.extend(face_values(idx))
+            parts.append(layout.struct.pack(*values))
+
+        if bitmask_3 & (IMAGE_BIG | IMAGE_SMALL):
+            width, height = (320, 240) if bitmask_3 & IMAGE_BIG else (160, 120)
+            parts.append(IMAGE_HEADER_STRUCT.pack(width, height))
+            parts.append(self.image(width, height))
+        return b''.join(parts)
+
+    def response_delay(self, response, baudrate=None):
+        """
+        :return: float, seconds from the command until the full response is received
+        """
+        delay = self.latency
+        if baudrate:
+            # 8N1: 10 bits per byte
+            delay += len(response) * 10.0 / baudrate
+        return delay
+
+
+class SimulatedSerial(object):
+    """
+    In-process transport with the subset of serial.Serial used by HvcP.
+    When there is nothing more to receive, reads return right away
+    with what is available instead of waiting for the timeout.
+    """
+    def __init__(self, simulator, timeout=5, baudrate=None):
+        """
+        :param simulator: HvcPSimulator
+        :param timeout: float, max seconds a read waits for a delayed response
+        :param baudrate: int, if given the transfer time of every response is simulated
+        """
+        self.simulator = simulator
+        self.timeout = timeout
+        self.baudrate = baudrate
+        self._parser = CommandParser()
+        # (time when it is fully received, response)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._open = True
+        self._busy_until = 0.0
+
+    def write(self, data):
+        for command in self._parser.feed(data):
+            response = self.simulator.respond(command)
+            # The device answers the commands one after the other
+            start = max(time.time(), self._busy_until)
+            self._busy_until = start + self.simulator.response_delay(response, self.baudrate)
+            self._pending.append((self._busy_until, response))
+        return len(data)
+
+    def _receive(self, size):
+        deadline = time.time() + self.timeout
+        while len(self._buffer) < size and self._pending:
+            ready_time, response = self._pending[0]
+            wait = ready_time - time.time()
+            if wait > 0:
+                if ready_time > deadline:
+                    time.sleep(max(deadline - time.time(), 0))
+                    break
+                time.sleep(wait)
+            self._buffer += response
+            self._pending.popleft()
+
+    def read(self, size=1):
+        self._receive(size)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        now = time.time()
+        return len(self._buffer) + sum(len(response) for ready_time, response in self._pending
+                                       if ready_time <= now)
+
+    def flushInput(self):
+        self._buffer = bytearray()
+        self._pending.clear()
+
+    def flushOutput(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def isOpen(self):
+        return self._open
+
+    def close(self):
+        self._open = False
+
+
+class PtySimulator(object):
+    """
+    Serve a HvcPSimulator on the master side of a pty, the slave side
+    (port) can be opened as a serial port.
+    """
+    def __init__(self, simulator, baudrate=None):
+        """
+        :param simulator: HvcPSimulator
+        :param baudrate: int, if given the transfer time of every response is simulated
+        """
+        self.simulator = simulator
+        self.baudrate = baudrate
+        self.port = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        import pty
+        import tty
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _serve(self):
+        parser = CommandParser()
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            for command in parser.feed(data):
+                response = self.simulator.respond(command)
+                delay = self.simulator.response_delay(response, self.baudrate)
+                if delay:
+                    time.sleep(delay)
+                written = 0
+                while written < len(response):
+                    written += os.write(self.master, response[written:])
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self.master)
+        os.close(self.slave)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""
+Image sink: encode and store the sensor images off the capture thread.
+
+The capture thread only puts the frames in a bounded queue (put never
+waits unless the drop policy is "block"); a pool of worker threads
+converts them (optionally drawing the detection boxes), encodes them as
+JPEG, PNG or raw grayscale bytes and hands them to an output, e.g. a
+RotatingFileWriter. When the workers fall behind, the drop policy
+decides which frames are lost:
+  "oldest"  drop the oldest queued frame to make room (keeps the latest)
+  "newest"  drop the incoming frame
+  "block"   make the capture wait
+
+Images read into an hvcp_image.ImageRing are not copied: the sink
+releases their slot once encoded (or dropped). HvcP.stream takes the
+slots through ImageSink.acquire, so a ring exhausted by the queued
+images is handled by the drop policy too instead of stopping the capture.
+
+Usage:
+    sink = ImageSink(RotatingFileWriter("images", max_files=500), encoding="jpeg", annotate=True)
+    for frame in sensor.stream(image_bit=True, image_ring=ImageRing(slots=8)):
+        sink.put(frame["frame"], frame["detections"])
+    sink.close()
+    print(sink.stats())
+"""
+
+import collections
+import os
+import queue
+import threading
+
+from hvcp_decoder import SENSOR_WIDTH, detection_box
+
+ENCODINGS = {"jpeg": ".jpg", "png": ".png", "raw": ".raw"}
+DROP_POLICIES = ("oldest", "newest", "block")
+BOX_COLORS = {"body": (255, 0, 0), "hand": (0, 255, 0), "face": (0, 0, 255)}
+
+
+class RotatingFileWriter(object):
+    """
+    Output writing every image to its own file, keeping only the latest max_files
+    """
+    def __init__(self, directory, prefix="frame", max_files=1000):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_files = max_files
+        self._files = collections.deque()
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __call__(self, frame_idx, data, extension):
+        path = os.path.join(self.directory, "%s_%08d%s" % (self.prefix, frame_idx, extension))
+        with open(path, "wb") as image_file:
+            image_file.write(data)
+        with self._lock:
+            self._files.append(path)
+            expired = []
+            while len(self._files) > self.max_files:
+                expired.append(self._files.popleft())
+        for path in expired:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def annotate(image, detections):
+    """
+    :param image: numpy (height, width) uint8 grayscale image
+    :param detections: dict as returned by HvcP.detection_execution
+    :return: numpy (height, width, 3) BGR image with the detection boxes drawn
+    """
+    import cv2
+    color_image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    scale = float(image.shape[1]) / SENSOR_WIDTH
+    for category, color in BOX_COLORS.items():
+        for result in detections.get(category, ()):
+            x1, y1, x2, y2 = detection_box(result, scale)
+            cv2.rectangle(color_image, (int(x1), int(y1)), (int(x2), int(y2)), color, 1)
+    return color_image
+
+
+class ImageSink(object):
+    def __init__(self, output, encoding="jpeg", workers=2, max_pending=8,
+                 drop_policy="oldest", annotate=False, jpeg_quality=90):
+        """
+        :param output: function(frame_idx, data, extension) storing every encoded
+                       image, e.g. RotatingFileWriter
+        :param encoding: str, one of "jpeg", "png", "raw"
+        :param workers: int, encoding threads (OpenCV releases the GIL while encoding)
+        :param max_pending: int, images waiting to be encoded before dropping
+        :param drop_policy: str, one of "oldest", "newest", "block"
+        :param annotate: bool, draw the detection boxes on the images
+        :param jpeg_quality: int, 0-100
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError("encoding can only be one of " + ", ".join(sorted(ENCODINGS)))
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError("drop_policy can only be one of " + ", ".join(DROP_POLICIES))
+        self.output = output
+        self.encoding = encoding
+        self.drop_policy = drop_policy
+        self.annotate = annotate
+        self.jpeg_quality = jpeg_quality
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._stats_lock = threading.Lock()
+        self._stats = {"submitted": 0, "dropped": 0, "encoded": 0, "errors": 0,
+                       "ring_exhausted": 0}
+        self._released = threading.Condition()
+        self._workers = [threading.Thread(target=self._work) for _ in range(workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """
+        :return: dict with the images submitted, dropped, encoded, the
+                 encoding/output errors and the images read out of the image
+                 ring because it was exhausted (ring_exhausted)
+        """
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def acquire(self, image_ring):
+        """
+        Take a slot of image_ring to read the next image into. When every slot
+        is held by the sink, the drop policy applies: "oldest" drops the oldest
+        queued image to free its slot, "block" waits for a worker to release
+        one, "newest" (or "oldest" with nothing queued) gives no slot, the
+        image is then read as a copy.
+        :return: hvcp_image.ImageSlot, None if there is no free slot
+        """
+        while not image_ring.free_slots():
+            if self.drop_policy == "block":
+                with self._released:
+                    if not image_ring.free_slots():
+                        self._released.wait(0.1)
+                continue
+            if self.drop_policy == "oldest":
+                try:
+                    self._drop(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+            self._count("ring_exhausted")
+            return None
+        return image_ring.acquire()
+
+    def put(self, frame_idx, detections):
+        """
+        Queue the image of a frame, never waits unless the drop policy is "block"
+        :param frame_idx: int
+        :param detections: dict as returned by HvcP.detection_execution
+        :return: bool, False if the image was dropped (or there is no image)
+        """
+        image = detections.get("image")
+        if image is None:
+            return False
+        self._count("submitted")
+        item = (frame_idx, detections)
+        if self.drop_policy == "block":
+            self._queue.put(item)
+            return True
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return True
+            except queue.Full:
+                if self.drop_policy == "newest":
+                    self._drop(item)
+                    return False
+            try:
+                self._drop(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+    def _drop(self, item):
+        frame_idx, detections = item
+        self._release(detections)
+        self._count("dropped")
+
+    def _release(self, detections):
+        slot = detections["image"].get("slot")
+        if slot is not None:
+            with self._released:
+                slot.release()
+                self._released.notify()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            frame_idx, detections = item
+            try:
+                data = self.encode(detections)
+            except Exception:
+                self._count("errors")
+                continue
+            finally:
+                self._release(detections)
+            try:
+                self.output(frame_idx, data, ENCODINGS[self.encoding])
+                self._count("encoded")
+            except Exception:
+                self._count("errors")
+
+    def encode(self, detections):
+        """
+        :return: bytes, the image of the detections encoded
+        """
+        image = detections["image"]
+        if self.encoding == "raw" and not self.annotate:
+            if "slot" in image:
+                return image["slot"].data.tobytes()
+            return bytes(image["data"])
+        import numpy as np
+        if "slot" in image:
+            image_np = image["slot"].array()
+        else:
+            image_np = np.frombuffer(image["data"], dtype=np.uint8).reshape(image["height"],
+                                                                           image["width"])
+        if self.annotate:
+            image_np = annotate(image_np, detections)
+        if self.encoding == "raw":
+            return image_np.tobytes()
+        import cv2
+        if self.encoding == "jpeg":
+            ok, encoded = cv2.imencode(".jpg", image_np, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        else:
+            ok, encoded = cv2.imencode(".png", image_np)
+        if not ok:
+            raise ValueError("Could not encode the image as " + self.encoding)
+        return encoded.tobytes()
+
+    def close(self):
+        """
+        Encode the images still queued and stop the workers
+        """
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
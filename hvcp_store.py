@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""
+Columnar store of detection results for long running sessions.
+
+Every frame appended (a dict as returned by HvcP.detection_execution)
+goes into typed array.array columns, one set per category (body, hand,
+face), plus per category offsets telling which rows belong to each frame.
+A face takes ~35 bytes instead of the ~2KB of its nested dicts.
+
+Fields not requested to the sensor are stored as the minimum value of
+their type (MISSING). Gender and expression are stored as their codes
+(see hvcp_decoder.GENDERS and EXPRESSIONS).
+
+Usage:
+    store = DetectionStore()
+    for frame in sensor.stream():
+        store.append(frame["detections"], frame["timestamp"])
+    adults = store.filter("face", age=(18, None), reliability=(600, None))
+    faces = store.to_numpy("face")  # dict of numpy arrays, no copy
+"""
+
+import array
+
+from hvcp_decoder import GENDERS, EXPRESSIONS
+
+MISSING = {'b': -128, 'h': -32768}
+DTYPES = {'b': 'int8', 'h': 'int16', 'i': 'int32', 'd': 'float64'}
+
+GENDER_CODES = dict((name, code) for code, name in GENDERS.items())
+EXPRESSION_CODES = dict((name, code) for code, name in EXPRESSIONS.items())
+EXPRESSION_CODES["unknown"] = 0
+
+RESULT_COLUMNS = (("frame", 'i'),
+                  ("coord_x", 'h'),
+                  ("coord_y", 'h'),
+                  ("detect_size", 'h'),
+                  ("reliability", 'h'))
+
+# (column, typecode, estimation key in the face dict, field in the estimation)
+FACE_ESTIMATION_COLUMNS = (
+    ("left_and_right_direction", 'h', "face_orientation", "left_and_right_direction"),
+    ("vertical_angle", 'h', "face_orientation", "vertical_angle"),
+    ("face_inclination_angle", 'h', "face_orientation", "face_inclination_angle"),
+    ("orientation_reliability", 'h', "face_orientation", "reliability"),
+    ("age", 'b', "age_estimation", "age"),
+    ("age_reliability", 'h', "age_estimation", "reliability"),
+    ("gender", 'b', "gender_estimation", "gender"),
+    ("gender_reliability", 'h', "gender_estimation", "reliability"),
+    ("gaze_left_and_right", 'b', "gaze_estimation", "left_and_right_angle"),
+    ("gaze_up_and_down", 'b', "gaze_estimation", "up_and_down_angle"),
+    ("eyes_head_left", 'h', "eyes_estimation", "eyes_head_left"),
+    ("eyes_head_right", 'h', "eyes_estimation", "eyes_head_right"),
+    ("expression", 'b', "facial_expression", "expression"),
+    ("expression_top_score", 'b', "facial_expression", "top_score"),
+    ("expression_neg_pos_degree", 'b', "facial_expression", "neg_pos_degree"))
+
+CATEGORIES = ("body", "hand", "face")
+
+
+def face_estimation_values(face, missing=None):
+    """
+    :param face: face dict as returned by HvcP.detection_execution
+    :param missing: int, value of the estimations not requested
+                    (None = the MISSING value of the column type)
+    :return: tuple of the FACE_ESTIMATION_COLUMNS values of the face,
+             gender and expression as their codes
+    """
+    values = []
+    for name, typecode, key, field in FACE_ESTIMATION_COLUMNS:
+        estimation = face.get(key)
+        if estimation is None:
+            values.append(MISSING[typecode] if missing is None else missing)
+            continue
+        value = estimation[field]
+        if name == "gender":
+            value = GENDER_CODES.get(value, value)
+        elif name == "expression":
+            value = EXPRESSION_CODES.get(value, 0)
+        values.append(value)
+    return tuple(values)
+
+
+class DetectionStore(object):
+    def __init__(self):
+        self.timestamps = array.array('d')
+        self.columns = {}
+        self.typecodes = {}
+        # offsets[category][n]:offsets[category][n + 1] are the rows of frame n
+        self.offsets = {}
+        for category in CATEGORIES:
+            columns = list(RESULT_COLUMNS)
+            if category == "face":
+                columns += [(name, typecode) for name, typecode, key, field in FACE_ESTIMATION_COLUMNS]
+            self.columns[category] = dict((name, array.array(typecode)) for name, typecode in columns)
+            self.typecodes[category] = dict(columns)
+            self.offsets[category] = array.array('i', [0])
+
+    def __len__(self):
+        """
+        :return: int, number of frames stored
+        """
+        return len(self.timestamps)
+
+    def append(self, detections, timestamp=0.0):
+        """
+        Append a frame, all or nothing: if a column can not grow (a to_numpy
+        view of it is alive) BufferError is raised and the store is unchanged
+        :param detections: dict as returned by HvcP.detection_execution
+        :param timestamp: float, time of the frame
+        """
+        frame_idx = len(self.timestamps)
+        # (array, values) of every column, staged before touching any of them
+        rows = [(self.timestamps, [timestamp])]
+        for category in CATEGORIES:
+            columns = self.columns[category]
+            results = detections.get(category, ())
+            rows.append((columns["frame"], [frame_idx] * len(results)))
+            for name in ("coord_x", "coord_y", "detect_size", "reliability"):
+                rows.append((columns[name], [result[name] for result in results]))
+            if category == "face" and results:
+                face_rows = [face_estimation_values(face) for face in results]
+                rows.extend((columns[name], list(values))
+                            for (name, typecode, key, field), values
+                            in zip(FACE_ESTIMATION_COLUMNS, zip(*face_rows)))
+            offsets = self.offsets[category]
+            rows.append((offsets, [offsets[-1] + len(results)]))
+        grown = []
+        try:
+            for column, values in rows:
+                if values:
+                    length = len(column)
+                    column.extend(values)
+                    grown.append((column, length))
+        except BufferError:
+            for column, length in grown:
+                del column[length:]
+            raise
+
+    def frame_rows(self, category, frame_idx):
+        """
+        :return: start, stop rows of the category belonging to frame frame_idx
+        """
+        offsets = self.offsets[category]
+        return offsets[frame_idx], offsets[frame_idx + 1]
+
+    def nbytes(self):
+        """
+        :return: int, bytes used by the stored data
+        """
+        arrays = [self.timestamps]
+        for category in CATEGORIES:
+            arrays.extend(self.columns[category].values())
+            arrays.append(self.offsets[category])
+        return sum(len(column) * column.itemsize for column in arrays)
+
+    def to_numpy(self, category):
+        """
+        Numpy views of the columns of a category, no copy. The views must be
+        dropped before appending more frames (the arrays can not grow while
+        they are shared).
+        :return: dict of column name: numpy array
+        """
+        import numpy as np
+        typecodes = self.typecodes[category]
+        return dict((name, np.frombuffer(column, dtype=DTYPES[typecodes[name]]))
+                    for name, column in self.columns[category].items())
+
+    def filter(self, category, **ranges):
+        """
+        Rows of a category whose columns are in the given ranges, e.g.
+        store.filter("face", reliability=(500, None), age=(20, 40))
+        :param ranges: column name: (min, max), both inclusive, None for no limit
+        :return: dict of column name: numpy array (copies) of the matching rows
+        """
+        import numpy as np
+        columns = self.to_numpy(category)
+        mask = np.ones(len(columns["frame"]), dtype=bool)
+        for name, (low, high) in ranges.items():
+            column = columns[name]
+            if low is not None:
+                mask &= column >= low
+            if high is not None:
+                mask &= column <= high
+        return dict((name, column[mask]) for name, column in columns.items())
+
+    def to_parquet(self, category, path):
+        """
+        Write the columns of a category (and the frame timestamps) to a parquet file
+        (needs pyarrow)
+        """
+        import numpy as np
+        import pyarrow
+        import pyarrow.parquet
+        columns = self.to_numpy(category)
+        timestamps = np.frombuffer(self.timestamps, dtype='float64')
+        columns["timestamp"] = timestamps[columns["frame"]]
+        names = sorted(columns)
+        table = pyarrow.Table.from_arrays([pyarrow.array(columns[name]) for name in names], names=names)
+        pyarrow.parquet.write_table(table, path)
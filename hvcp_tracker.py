@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""
+Multi-object tracker for the detection results.
+
+The sensor detections have no identity. Tracker gives a stable track id
+to every body, hand and face across frames by associating each frame's
+detections with the current tracks of the same category:
+  - a detection is the square of side detect_size around (coord_x, coord_y),
+  - the IoU of all detection/track pairs is computed at once with numpy,
+  - pairs are matched greedily by decreasing IoU (min_iou at least),
+    which sorts the n x m pairs: O(nm log nm), ~1200 pairs at 35 objects.
+The face estimations are smoothed per track (age: exponential average,
+gender and expression: decaying votes weighted by their reliability/score),
+and an event is emitted when a track enters or exits.
+
+Usage:
+    tracker = Tracker()
+    for frame in sensor.stream():
+        result = tracker.update(frame["detections"], frame["timestamp"])
+        # every detection now has a 'track_id'
+        for event in result["events"]:
+            print(event["event"], event["category"], event["track_id"])
+        faces = result["tracks"]["face"]  # list of track dicts, see Track.as_dict
+"""
+
+import itertools
+
+import numpy as np
+
+CATEGORIES = ("body", "hand", "face")
+
+
+def boxes(results):
+    """
+    :param results: list of detection dicts
+    :return: numpy array of (x1, y1, x2, y2), one row per detection
+    """
+    values = np.array([(result["coord_x"], result["coord_y"], result["detect_size"])
+                       for result in results], dtype=np.float64).reshape(-1, 3)
+    half = values[:, 2:3] / 2
+    return np.hstack((values[:, :2] - half, values[:, :2] + half))
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """
+    :return: numpy array len(boxes_a) x len(boxes_b) of the IoU of every pair
+    """
+    a = boxes_a[:, np.newaxis, :]
+    b = boxes_b[np.newaxis, :, :]
+    width = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    height = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    intersection = width * height
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    union = area_a + area_b - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0.0)
+
+
+def greedy_match(scores, min_score):
+    """
+    Match rows and columns by decreasing score, each one at most once
+    :param scores: numpy array rows x columns
+    :return: list of (row, column)
+    """
+    if not scores.size:
+        return []
+    order = np.argsort(scores, axis=None)[::-1]
+    rows, columns = np.unravel_index(order, scores.shape)
+    used_rows = set()
+    used_columns = set()
+    matches = []
+    for row, column in zip(rows.tolist(), columns.tolist()):
+        if scores[row, column] < min_score:
+            break
+        if row in used_rows or column in used_columns:
+            continue
+        used_rows.add(row)
+        used_columns.add(column)
+        matches.append((row, column))
+    return matches
+
+
+class Track(object):
+    def __init__(self, track_id, category, result, frame_idx, timestamp):
+        self.track_id = track_id
+        self.category = category
+        self.first_seen = timestamp
+        self.hits = 0
+        self.missed = 0
+        self.age = None
+        self.gender_score = 0.0
+        self.expression_votes = {}
+        self.update(result, frame_idx, timestamp, 1.0)
+
+    def update(self, result, frame_idx, timestamp, smoothing):
+        """
+        :param smoothing: float, weight of the new estimations (1 = no smoothing)
+        """
+        self.result = result
+        self.last_frame = frame_idx
+        self.last_seen = timestamp
+        self.hits += 1
+        self.missed = 0
+
+        age = result.get("age_estimation")
+        if age is not None:
+            if self.age is None:
+                self.age = float(age["age"])
+            else:
+                self.age += smoothing * (age["age"] - self.age)
+
+        gender = result.get("gender_estimation")
+        if gender is not None:
+            sign = {"man": 1, "woman": -1}.get(gender["gender"], 0)
+            self.gender_score = (1 - smoothing) * self.gender_score + sign * gender["reliability"]
+
+        expression = result.get("facial_expression")
+        if expression is not None:
+            for name in self.expression_votes:
+                self.expression_votes[name] *= 1 - smoothing
+            self.expression_votes[expression["expression"]] = (
+                self.expression_votes.get(expression["expression"], 0.0) + expression["top_score"])
+
+    @property
+    def gender(self):
+        if self.gender_score > 0:
+            return "man"
+        if self.gender_score < 0:
+            return "woman"
+        return None
+
+    @property
+    def expression(self):
+        if not self.expression_votes:
+            return None
+        return max(self.expression_votes, key=self.expression_votes.get)
+
+    def as_dict(self):
+        """
+        :return: dict with track_id, category, the latest coord_x, coord_y,
+                 detect_size, reliability, first_seen, last_seen, hits and
+                 for faces the smoothed age, gender and expression
+        """
+        track = {"track_id": self.track_id,
+                 "category": self.category,
+                 "coord_x": self.result["coord_x"],
+                 "coord_y": self.result["coord_y"],
+                 "detect_size": self.result["detect_size"],
+                 "reliability": self.result["reliability"],
+                 "first_seen": self.first_seen,
+                 "last_seen": self.last_seen,
+                 "hits": self.hits}
+        if self.category == "face":
+            track["age"] = self.age
+            track["gender"] = self.gender
+            track["expression"] = self.expression
+        return track
+
+
+class Tracker(object):
+    def __init__(self, min_iou=0.2, max_missed=5, smoothing=0.3):
+        """
+        :param min_iou: float, min IoU between a detection and a track to match them
+        :param max_missed: int, frames a track can go unmatched before it exits
+        :param smoothing: float (0-1], weight of every new face estimation
+        """
+        self.min_iou = min_iou
+        self.max_missed = max_missed
+        self.smoothing = smoothing
+        self.tracks = dict((category, []) for category in CATEGORIES)
+        self.frame_idx = 0
+        self._ids = itertools.count(1)
+
+    def update(self, detections, timestamp=None):
+        """
+        Associate the detections of a frame with the tracks, adding a
+        'track_id' to each detection dict
+        :param detections: dict as returned by HvcP.detection_execution
+        :param timestamp: float, time of the frame
+        :return: {'tracks': {category: [track dicts]},
+                  'events': [{'event': 'enter' or 'exit', 'category', 'track_id', 'timestamp'}]}
+        """
+        events = []
+        for category in CATEGORIES:
+            self._update_category(category, detections.get(category, ()), timestamp, events)
+        self.frame_idx += 1
+        return {"tracks": dict((category, [track.as_dict() for track in tracks])
+                               for category, tracks in self.tracks.items()),
+                "events": events}
+
+    def _update_category(self, category, results, timestamp, events):
+        tracks = self.tracks[category]
+        matches = []
+        if results and tracks:
+            scores = iou_matrix(boxes(results), boxes([track.result for track in tracks]))
+            matches = greedy_match(scores, self.min_iou)
+
+        matched_results = set()
+        matched_tracks = set()
+        for result_idx, track_idx in matches:
+            track = tracks[track_idx]
+            track.update(results[result_idx], self.frame_idx, timestamp, self.smoothing)
+            results[result_idx]["track_id"] = track.track_id
+            matched_results.add(result_idx)
+            matched_tracks.add(track_idx)
+
+        remaining = []
+        for track_idx, track in enumerate(tracks):
+            if track_idx not in matched_tracks:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    events.append({"event": "exit", "category": category,
+                                   "track_id": track.track_id, "timestamp": timestamp})
+                    continue
+            remaining.append(track)
+
+        for result_idx, result in enumerate(results):
+            if result_idx in matched_results:
+                continue
+            track = Track(next(self._ids), category, result, self.frame_idx, timestamp)
+            result["track_id"] = track.track_id
+            remaining.append(track)
+            events.append({"event": "enter", "category": category,
+                           "track_id": track.track_id, "timestamp": timestamp})
+        self.tracks[category] = remaining
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""
+I/O worker that owns the serial link of a HvcP and serves commands
+from any number of threads.
+
+Commands are queued and written as soon as there is room in the
+pipeline (max_in_flight), without waiting for the previous responses.
+The sensor answers in order, so every response is matched to the oldest
+command still waiting for one, and its length is checked against that
+command. Each submitted command returns a CommandFuture.
+
+When a response is lost or does not match (timeout, unexpected length)
+the responses still to come can not be matched any more: every command
+in flight fails and the input is drained before writing the next ones.
+
+While the worker runs, the HvcP must only be used through it.
+
+Usage:
+    worker = HvcPWorker(sensor)
+    detections = worker.detection_execution(gaze=False)
+    thresholds = worker.thresholds_read()  # queued behind the detection
+    print(detections.result(), thresholds.result())
+    worker.stop()
+"""
+
+import collections
+import queue
+import threading
+
+from hvcp_decoder import decode_detection
+from hvcp_protocol import (VERSION_COMMAND, parse_version,
+                           camera_orientation_command,
+                           GET_CAMERA_ORIENTATION_COMMAND, parse_camera_orientation,
+                           detection_command,
+                           THRESHOLDS_READ_COMMAND, parse_thresholds, thresholds_set_command,
+                           DETECTION_SIZE_READ_COMMAND, parse_detection_size,
+                           detection_size_set_command,
+                           FACE_DETECTION_ANGLE_READ_COMMAND, parse_face_detection_angle,
+                           face_inclination_angle_set_command,
+                           HvcPError, ResponseTimeout, FramingError, ResponseError,
+                           check_detection_size)
+
+
+class CommandFuture(object):
+    """
+    Result of a command that will be available once its response is read
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the response
+        :param timeout: float, seconds (None = forever)
+        :return: the parsed response, None if the response code is not OK
+        :raise HvcPError: if the response was lost or did not match the command
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for the response")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class HvcPWorker(object):
+    def __init__(self, sensor, max_in_flight=4):
+        """
+        :param sensor: HvcP, its link is owned by the worker until stop()
+        :param max_in_flight: int, commands written whose response was not read yet
+        """
+        self.sensor = sensor
+        self._requests = queue.Queue()
+        self._in_flight = threading.Semaphore(max_in_flight)
+        # (future, parser, command code) of the commands written, in order
+        self._pending = collections.deque()
+        self._pending_ready = threading.Condition()
+        # Held to write a command, and to resync the link
+        self._link_lock = threading.Lock()
+        self._stopping = False
+        self._writer = threading.Thread(target=self._write_loop)
+        self._reader = threading.Thread(target=self._read_loop)
+        for thread in (self._writer, self._reader):
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, command, parser=None):
+        """
+        Queue a command
+        :param command: bytes, full datagram
+        :param parser: function to turn the response data into the result,
+                       None to get the response code
+        :return: CommandFuture
+        """
+        if self._stopping:
+            raise RuntimeError("The worker is stopped")
+        future = CommandFuture()
+        self._requests.put((command, parser, future))
+        return future
+
+    def _write_loop(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+            command, parser, future = request
+            self._in_flight.acquire()
+            with self._link_lock:
+                try:
+                    self.sensor.send_command_hex(command)
+                except Exception as e:
+                    self._in_flight.release()
+                    future.set_exception(e)
+                    continue
+                with self._pending_ready:
+                    self._pending.append((future, parser, command[1]))
+                    self._pending_ready.notify()
+        with self._pending_ready:
+            self._pending.append(None)
+            self._pending_ready.notify()
+
+    def _read_loop(self):
+        while True:
+            with self._pending_ready:
+                while not self._pending:
+                    self._pending_ready.wait()
+                pending = self._pending.popleft()
+            if pending is None:
+                break
+            future, parser, command_code = pending
+            try:
+                data = self.sensor._read_response(command_code)
+            except (ResponseTimeout, FramingError) as e:
+                future.set_exception(e)
+                self._in_flight.release()
+                if self._resync(e):
+                    break
+                continue
+            except ResponseError as e:
+                future.set_result(e.response_code if parser is None else None)
+                self._in_flight.release()
+                continue
+            except Exception as e:
+                future.set_exception(e)
+                self._in_flight.release()
+                continue
+            try:
+                future.set_result(0 if parser is None else parser(data))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self._in_flight.release()
+
+    def _resync(self, error):
+        """
+        Fail every command in flight and drain the input, holding the writes
+        :return: bool, True if the worker was stopped meanwhile
+        """
+        with self._link_lock:
+            with self._pending_ready:
+                pending = list(self._pending)
+                self._pending.clear()
+            stopped = False
+            for request in pending:
+                if request is None:
+                    stopped = True
+                    continue
+                request[0].set_exception(FramingError(
+                    "Response discarded to resync the link after: " + str(error)))
+                self._in_flight.release()
+            self.sensor.drain_input()
+        return stopped
+
+    def stop(self):
+        """
+        Finish the queued commands and give the link back to the HvcP
+        """
+        self._stopping = True
+        self._requests.put(None)
+        self._writer.join()
+        self._reader.join()
+
+    def _setter(self, command):
+        # The configuration cache of the HvcP is not kept up to date through the worker
+        self.sensor.invalidate_config()
+        return self.submit(command)
+
+    def get_version(self):
+        return self.submit(VERSION_COMMAND, parse_version)
+
+    def set_camera_orientation(self, angle):
+        return self._setter(camera_orientation_command(angle))
+
+    def get_camera_orientation(self):
+        return self.submit(GET_CAMERA_ORIENTATION_COMMAND, parse_camera_orientation)
+
+    def detection_execution(self, **detection_flags):
+        """
+        :param detection_flags: see HvcP.detection_execution (no image_ring nor show_image)
+        :return: CommandFuture of the detections dict
+        """
+        command, bitmask_1, bitmask_2, bitmask_3 = detection_command(**detection_flags)
+        return self.submit(command, lambda data: self._decode_detection(data, bitmask_1,
+                                                                         bitmask_2, bitmask_3))
+
+    def _decode_detection(self, data, bitmask_1, bitmask_2, bitmask_3):
+        try:
+            check_detection_size(data, bitmask_1, bitmask_2, bitmask_3)
+        except FramingError:
+            self.sensor.errors["bad_lengths"] += 1
+            raise
+        return decode_detection(data, bitmask_1, bitmask_2, bitmask_3)
+
+    def thresholds_read(self):
+        return self.submit(THRESHOLDS_READ_COMMAND, parse_thresholds)
+
+    def thresholds_set(self, human_body, hand, face):
+        return self._setter(thresholds_set_command(human_body, hand, face))
+
+    def detection_size_read(self):
+        return self.submit(DETECTION_SIZE_READ_COMMAND, parse_detection_size)
+
+    def detection_size_set(self, human_body_min, human_body_max,
+                           hand_min, hand_max, face_min, face_max):
+        return self._setter(detection_size_set_command(human_body_min, human_body_max,
+                                                       hand_min, hand_max,
+                                                       face_min, face_max))
+
+    def face_detection_angle_read(self):
+        return self.submit(FACE_DETECTION_ANGLE_READ_COMMAND, parse_face_detection_angle)
+
+    def face_inclination_angle_set(self, face_direction, face_inclination):
+        """
+        :raise ValueError: on invalid face_direction or face_inclination
+        """
+        return self._setter(face_inclination_angle_set_command(face_direction, face_inclination))